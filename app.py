@@ -1,15 +1,30 @@
 import os
+import io
+import re
+import csv
+import json
 import time
+import bisect
+import codecs
 import random
-import base64
+import hashlib
+import logging
+import functools
+import threading
+import contextlib
 from pathlib import Path
 from datetime import datetime, timezone
-from typing import List, Dict
+from typing import List, Dict, Tuple
 
 import streamlit as st
 import streamlit.components.v1 as components
+from streamlit.runtime.scriptrunner import RerunException, StopException
 from supabase import create_client, Client
 
+from study_pdf import STUDY_DOCS, STUDY_INDEX_PATH, LazyStudyIndex, PageRenderer
+
+RERUN_T0 = time.perf_counter()  # inizio del rerun: misura del prologo (page.prologue)
+
 # =========================================================
 # PAGE CONFIG (UNA SOLA VOLTA, IN TESTA AL FILE)
 # =========================================================
@@ -215,6 +230,11 @@ st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
 N_QUESTIONS_DEFAULT = 30
 DURATION_SECONDS_DEFAULT = 30 * 60  # 30 minuti
 
+# visualizzazione simulazione: a pagine (solo le domande visibili vengono disegnate) o tutte insieme
+SIM_LAYOUTS = {"exam": "⚡ Esame", "paged": "📄 A pagine", "all": "📜 Tutte le domande"}
+SIM_PAGE_SIZES = [1, 5, 10]
+SIM_NAV_COLUMNS = 10  # bottoni per riga nel navigatore domande
+
 # =========================================================
 # ACCESSO CORSO
 # =========================================================
@@ -254,6 +274,149 @@ def render_live_timer(end_ts: float):
         height=40,
     )
 
+# =========================================================
+# METRICHE (DB HELPERS E PAGINE)
+# =========================================================
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_LOG_SECONDS = int(os.getenv("METRICS_LOG_SECONDS", "60"))  # 0 = niente log JSON
+
+metrics_log = logging.getLogger("quiz.metrics")
+if not metrics_log.handlers:  # lo script rigira a ogni rerun: un solo handler
+    _h = logging.StreamHandler()
+    _h.setFormatter(logging.Formatter("%(asctime)s %(name)s %(message)s"))
+    metrics_log.addHandler(_h)
+    metrics_log.setLevel(logging.INFO)
+    metrics_log.propagate = False
+
+class Metrics:
+    """
+    Contatori condivisi dal processo: per ogni serie (db.<helper> o page.<ramo>)
+    numero chiamate, errori, istogramma delle latenze e byte restituiti.
+    Leggibili come testo Prometheus, come riga JSON nel log o dal pannello docente.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.series: Dict[str, Dict] = {}
+        self.started_ts = time.time()
+        self.logged_ts = time.time()
+
+    def observe(self, name: str, seconds: float, nbytes: int = 0, error: bool = False) -> None:
+        with self.lock:
+            s = self.series.get(name)
+            if s is None:
+                s = {"count": 0, "errors": 0, "sum": 0.0, "bytes": 0, "buckets": [0] * (len(METRICS_BUCKETS) + 1)}
+                self.series[name] = s
+            s["count"] += 1
+            s["errors"] += int(error)
+            s["sum"] += seconds
+            s["bytes"] += nbytes
+            s["buckets"][bisect.bisect_left(METRICS_BUCKETS, seconds)] += 1
+
+            log_now = METRICS_LOG_SECONDS and time.time() - self.logged_ts >= METRICS_LOG_SECONDS
+            if log_now:
+                self.logged_ts = time.time()
+        if log_now:
+            metrics_log.info(json.dumps({"metrics": self.snapshot()}))
+
+    @staticmethod
+    def _quantile(buckets: List[int], q: float) -> float:
+        # stima dal limite superiore del bucket
+        total = sum(buckets)
+        if not total:
+            return 0.0
+        acc = 0
+        for i, c in enumerate(buckets):
+            acc += c
+            if acc >= q * total:
+                return METRICS_BUCKETS[i] if i < len(METRICS_BUCKETS) else float("inf")
+        return float("inf")
+
+    def snapshot(self) -> List[Dict]:
+        with self.lock:
+            items = sorted((k, dict(v, buckets=list(v["buckets"]))) for k, v in self.series.items())
+        return [
+            {
+                "serie": name,
+                "chiamate": s["count"],
+                "errori": s["errors"],
+                "media_ms": round(s["sum"] / s["count"] * 1000, 1) if s["count"] else 0.0,
+                "p50_ms<=": self._quantile(s["buckets"], 0.50) * 1000,
+                "p95_ms<=": self._quantile(s["buckets"], 0.95) * 1000,
+                "kb_totali": round(s["bytes"] / 1024, 1),
+            }
+            for name, s in items
+        ]
+
+    def prometheus_text(self) -> str:
+        lines = [
+            "# HELP quiz_duration_seconds Latenza di DB helper (kind=db) e rami di pagina (kind=page).",
+            "# TYPE quiz_duration_seconds histogram",
+        ]
+        errors, payload = [], []
+        with self.lock:
+            items = sorted((k, dict(v, buckets=list(v["buckets"]))) for k, v in self.series.items())
+        for name, s in items:
+            kind, _, fn = name.partition(".")
+            labels = f'kind="{kind}",name="{fn}"'
+            acc = 0
+            for le, c in zip(list(METRICS_BUCKETS) + ["+Inf"], s["buckets"]):
+                acc += c
+                lines.append(f'quiz_duration_seconds_bucket{{{labels},le="{le}"}} {acc}')
+            lines.append(f"quiz_duration_seconds_sum{{{labels}}} {s['sum']:.6f}")
+            lines.append(f"quiz_duration_seconds_count{{{labels}}} {s['count']}")
+            errors.append(f"quiz_errors_total{{{labels}}} {s['errors']}")
+            payload.append(f"quiz_payload_bytes_total{{{labels}}} {s['bytes']}")
+        lines += ["# TYPE quiz_errors_total counter"] + errors
+        lines += ["# TYPE quiz_payload_bytes_total counter"] + payload
+        return "\n".join(lines) + "\n"
+
+    def reset(self) -> None:
+        with self.lock:
+            self.series.clear()
+            self.started_ts = time.time()
+
+@st.cache_resource(show_spinner=False)
+def get_metrics() -> Metrics:
+    return Metrics()
+
+def _payload_bytes(result) -> int:
+    if result is None:
+        return 0
+    try:
+        return len(json.dumps(result, default=str))
+    except (TypeError, ValueError):
+        return 0
+
+def instrumented(fn):
+    """Decoratore per i DB helper: latenza, errori e dimensione della risposta."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            get_metrics().observe(f"db.{fn.__name__}", time.perf_counter() - t0, error=True)
+            raise
+        get_metrics().observe(f"db.{fn.__name__}", time.perf_counter() - t0, _payload_bytes(result))
+        return result
+    return wrapper
+
+@contextlib.contextmanager
+def page_timer(page: str):
+    # st.stop()/st.rerun() escono con un'eccezione di controllo: non sono errori
+    t0 = time.perf_counter()
+    error = False
+    try:
+        yield
+    except (StopException, RerunException):
+        raise
+    except Exception:
+        error = True
+        raise
+    finally:
+        get_metrics().observe(f"page.{page}", time.perf_counter() - t0, error=error)
+
 # =========================================================
 # SUPABASE
 # =========================================================
@@ -274,103 +437,930 @@ if not SUPABASE_URL or not SUPABASE_ANON_KEY:
     st.error("Mancano SUPABASE_URL / SUPABASE_ANON_KEY nelle Secrets (o env).")
     st.stop()
 
-sb: Client = create_client(SUPABASE_URL, SUPABASE_ANON_KEY)
+@st.cache_resource(show_spinner=False)
+def get_supabase(url: str, key: str) -> Client:
+    # un solo client (e pool di connessioni) per processo, non uno per rerun
+    return create_client(url, key)
+
+sb: Client = get_supabase(SUPABASE_URL, SUPABASE_ANON_KEY)
 
 # =========================================================
 # DB HELPERS
 # =========================================================
+STUDENT_CACHE_TTL_SECONDS = 6 * 60 * 60
+STUDENT_CACHE_MAX_ENTRIES = 5000
+
 def upsert_student(class_code: str, nickname: str) -> Dict:
-    class_code = class_code.strip()
-    nickname = nickname.strip()
+    return _upsert_student_cached(class_code.strip(), nickname.strip())
 
-    res = (
+@st.cache_data(ttl=STUDENT_CACHE_TTL_SECONDS, max_entries=STUDENT_CACHE_MAX_ENTRIES, show_spinner=False)
+@instrumented
+def _upsert_student_cached(class_code: str, nickname: str) -> Dict:
+    """
+    Un solo upsert atomico su (class_code, nickname) che restituisce la riga:
+    niente doppioni con login simultanei. Gli studenti già visti restano in cache
+    nel processo, quindi re-login e refresh non interrogano il DB.
+    """
+    return (
         sb.table("students")
-        .select("*")
-        .eq("class_code", class_code)
-        .eq("nickname", nickname)
+        .upsert({"class_code": class_code, "nickname": nickname}, on_conflict="class_code,nickname")
+        .execute()
+        .data[0]
+    )
+
+@instrumented
+def start_session(
+    student_id: int,
+    question_ids: List[int],
+    duration_seconds: int,
+    topic_id: int | None = None,
+    bank_version: int | None = None,
+) -> Tuple[Dict, List[Dict]]:
+    """
+    Avvio simulazione in un'unica transazione lato DB (funzione SQL start_session):
+    crea la sessione e le righe quiz_answers per gli id scelti, in una sola chiamata.
+    Con topic_id la sessione è registrata come simulazione su quell'argomento;
+    bank_version è la versione della banca dati da cui sono stati sorteggiati gli id.
+    Ritorna (sessione, righe quiz_answers compatte: id, question_id, position, lettere).
+    """
+    res = sb.rpc(
+        "start_session",
+        {
+            "p_student_id": student_id,
+            "p_question_ids": [int(i) for i in question_ids],
+            "p_duration_seconds": int(duration_seconds),
+            "p_topic_scope": "topic" if topic_id is not None else "bank",
+            "p_topic_id": topic_id,
+            "p_bank_version": bank_version,
+        },
+    ).execute().data
+    return res["session"], res["questions"] or []
+
+@instrumented
+def start_session_from_paper(
+    student_id: int, n: int, duration_seconds: int, topic_id: int | None = None, balanced: bool = False
+) -> Tuple[Dict, List[Dict]] | None:
+    """
+    Avvio da un foglio d'esame preparato dal docente (funzione SQL start_session_from_paper):
+    prende un foglio libero adatto e avvia la sessione nella stessa transazione.
+    Ritorna None se non ci sono fogli disponibili.
+    """
+    res = sb.rpc(
+        "start_session_from_paper",
+        {
+            "p_student_id": student_id,
+            "p_n_questions": int(n),
+            "p_duration_seconds": int(duration_seconds),
+            "p_topic_id": topic_id,
+            "p_balanced": bool(balanced),
+        },
+    ).execute().data
+    if not res:
+        return None
+    return res["session"], res["questions"] or []
+
+@instrumented
+def insert_exam_papers(rows: List[Dict]) -> int:
+    return len(sb.table("exam_papers").insert(rows).execute().data or [])
+
+@instrumented
+def count_unclaimed_papers() -> int:
+    res = sb.table("exam_papers").select("id", count="exact").is_("claimed_at", "null").limit(1).execute()
+    return int(res.count or 0)
+
+@instrumented
+def delete_unclaimed_papers() -> None:
+    sb.table("exam_papers").delete().is_("claimed_at", "null").execute()
+
+# colonne della riga sessions che descrivono stato, scadenza e riepilogo della simulazione
+SESSION_STATE_COLUMNS = "id, student_id, status, started_at, duration_seconds, finished_at, score, answered, n_questions"
+
+@instrumented
+def finish_session(session_id: str) -> Dict:
+    """
+    Chiude e corregge la sessione lato DB (funzione SQL grade_session):
+    esito per domanda, punteggio e risposte date salvati sulla riga sessions.
+    Ritorna il riepilogo.
+    """
+    return sb.rpc("grade_session", {"p_session_id": session_id}).execute().data
+
+@instrumented
+def fetch_session(session_id: str) -> Dict | None:
+    res = sb.table("sessions").select(SESSION_STATE_COLUMNS).eq("id", session_id).limit(1).execute().data
+    return res[0] if res else None
+
+@instrumented
+def fetch_open_session(student_id: int) -> Dict | None:
+    # ultima simulazione non ancora chiusa dallo studente (in corso o con risultati da vedere)
+    res = (
+        sb.table("sessions")
+        .select(SESSION_STATE_COLUMNS)
+        .eq("student_id", student_id)
+        .in_("status", ["in_progress", "finished"])
+        .order("started_at", desc=True)
         .limit(1)
         .execute()
         .data
     )
-    if res:
-        return res[0]
-
-    ins = sb.table("students").insert({"class_code": class_code, "nickname": nickname}).execute().data
-    return ins[0]
-
-def create_session(student_id: int, n_questions: int) -> Dict:
-    payload = {
-        "student_id": student_id,
-        "mode": "sim",
-        "topic_scope": "bank",
-        "selected_topic_id": None,
-        "n_questions": int(n_questions),
-        "started_at": datetime.now(timezone.utc).isoformat(),
-    }
-    return sb.table("sessions").insert(payload).execute().data[0]
+    return res[0] if res else None
 
-def finish_session(session_id: str) -> None:
-    sb.table("sessions").update({"finished_at": datetime.now(timezone.utc).isoformat()}).eq("id", session_id).execute()
+@instrumented
+def close_session(session_id: str) -> None:
+    sb.table("sessions").update({"status": "closed"}).eq("id", session_id).execute()
 
-def fetch_bank_count() -> int:
-    res = sb.table("question_bank").select("id", count="exact").limit(1).execute()
-    return int(res.count or 0)
+SWEEP_BATCH_SIZE = 200
+SWEEP_GRACE_SECONDS = 120  # margine per la consegna automatica dal browser
 
-def fetch_all_bank_questions() -> List[Dict]:
-    return sb.table("question_bank").select("*").order("id").execute().data or []
-
-def insert_session_questions(session_id: str, questions: List[Dict]) -> None:
-    rows = []
-    for q in questions:
-        qa = (q.get("question_text") or "").strip()
-        oa = (q.get("option_a") or "").strip()
-        ob = (q.get("option_b") or "").strip()
-        oc = (q.get("option_c") or "").strip()
-        od = (q.get("option_d") or "").strip()
-
-        co = (q.get("correct_option") or "").strip().upper()
-        if co not in ["A", "B", "C", "D"]:
-            co = "A"
-
-        if od == "" and co == "D":
-            if oc:
-                co = "C"
-            elif ob:
-                co = "B"
-            else:
-                co = "A"
+@instrumented
+def sweep_expired_sessions(limit: int = SWEEP_BATCH_SIZE) -> int:
+    """
+    Corregge un blocco di sessioni scadute e mai consegnate (funzione SQL
+    sweep_expired_sessions). Ritorna quante ne ha chiuse.
+    """
+    res = sb.rpc(
+        "sweep_expired_sessions", {"p_limit": int(limit), "p_grace_seconds": SWEEP_GRACE_SECONDS}
+    ).execute().data
+    return int(res["finalized"])
 
-        rows.append(
-            {
-                "session_id": session_id,
-                "topic_id": None,
-                "question_text": qa,
-                "option_a": oa,
-                "option_b": ob,
-                "option_c": oc,
-                "option_d": od if od else "",
-                "correct_option": co,
-                "chosen_option": None,
-                "explanation": (q.get("explanation") or "").strip(),
-            }
+@instrumented
+def fetch_bank_version() -> Tuple[int, int]:
+    """
+    Ultima versione pubblicata della banca dati: (versione, numero domande).
+    Una sola richiesta che restituisce una riga.
+    """
+    res = sb.table("bank_versions").select("version, n_questions").order("version", desc=True).limit(1).execute().data
+    return (int(res[0]["version"]), int(res[0]["n_questions"])) if res else (0, 0)
+
+@instrumented
+def publish_bank_version() -> int:
+    # rende visibili in una volta tutte le righe scritte dall'ultima pubblicazione
+    return int(sb.rpc("publish_bank_version", {}).execute().data["version"])
+
+@instrumented
+def fetch_changed_question_ids(after_version: int) -> List[int]:
+    # paginazione keyset su id (limite righe PostgREST, BANK_PAGE_SIZE): una pubblicazione
+    # può toccare più di una pagina di domande
+    out: List[int] = []
+    last_id = None
+    while True:
+        q = sb.table("question_bank").select("id").gt("version_changed", after_version).order("id").limit(BANK_PAGE_SIZE)
+        if last_id is not None:
+            q = q.gt("id", last_id)
+        chunk = q.execute().data or []
+        out.extend(int(r["id"]) for r in chunk)
+        if len(chunk) < BANK_PAGE_SIZE:
+            break
+        last_id = out[-1]
+    return out
+
+@instrumented
+def fetch_topics() -> Dict[int, str]:
+    return {int(r["id"]): r["name"] for r in (sb.table("topics").select("id, name").execute().data or [])}
+
+@instrumented
+def upsert_topics(names: List[str]) -> Dict[str, int]:
+    # idempotente sul nome: restituisce nome -> id anche per gli argomenti già presenti
+    rows = sb.table("topics").upsert([{"name": n} for n in names], on_conflict="name").execute().data or []
+    return {r["name"]: int(r["id"]) for r in rows}
+
+BANK_PAGE_SIZE = 1000  # limite righe per richiesta PostgREST
+BANK_INDEX_COLUMNS = "id, n_options, correct_option, explanation, content_hash, topic_id"
+
+@instrumented
+def fetch_bank_index_rows(upto_version: int, after_version: int | None = None) -> List[Dict]:
+    """
+    Colonne compatte per l'indice (no testo domanda), paginazione keyset su id.
+    Solo le domande dello snapshot upto_version; con after_version solo quelle
+    aggiunte o modificate dopo quella versione (aggiornamento incrementale).
+    """
+    out: List[Dict] = []
+    last_id = None
+    while True:
+        q = (
+            sb.table("question_bank")
+            .select(BANK_INDEX_COLUMNS)
+            .lte("version_added", upto_version)
+            .order("id")
+            .limit(BANK_PAGE_SIZE)
         )
+        if after_version is not None:
+            q = q.gt("version_changed", after_version)
+        if last_id is not None:
+            q = q.gt("id", last_id)
+        chunk = q.execute().data or []
+        out.extend(chunk)
+        if len(chunk) < BANK_PAGE_SIZE:
+            break
+        last_id = int(chunk[-1]["id"])
+    return out
+
+# =========================================================
+# INDICE BANCA DATI (CONDIVISO DA TUTTO IL PROCESSO)
+# =========================================================
+BANK_VERSION_CHECK_SECONDS = 60  # ogni quanto (al massimo) si rilegge la versione pubblicata sul DB
+
+def topic_quotas(n: int, pools: Dict, balanced: bool = False) -> Dict:
+    """
+    Quante domande estrarre da ciascun argomento (pools: argomento -> numero di domande).
+    Proporzionale alla dimensione dell'argomento (resti più grandi), oppure in parti
+    uguali con balanced=True; la quota che un argomento non può coprire passa agli altri.
+    """
+    quotas = {k: 0 for k in pools}
+    left = min(n, sum(pools.values()))
+    while left > 0:
+        open_pools = {k: pools[k] - quotas[k] for k in pools if pools[k] > quotas[k]}
+        weights = {k: (1 if balanced else pools[k]) for k in open_pools}
+        total = sum(weights.values())
+        shares = {k: left * w / total for k, w in weights.items()}
+        give = {k: min(int(shares[k]), open_pools[k]) for k in open_pools}
+        # resti: uno ciascuno agli argomenti con la parte frazionaria maggiore
+        rest = left - sum(give.values())
+        for k in sorted(open_pools, key=lambda k: shares[k] - int(shares[k]), reverse=True):
+            if rest == 0:
+                break
+            if give[k] < open_pools[k]:
+                give[k] += 1
+                rest -= 1
+        for k, g in give.items():
+            quotas[k] += g
+            left -= g
+    return quotas
+
+class BankIndex:
+    """
+    Indice in memoria della banca dati: id -> numero di opzioni, lettera corretta, spiegazione,
+    hash di contenuto, argomento (più gli indici inversi hash -> id usato dall'import
+    e argomento -> id usato dal sorteggio).
+    È lo snapshot di una versione pubblicata (self.version): costruito una volta per
+    processo, aggiornato in modo incrementale (solo le righe cambiate) quando la
+    versione sul DB avanza.
+    """
 
-    if rows:
-        sb.table("quiz_answers").insert(rows).execute()
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.entries: Dict[int, Dict] = {}
+        self.by_hash: Dict[str, int] = {}
+        self.by_topic: Dict[int | None, List[int]] = {}
+        self.topics: Dict[int, str] = {}
+        self.ids: List[int] = []
+        self.version: int | None = None
+        # ultima (versione, numero domande) letta dal DB, usata anche da count() e QuestionTexts
+        self.remote: Tuple[int, int] | None = None
+        self.remote_ts = 0.0
+
+    @staticmethod
+    def _entry(row: Dict) -> Dict:
+        # righe già canoniche (validate_csv_row + vincoli su question_bank): nessuna pulizia
+        return {
+            "n_options": int(row["n_options"]),
+            "correct": row["correct_option"],
+            "explanation": row["explanation"],
+            "hash": row.get("content_hash"),
+            "topic": int(row["topic_id"]) if row.get("topic_id") is not None else None,
+        }
+
+    def _rebuild(self, version: int) -> None:
+        rows = fetch_bank_index_rows(version)
+        self.entries = {int(r["id"]): self._entry(r) for r in rows}
+        self.by_hash = {e["hash"]: rid for rid, e in self.entries.items() if e["hash"]}
+        self.ids = sorted(self.entries)
+        self.by_topic = {}
+        for rid in self.ids:
+            self.by_topic.setdefault(self.entries[rid]["topic"], []).append(rid)
+        self.topics = fetch_topics()
+
+    def add_rows(self, rows: List[Dict]) -> None:
+        with self.lock:
+            for r in rows:
+                rid = int(r["id"])
+                entry = self._entry(r)
+                old = self.entries.get(rid)
+                if old is None:
+                    self.ids.append(rid)
+                    self.by_topic.setdefault(entry["topic"], []).append(rid)
+                elif old["topic"] != entry["topic"]:
+                    self.by_topic[old["topic"]].remove(rid)
+                    self.by_topic.setdefault(entry["topic"], []).append(rid)
+                self.entries[rid] = entry
+                if entry["hash"]:
+                    self.by_hash[entry["hash"]] = rid
+            self.ids.sort()
+            if any(t is not None and t not in self.topics for t in self.by_topic):
+                self.topics = fetch_topics()
+
+    def remote_version(self, force: bool = False) -> Tuple[int, int]:
+        # (versione, numero domande) pubblicati: una riga, al massimo ogni BANK_VERSION_CHECK_SECONDS
+        with self.lock:
+            now = time.time()
+            if force or self.remote is None or now - self.remote_ts >= BANK_VERSION_CHECK_SECONDS:
+                self.remote = fetch_bank_version()
+                self.remote_ts = now
+            return self.remote
+
+    def invalidate(self) -> None:
+        # al prossimo uso l'indice si ricostruisce da zero (es. domanda eliminata a mano)
+        with self.lock:
+            self.version = None
+            self.remote_ts = 0.0
+
+    def refresh(self) -> None:
+        # dopo una pubblicazione fatta da questo processo: la nuova versione si legge subito
+        with self.lock:
+            self.remote_version(force=True)
+            self.ensure_fresh()
+
+    def ensure_fresh(self) -> None:
+        with self.lock:
+            remote, n_questions = self.remote_version()
+            if self.version == remote:
+                return
+            if self.version is not None and remote > self.version:
+                # solo le righe aggiunte o modificate dopo la versione caricata
+                self.add_rows(fetch_bank_index_rows(remote, after_version=self.version))
+                if len(self.ids) == n_questions:
+                    self.version = remote
+                    return
+            # primo caricamento, righe eliminate o DB ricreato: ricostruzione completa
+            self._rebuild(remote)
+            self.version = remote
+
+    def count(self) -> int:
+        # basta la versione (una riga): l'indice completo si carica solo per sorteggio e import
+        with self.lock:
+            if self.version is not None:
+                # indice già caricato: resta allineato alla versione come per il sorteggio
+                self.ensure_fresh()
+                return len(self.ids)
+            return self.remote_version()[1]
+
+    def get(self, question_id: int) -> Dict | None:
+        self.ensure_fresh()
+        return self.entries.get(int(question_id))
+
+    def find_hash(self, content_hash: str) -> Dict | None:
+        rid = self.by_hash.get(content_hash)
+        return self.entries.get(rid) if rid is not None else None
+
+    def add_topics(self, topics: Dict[str, int]) -> None:
+        with self.lock:
+            self.topics.update({tid: name for name, tid in topics.items()})
+
+    def topic_counts(self) -> List[Tuple[int, str, int]]:
+        """(id, nome, numero di domande) degli argomenti con almeno una domanda, per nome."""
+        self.ensure_fresh()
+        with self.lock:
+            out = [(t, self.topics.get(t, f"Argomento {t}"), len(ids)) for t, ids in self.by_topic.items() if t is not None and ids]
+        return sorted(out, key=lambda x: x[1].lower())
+
+    def sample_ids(self, n: int, topic_id: int | None = None, balanced: bool = False) -> List[int]:
+        """
+        Sorteggio di n id. Con topic_id solo da quell'argomento; altrimenti a strati:
+        quote per argomento (proporzionali, o uguali con balanced=True) estratte
+        dalle liste argomento -> id, senza scorrere la banca dati.
+        """
+        self.ensure_fresh()
+        with self.lock:
+            pools = {topic_id: self.by_topic.get(topic_id, [])} if topic_id is not None else self.by_topic
+            available = sum(len(ids) for ids in pools.values())
+            if available < n:
+                raise ValueError(f"Domande insufficienti in banca dati: {available} < {n}")
+            quotas = topic_quotas(n, {t: len(ids) for t, ids in pools.items()}, balanced=balanced)
+            picked = [rid for t, q in quotas.items() if q for rid in random.sample(pools[t], q)]
+        random.shuffle(picked)
+        return picked
+
+    def deal_papers(self, k: int, n: int, topic_id: int | None = None, balanced: bool = False) -> List[List[int]]:
+        """
+        k fogli da n domande con le stesse quote per argomento di sample_ids.
+        Le domande si distribuiscono da mazzi mescolati (uno per argomento): nessuna
+        domanda si ripete tra fogli finché il mazzo dell'argomento non è esaurito,
+        poi il mazzo si rimescola. Dentro un foglio non ci sono doppioni.
+        """
+        self.ensure_fresh()
+        with self.lock:
+            pools = {topic_id: list(self.by_topic.get(topic_id, []))} if topic_id is not None else {
+                t: list(ids) for t, ids in self.by_topic.items()
+            }
+        available = sum(len(ids) for ids in pools.values())
+        if available < n:
+            raise ValueError(f"Domande insufficienti in banca dati: {available} < {n}")
+        quotas = topic_quotas(n, {t: len(ids) for t, ids in pools.items()}, balanced=balanced)
+
+        decks = {t: [] for t in pools}
+        papers = []
+        for _ in range(k):
+            paper: List[int] = []
+            for t, q in quotas.items():
+                taken, skipped = set(), []
+                while len(taken) < q:
+                    if not decks[t]:
+                        decks[t] = random.sample(pools[t], len(pools[t]))
+                    rid = decks[t].pop()
+                    if rid in taken:
+                        skipped.append(rid)  # già nel foglio (mazzo rimescolato): resta per i fogli dopo
+                        continue
+                    taken.add(rid)
+                decks[t] = skipped + decks[t]
+                paper.extend(taken)
+            random.shuffle(paper)
+            papers.append(paper)
+        return papers
+
+@st.cache_resource(show_spinner=False)
+def get_bank_index() -> BankIndex:
+    return BankIndex()
+
+class QuestionTexts:
+    """
+    Testo, opzioni e spiegazione delle domande per id, condivisi dal processo: le righe
+    quiz_answers referenziano la domanda e il contenuto si unisce da qui.
+    La cache è legata a una versione della banca dati: quando la versione pubblicata
+    avanza si dimenticano solo gli id modificati dopo (una lettura dei soli id).
+    """
 
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.texts: Dict[int, Dict] = {}
+        self.version: int | None = None
+
+    def _sync_version(self) -> None:
+        remote = get_bank_index().remote_version()[0]
+        with self.lock:
+            known = self.version
+        if known is None or remote < known:
+            changed = None  # prima lettura o DB ricreato: si riparte da zero
+        elif remote == known:
+            return
+        else:
+            changed = fetch_changed_question_ids(known)
+        with self.lock:
+            if changed is None:
+                self.texts.clear()
+            for i in changed or []:
+                self.texts.pop(i, None)
+            self.version = remote
+
+    def get_many(self, ids: List[int]) -> Dict[int, Dict]:
+        self._sync_version()
+        with self.lock:
+            missing = sorted({int(i) for i in ids} - self.texts.keys())
+        if missing:
+            fetched = {
+                int(r["id"]): {f: r[f] for f in SESSION_ROW_FIELDS}
+                for r in fetch_question_texts(missing)
+            }
+            with self.lock:
+                self.texts.update(fetched)
+        with self.lock:
+            return {int(i): self.texts[int(i)] for i in ids if int(i) in self.texts}
+
+@st.cache_resource(show_spinner=False)
+def get_question_texts() -> QuestionTexts:
+    return QuestionTexts()
+
+PAPER_RETRY_SECONDS = 30  # senza fogli liberi si torna a provarli dopo questo intervallo
+
+@st.cache_resource(show_spinner=False)
+def get_paper_state() -> Dict:
+    # condiviso dal processo: evita una chiamata a vuoto per ogni avvio quando i fogli sono finiti;
+    # {(n, topic_id, balanced): istante fino al quale quel tipo di foglio non si prova}
+    return {"empty_until": {}}
+
+def prepare_exam_papers(k: int, n: int, topic_id: int | None = None, balanced: bool = False) -> int:
+    idx = get_bank_index()
+    papers = idx.deal_papers(k, n, topic_id, balanced)
+    created = insert_exam_papers(
+        [
+            {"question_ids": p, "n_questions": n, "topic_id": topic_id, "balanced": balanced, "bank_version": idx.version}
+            for p in papers
+        ]
+    )
+    get_paper_state()["empty_until"].pop((n, topic_id, balanced), None)
+    return created
+
+def start_sim_session(
+    student_id: int, n: int, duration_seconds: int, topic_id: int | None = None, balanced: bool = False
+) -> Tuple[Dict, List[Dict]]:
+    """
+    Prima prova un foglio preparato dal docente (una sola chiamata, niente sorteggio);
+    altrimenti sorteggio degli id sull'indice in memoria + avvio atomico della sessione.
+    Se un id sorteggiato non esiste più la transazione fallisce senza lasciare
+    tracce: si ricostruisce l'indice e si riprova una volta.
+    """
+    empty_until = get_paper_state()["empty_until"]
+    kind = (n, topic_id, balanced)
+    if time.time() >= empty_until.get(kind, 0.0):
+        try:
+            started = start_session_from_paper(student_id, n, duration_seconds, topic_id, balanced)
+            if started is not None:
+                return started
+            # nessun foglio libero di questo tipo: gli altri tipi restano da provare
+            empty_until[kind] = time.time() + PAPER_RETRY_SECONDS
+        except Exception:
+            pass  # errore già contato in db.start_session_from_paper: si sorteggia, senza pausa
+
+    idx = get_bank_index()
+    try:
+        ids = idx.sample_ids(n, topic_id, balanced)
+        return start_session(student_id, ids, duration_seconds, topic_id, idx.version)
+    except ValueError:
+        raise
+    except Exception:
+        idx.invalidate()
+        ids = idx.sample_ids(n, topic_id, balanced)
+        return start_session(student_id, ids, duration_seconds, topic_id, idx.version)
+
+SESSION_ANSWER_COLUMNS = "id, question_id, position, correct_option, chosen_option"
+LEGACY_ANSWER_COLUMNS = "id, question_text, option_a, option_b, option_c, option_d, explanation"
+
+@instrumented
 def fetch_session_questions(session_id: str) -> List[Dict]:
-    return (
+    """
+    Righe compatte della sessione (il testo si prende da question_bank, vedi QuestionTexts).
+    Solo le righe vecchie rimaste senza question_id portano ancora la propria copia del testo.
+    """
+    rows = (
         sb.table("quiz_answers")
-        .select("*")
+        .select(SESSION_ANSWER_COLUMNS)
         .eq("session_id", session_id)
-        .order("id")
+        .order("position")
         .execute()
         .data
         or []
     )
+    legacy = [int(r["id"]) for r in rows if r.get("question_id") is None]
+    if legacy:
+        texts = {
+            int(r["id"]): r
+            for r in sb.table("quiz_answers").select(LEGACY_ANSWER_COLUMNS).in_("id", legacy).execute().data or []
+        }
+        for r in rows:
+            r.update(texts.get(int(r["id"]), {}))
+    return rows
+
+QUESTION_TEXT_COLUMNS = "id, question_text, option_a, option_b, option_c, option_d, explanation"
+QUESTION_TEXT_CHUNK = 200  # id per richiesta (lunghezza URL del filtro in.)
+
+@instrumented
+def fetch_question_texts(ids: List[int]) -> List[Dict]:
+    out: List[Dict] = []
+    for i in range(0, len(ids), QUESTION_TEXT_CHUNK):
+        chunk = ids[i : i + QUESTION_TEXT_CHUNK]
+        out.extend(sb.table("question_bank").select(QUESTION_TEXT_COLUMNS).in_("id", chunk).execute().data or [])
+    return out
+
+QUESTION_STATS_COLUMNS = (
+    "question_id, served, answered, correct, chosen_a, chosen_b, chosen_c, chosen_d, rest_sum_correct, rest_sum_wrong"
+)
+
+@instrumented
+def fetch_question_stats() -> List[Dict]:
+    """
+    Aggregati per domanda (tabella question_stats, aggiornata da grade_session):
+    una riga per domanda già proposta, paginazione keyset su question_id.
+    """
+    out: List[Dict] = []
+    last_id = None
+    while True:
+        q = sb.table("question_stats").select(QUESTION_STATS_COLUMNS).order("question_id").limit(BANK_PAGE_SIZE)
+        if last_id is not None:
+            q = q.gt("question_id", last_id)
+        chunk = q.execute().data or []
+        out.extend(chunk)
+        if len(chunk) < BANK_PAGE_SIZE:
+            break
+        last_id = int(chunk[-1]["question_id"])
+    return out
+
+@instrumented
+def save_answers(session_id: str, answers: Dict[int, str | None]) -> bool:
+    """
+    Salvataggio in blocco delle risposte (funzione SQL save_answers): una sola
+    chiamata qualunque sia il numero di risposte.
+    Ritorna False se la sessione è già chiusa o scaduta (nessuna risposta salvata).
+    """
+    res = sb.rpc(
+        "save_answers",
+        {
+            "p_session_id": session_id,
+            "p_answers": {str(int(k)): v for k, v in answers.items()},
+            "p_grace_seconds": SWEEP_GRACE_SECONDS,
+        },
+    ).execute()
+    return res.data is None or int(res.data) >= 0
+
+# =========================================================
+# CHIUSURA SESSIONI SCADUTE (THREAD IN BACKGROUND)
+# =========================================================
+SWEEP_INTERVAL_SECONDS = int(os.getenv("SWEEP_INTERVAL_SECONDS", "60"))  # 0 = disattivato (es. con sweeper.py)
+
+def sweep_all_expired() -> int:
+    # blocchi finché la funzione SQL ne trova di pieni
+    total = 0
+    while True:
+        n = sweep_expired_sessions()
+        total += n
+        if n < SWEEP_BATCH_SIZE:
+            return total
+
+@st.cache_resource(show_spinner=False)
+def start_deadline_sweeper() -> threading.Event | None:
+    """
+    Un thread per processo che chiude le sessioni abbandonate. Con più repliche
+    ognuna ha il suo thread: la funzione SQL salta le righe già in lavorazione.
+    Ritorna l'evento per fermarlo (None se disattivato).
+    """
+    if SWEEP_INTERVAL_SECONDS <= 0:
+        return None
+    stop = threading.Event()
+
+    def _loop():
+        while not stop.wait(SWEEP_INTERVAL_SECONDS):
+            try:
+                n = sweep_all_expired()
+                if n:
+                    metrics_log.info(json.dumps({"sweeper": {"finalized": n}}))
+            except Exception as e:
+                metrics_log.warning(json.dumps({"sweeper": {"error": str(e)}}))
 
-def update_chosen_option(row_id: int, session_id: str, chosen_letter: str | None) -> None:
-    sb.table("quiz_answers").update({"chosen_option": chosen_letter}).eq("id", row_id).eq("session_id", session_id).execute()
+    threading.Thread(target=_loop, name="deadline-sweeper", daemon=True).start()
+    return stop
+
+# =========================================================
+# IMPORT CSV DOCENTE (STREAMING, A BLOCCHI)
+# =========================================================
+CSV_REQUIRED_COLUMNS = ["question_text", "option_a", "option_b", "option_c", "option_d", "correct_option"]
+CSV_TOPIC_COLUMN = "topic"  # opzionale: nome dell'argomento (creato se non esiste)
+CSV_ENCODINGS = ("utf-8-sig", "latin1")  # utf-8-sig legge anche UTF-8 senza BOM
+CSV_SNIFF_BYTES = 64 * 1024
+# spazi compressi e tolti ai bordi: solo questi, come question_bank_norm in SQL
+# (str.split()/strip() toccherebbero anche NBSP e \x1c-\x1f, che il backfill SQL lascia)
+CSV_WHITESPACE = " \t\n\r\f\v"
+CSV_WHITESPACE_RE = re.compile(r"[ \t\n\r\f\v]+")
+IMPORT_CHUNK_SIZE = 500
+IMPORT_RETRIES = 3
+IMPORT_MAX_REPORTED_REJECTS = 50
+
+@instrumented
+def upsert_bank_rows(rows: List[Dict]) -> List[Dict]:
+    # idempotente: una riga con lo stesso content_hash aggiorna quella esistente
+    return sb.table("question_bank").upsert(rows, on_conflict="content_hash").execute().data or []
+
+@instrumented
+def stage_bank_updates(rows: List[Dict]) -> None:
+    # spiegazione/argomento di domande già pubblicate: applicati da publish_bank_version
+    sb.table("question_bank_staging").upsert(
+        [{"content_hash": r["content_hash"], "explanation": r["explanation"], "topic_id": r["topic_id"]} for r in rows],
+        on_conflict="content_hash",
+    ).execute()
+
+def _norm_text(t: str) -> str:
+    return CSV_WHITESPACE_RE.sub(" ", t or "").strip(" ").lower()
+
+def question_hash(row: Dict) -> str:
+    """
+    Hash di contenuto normalizzato (testo, opzioni, lettera corretta).
+    Deve restare allineato con la migrazione SQL che ha calcolato gli hash esistenti.
+    """
+    parts = [_norm_text(row.get(c, "")) for c in CSV_REQUIRED_COLUMNS[:-1]]
+    parts.append((row.get("correct_option") or "").strip(CSV_WHITESPACE).upper())
+    return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+def detect_csv_encoding(f) -> str:
+    # decodifica solo un prefisso del file (final=False: ignora un carattere troncato in coda)
+    f.seek(0)
+    prefix = f.read(CSV_SNIFF_BYTES)
+    f.seek(0)
+    for enc in CSV_ENCODINGS:
+        try:
+            codecs.getincrementaldecoder(enc)().decode(prefix, final=False)
+            return enc
+        except UnicodeDecodeError:
+            continue
+    return CSV_ENCODINGS[-1]
+
+def validate_csv_row(raw: Dict) -> Tuple[Dict | None, str | None]:
+    """
+    Ritorna (riga canonica, None) se valida, (None, motivo) se da scartare,
+    (None, None) se la riga è vuota e va saltata.
+    Forma canonica (l'unica ammessa in question_bank, vedi i vincoli SQL): campi senza
+    spazi ai bordi, almeno le opzioni A e B, opzioni presenti consecutive, lettera
+    corretta maiuscola riferita a un'opzione presente. Nessuna correzione automatica:
+    una riga che non rispetta la forma si scarta e il docente la vede nel riepilogo.
+    """
+    row = {c: (raw.get(c) or "").strip(CSV_WHITESPACE) for c in CSV_REQUIRED_COLUMNS + ["explanation"]}
+    if not any(row.values()):
+        return None, None
+
+    row["correct_option"] = row["correct_option"].upper()
+    if not row["question_text"]:
+        return None, "question_text vuota"
+    if not row["option_a"] or not row["option_b"]:
+        return None, "servono almeno option_a e option_b"
+    if row["option_d"] and not row["option_c"]:
+        return None, "option_d presente ma option_c vuota"
+    if row["correct_option"] not in ["A", "B", "C", "D"]:
+        return None, "correct_option non valido (deve essere A/B/C/D)"
+    if not row[f"option_{row['correct_option'].lower()}"]:
+        return None, f"correct_option = {row['correct_option']} ma option_{row['correct_option'].lower()} vuota"
+
+    row["content_hash"] = question_hash(row)
+    if CSV_TOPIC_COLUMN in raw:
+        row[CSV_TOPIC_COLUMN] = " ".join((raw.get(CSV_TOPIC_COLUMN) or "").split())
+    return row, None
+
+def import_questions_csv(f, on_progress=None) -> Dict:
+    """
+    Import in streaming: legge il CSV riga per riga, valida e invia a blocchi
+    di IMPORT_CHUNK_SIZE con retry per blocco. La memoria resta costante
+    (a parte gli hash già visti nel file).
+    I doppioni (nel file o già in banca con la stessa spiegazione) vengono scartati
+    in locale tramite l'indice hash, senza chiamate di rete; le righe note con
+    spiegazione o argomento diversi diventano aggiornamenti, accodati in
+    question_bank_staging (per content_hash) invece di modificare la riga pubblicata.
+    Gli argomenti nuovi della colonna opzionale `topic` si creano al primo incontro.
+    Alla fine le righe scritte si pubblicano insieme come nuova versione della banca dati:
+    fino ad allora sorteggi e cache continuano a usare la versione precedente.
+    on_progress(frazione, riepilogo) viene chiamata dopo ogni blocco.
+    """
+    summary = {
+        "encoding": None,
+        "new": 0,
+        "updated": 0,
+        "duplicates": 0,
+        "rejected": 0,
+        "skipped": 0,
+        "rejects": [],
+        "errors": [],
+        "error": None,
+        "version": None,
+    }
+
+    f.seek(0, io.SEEK_END)
+    size = max(1, f.tell())
+    enc = detect_csv_encoding(f)
+    summary["encoding"] = enc
+
+    idx = get_bank_index()
+    idx.ensure_fresh()
+    seen: set = set()
+    topic_ids = {name: tid for tid, name in idx.topics.items()}
+    chunk: List[Dict] = []   # domande nuove
+    staged: List[Dict] = []  # domande note con spiegazione o argomento cambiati
+
+    def _flush():
+        if not chunk and not staged:
+            return
+        for attempt in range(IMPORT_RETRIES):
+            try:
+                if chunk:
+                    upsert_bank_rows(chunk)
+                if staged:
+                    stage_bank_updates(staged)
+                summary["new"] += len(chunk)
+                summary["updated"] += len(staged)
+                break
+            except Exception as e:
+                if attempt < IMPORT_RETRIES - 1:
+                    time.sleep(0.5 * (attempt + 1))
+                else:
+                    n = len(chunk) + len(staged)
+                    summary["skipped"] += n
+                    summary["errors"].append(f"Blocco di {n} righe non inserito: {e}")
+        chunk.clear()
+        staged.clear()
+        if on_progress:
+            on_progress(min(f.tell() / size, 1.0), summary)
+
+    text = io.TextIOWrapper(f, encoding=enc, newline="")
+    try:
+        reader = csv.DictReader(text)
+        reader.fieldnames = [(h or "").strip() for h in (reader.fieldnames or [])]
+        miss = [c for c in CSV_REQUIRED_COLUMNS if c not in reader.fieldnames]
+        if miss:
+            summary["error"] = f"Mancano colonne: {miss}"
+            return summary
+
+        # riga 1 = intestazione
+        for line_no, raw in enumerate(reader, start=2):
+            row, reason = validate_csv_row(raw)
+            if row is not None and CSV_TOPIC_COLUMN in row:
+                name = row.pop(CSV_TOPIC_COLUMN)
+                if name and name not in topic_ids:
+                    try:
+                        created = upsert_topics([name])
+                        idx.add_topics(created)
+                        topic_ids.update(created)
+                    except Exception as e:
+                        row, reason = None, f"argomento '{name}' non creato: {e}"
+                if row is not None:
+                    row["topic_id"] = topic_ids.get(name)
+            if row is not None:
+                h = row["content_hash"]
+                # prima occorrenza nel file vince: le copie successive si scartano
+                # anche se differiscono da quella in banca dati (niente alternanza tra copie)
+                if h in seen:
+                    summary["duplicates"] += 1
+                    continue
+                seen.add(h)
+                known = idx.find_hash(h)
+                unchanged = known is not None and (
+                    known["explanation"] == row["explanation"] and known["topic"] == row.get("topic_id", known["topic"])
+                )
+                if unchanged:
+                    summary["duplicates"] += 1
+                    continue
+                if known is not None:
+                    # la riga pubblicata non cambia fino a publish_bank_version
+                    row.setdefault("topic_id", known["topic"])
+                    staged.append(row)
+                else:
+                    chunk.append(row)
+                if len(chunk) + len(staged) >= IMPORT_CHUNK_SIZE:
+                    _flush()
+            elif reason is None:
+                summary["skipped"] += 1
+            else:
+                summary["rejected"] += 1
+                if len(summary["rejects"]) < IMPORT_MAX_REPORTED_REJECTS:
+                    summary["rejects"].append(
+                        {"riga": line_no, "motivo": reason, "question_text": (raw.get("question_text") or "")[:120]}
+                    )
+        _flush()
+    except (csv.Error, UnicodeDecodeError) as e:
+        summary["error"] = f"Impossibile leggere il CSV ({e}). Salvalo come UTF-8."
+    finally:
+        # stacca il wrapper senza chiudere il file caricato
+        text.detach()
+
+    if summary["new"] or summary["updated"]:
+        try:
+            summary["version"] = publish_bank_version()
+            idx.refresh()
+        except Exception as e:
+            summary["errors"].append(f"Nuova versione della banca dati non pubblicata: {e}")
+
+    return summary
+
+# =========================================================
+# STATISTICHE DOMANDE (SCHEDA DOCENTE)
+# =========================================================
+STATS_CACHE_TTL_SECONDS = 60
+STATS_MIN_SERVED = 5      # sotto questa soglia difficoltà e discriminazione dicono poco
+STATS_TABLE_ROWS = 100    # righe mostrate (il testo si legge solo per queste)
+
+@st.cache_data(ttl=STATS_CACHE_TTL_SECONDS, show_spinner=False)
+def load_question_stats() -> List[Dict]:
+    return fetch_question_stats()
+
+def question_stats_table(stats: List[Dict], topic_id: int | None = None, min_served: int = STATS_MIN_SERVED) -> List[Dict]:
+    """
+    Righe della tabella docente dagli aggregati per domanda, dalla più sbagliata:
+    % corrette (difficoltà), discriminazione (resto della prova di chi risponde giusto
+    meno quello di chi sbaglia) e distribuzione delle risposte date.
+    """
+    idx = get_bank_index()
+    idx.ensure_fresh()
+    picked = []
+    for r in stats:
+        entry = idx.entries.get(int(r["question_id"]))
+        served, correct = int(r["served"]), int(r["correct"])
+        if entry is None or served < min_served:
+            continue
+        if topic_id is not None and entry["topic"] != topic_id:
+            continue
+        wrong = served - correct
+        disc = (
+            r["rest_sum_correct"] / correct - r["rest_sum_wrong"] / wrong
+            if correct and wrong else None
+        )
+        picked.append((correct / served, -served, r, entry, disc))
+    picked.sort(key=lambda x: (x[0], x[1]))
+    picked = picked[:STATS_TABLE_ROWS]
+
+    texts = get_question_texts().get_many([int(p[2]["question_id"]) for p in picked])
+    out = []
+    for p_correct, _, r, entry, disc in picked:
+        qid = int(r["question_id"])
+        answered = int(r["answered"]) or 1
+        text = texts.get(qid, {}).get("question_text", "")
+        out.append(
+            {
+                "id": qid,
+                "domanda": text if len(text) <= 90 else text[:87] + "…",
+                "argomento": idx.topics.get(entry["topic"], "—") if entry["topic"] is not None else "—",
+                "proposta": int(r["served"]),
+                "% corrette": round(100 * p_correct, 1),
+                "% senza risposta": round(100 * (1 - int(r["answered"]) / int(r["served"])), 1),
+                "discriminazione": round(disc, 2) if disc is not None else None,
+                "esatta": entry["correct"],
+                "risposte date": " · ".join(
+                    f"{k} {round(100 * int(r[f'chosen_{k.lower()}']) / answered)}%"
+                    for k in "ABCD"[: entry["n_options"]]
+                ),
+            }
+        )
+    return out
 
 # =========================================================
 # SESSION STATE
@@ -388,6 +1378,29 @@ def ss_init():
         "n_questions": N_QUESTIONS_DEFAULT,
         # NUOVO: pagina menu dopo login
         "menu_page": "home",   # home | sim | bank | case
+        # buffer risposte non ancora salvate: {quiz_answers.id: lettera | None}
+        "pending_answers": {},
+        "answers_flushed_ts": 0.0,
+        "answers_flush_error": None,
+        # esame nel browser: ultimo invio ricevuto e ultimo invio salvato sul DB
+        "exam_seq": 0,
+        "exam_saved_seq": 0,
+        "exam_submitted": False,
+        # domande della sessione caricate una sola volta (vedi load_session_rows)
+        "session_rows": None,
+        "session_rows_id": None,
+        # riepilogo salvato dalla correzione (score, answered, n_questions, ...)
+        "session_summary": None,
+        # ripristino della simulazione dal DB già tentato in questa sessione browser
+        "restore_checked": False,
+        # visualizzazione simulazione
+        "sim_layout": "exam",
+        "sim_page_size": SIM_PAGE_SIZES[0],
+        "sim_page": 0,
+        # lettore PDF integrato (banca dati)
+        "bank_doc": STUDY_DOCS[0]["id"],
+        "bank_page": 1,
+        "bank_view": "Pagina",
     }
     for k, v in defaults.items():
         if k not in st.session_state:
@@ -395,6 +1408,298 @@ def ss_init():
 
 ss_init()
 
+# =========================================================
+# STATO SIMULAZIONE (PERSISTITO SU sessions)
+# =========================================================
+# La riga sessions è la fonte di verità (status, started_at, duration_seconds):
+# st.session_state ne è solo una copia. L'id della sessione viaggia nell'URL (?sid=...),
+# così dopo un refresh, una riconnessione o un cambio di replica lo studente
+# riprende la simulazione da dove era, con la scadenza calcolata da started_at.
+def _parse_ts(value: str) -> float:
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+def apply_session_state(sess: Dict):
+    st.session_state["session_id"] = sess["id"]
+    st.session_state["started_ts"] = _parse_ts(sess["started_at"])
+    st.session_state["duration_seconds"] = int(sess.get("duration_seconds") or DURATION_SECONDS_DEFAULT)
+    finished = sess.get("status", "in_progress") != "in_progress"
+    st.session_state["in_progress"] = not finished
+    st.session_state["show_results"] = finished
+    st.session_state["finished_ts"] = _parse_ts(sess["finished_at"]) if sess.get("finished_at") else None
+    if sess.get("score") is not None:
+        st.session_state["session_summary"] = sess
+    st.session_state["menu_page"] = "sim"
+    st.query_params["sid"] = str(sess["id"])
+
+def reset_sim_state():
+    reset_answer_buffer()
+    clear_session_rows()
+    st.session_state["session_id"] = None
+    st.session_state["in_progress"] = False
+    st.session_state["show_results"] = False
+    st.session_state["started_ts"] = None
+    st.session_state["finished_ts"] = None
+    st.session_state["duration_seconds"] = DURATION_SECONDS_DEFAULT
+    st.session_state["menu_page"] = "home"
+    if "sid" in st.query_params:
+        del st.query_params["sid"]
+
+def restore_simulation():
+    """
+    Una sola volta per sessione browser, dopo il login: riprende la simulazione
+    dell'URL (?sid=...) se è dello stesso studente, altrimenti l'ultima sessione
+    non chiusa dello studente. Il ?sid da solo non autentica: su un PC condiviso
+    l'URL resta nella cronologia. Senza login non fa chiamate al DB.
+    """
+    if st.session_state["restore_checked"] or st.session_state["session_id"]:
+        return
+    if not st.session_state["logged"]:
+        return
+    st.session_state["restore_checked"] = True
+
+    student_id = st.session_state["student"]["id"]
+    sid = st.query_params.get("sid")
+    sess = fetch_session(sid) if sid else None
+    if sess and sess["student_id"] != student_id:
+        sess = None
+    if sess is None:
+        sess = fetch_open_session(student_id)
+
+    if sess and sess.get("status") in ("in_progress", "finished"):
+        apply_session_state(sess)
+    elif "sid" in st.query_params:
+        del st.query_params["sid"]
+
+# =========================================================
+# DOMANDE DELLA SESSIONE (CARICATE UNA VOLTA)
+# =========================================================
+SESSION_ROW_FIELDS = ["question_text", "option_a", "option_b", "option_c", "option_d", "explanation"]
+
+def compact_session_rows(rows: List[Dict]) -> List[Dict]:
+    """
+    Solo i campi usati da quiz e correzione. Il contenuto delle domande viene da
+    QuestionTexts (stessi oggetti stringa per tutte le sessioni del processo);
+    le righe vecchie senza question_id usano la propria copia del testo.
+    """
+    texts = get_question_texts().get_many([r["question_id"] for r in rows if r.get("question_id") is not None])
+    out = []
+    for r in sorted(rows, key=lambda x: (x.get("position") or 0, int(x["id"]))):
+        qid = int(r["question_id"]) if r.get("question_id") is not None else None
+        item = {"id": int(r["id"]), "question_id": qid}
+        content = texts.get(qid) if qid is not None else None
+        for f in SESSION_ROW_FIELDS:
+            item[f] = content[f] if content else (r.get(f) or "")
+        # lettere già canoniche: correct_option da question_bank, chosen_option scritta dall'app
+        item["correct_option"] = r["correct_option"]
+        item["chosen_option"] = r["chosen_option"]
+        out.append(item)
+    return out
+
+def set_session_rows(session_id: str, rows: List[Dict]):
+    st.session_state["session_rows"] = compact_session_rows(rows)
+    st.session_state["session_rows_id"] = session_id
+
+def clear_session_rows():
+    st.session_state["session_rows"] = None
+    st.session_state["session_rows_id"] = None
+    st.session_state["session_summary"] = None
+
+def load_session_rows(session_id: str) -> List[Dict]:
+    """
+    Domande della sessione tenute in session_state: il DB viene letto solo se
+    la struttura locale manca (es. sessione ripresa), non a ogni rerun.
+    """
+    if st.session_state["session_rows"] is None or st.session_state["session_rows_id"] != session_id:
+        set_session_rows(session_id, fetch_session_questions(session_id))
+    return st.session_state["session_rows"]
+
+# =========================================================
+# NAVIGAZIONE SIMULAZIONE (MODALITÀ A PAGINE)
+# =========================================================
+def go_to_question(pos: int):
+    # pos = indice 0-based della domanda; callback dei bottoni (niente rerun extra)
+    st.session_state["sim_page"] = pos // int(st.session_state["sim_page_size"])
+
+def go_to_page(page: int):
+    st.session_state["sim_page"] = max(0, page)
+
+def on_page_size_change():
+    st.session_state["sim_page"] = 0
+
+# =========================================================
+# BUFFER RISPOSTE (WRITE-BEHIND)
+# =========================================================
+ANSWER_FLUSH_MAX_PENDING = 10   # salva quando ci sono almeno N risposte in attesa...
+ANSWER_FLUSH_SECONDS = 20       # ...oppure quando l'ultimo salvataggio è più vecchio di N secondi
+ANSWER_FLUSH_RETRIES = 3
+ANSWER_LATE_GRACE_SECONDS = 5   # un clic arrivato oltre la scadenza (+ questo margine) non vale
+
+def session_end_ts() -> float:
+    return float(st.session_state["started_ts"]) + int(st.session_state["duration_seconds"])
+
+def reset_answer_buffer():
+    st.session_state["pending_answers"] = {}
+    st.session_state["answers_flushed_ts"] = time.time()
+    st.session_state["answers_flush_error"] = None
+    st.session_state["exam_seq"] = 0
+    st.session_state["exam_saved_seq"] = 0
+    st.session_state["exam_submitted"] = False
+
+def on_answer_change(row_id: int):
+    # callback del radio: gira prima del rerun, quindi il buffer è già aggiornato
+    if time.time() > session_end_ts() + ANSWER_LATE_GRACE_SECONDS:
+        return  # tempo scaduto: la risposta non entra nel buffer e non viene salvata
+    val = st.session_state.get(f"q_{row_id}")
+    st.session_state["pending_answers"][int(row_id)] = None if val in (None, "—") else val
+
+def flush_answers(force: bool = False) -> bool:
+    """
+    Scrive il buffer su quiz_answers. Senza force salva solo oltre le soglie.
+    Ritorna False se dopo i tentativi restano risposte non salvate.
+    """
+    pending = st.session_state["pending_answers"]
+    if not pending:
+        return True
+
+    if not force:
+        age = time.time() - float(st.session_state["answers_flushed_ts"] or 0)
+        if len(pending) < ANSWER_FLUSH_MAX_PENDING and age < ANSWER_FLUSH_SECONDS:
+            return True
+
+    batch = dict(pending)
+    for attempt in range(ANSWER_FLUSH_RETRIES):
+        try:
+            if not save_answers(st.session_state["session_id"], batch):
+                # sessione già corretta o scaduta: il DB non accetta più risposte,
+                # riprovare non serve e il punteggio resta quello registrato
+                pending.clear()
+                st.session_state["answers_flush_error"] = "sessione chiusa: risposte non salvate"
+                return True
+            break
+        except Exception as e:
+            st.session_state["answers_flush_error"] = str(e)
+            if attempt < ANSWER_FLUSH_RETRIES - 1:
+                time.sleep(0.3 * (attempt + 1))
+    else:
+        return False
+
+    # rimuove solo ciò che è stato salvato (una modifica successiva resta in coda)
+    for row_id, letter in batch.items():
+        if pending.get(row_id, "__none__") == letter:
+            pending.pop(row_id)
+
+    # allinea la copia locale delle domande con quanto ora è sul DB
+    for row in st.session_state["session_rows"] or []:
+        if row["id"] in batch:
+            row["chosen_option"] = batch[row["id"]]
+    st.session_state["answers_flushed_ts"] = time.time()
+    st.session_state["answers_flush_error"] = None
+    return True
+
+# =========================================================
+# ESAME NEL BROWSER (COMPONENTE BIDIREZIONALE)
+# =========================================================
+# Risposte e navigazione restano nel browser (components/exam_runner/index.html):
+# il server riceve solo i checkpoint periodici, il "Termina", la scadenza e il cambio
+# di visualizzazione (fatto dal componente, così nessuna risposta resta solo nel browser).
+EXAM_CHECKPOINT_SECONDS = 60
+EXAM_LATE_GRACE_SECONDS = 10  # ritardo massimo accettato per un invio oltre la scadenza
+
+_exam_runner = components.declare_component(
+    "exam_runner", path=str(Path(__file__).parent / "components" / "exam_runner")
+)
+
+def exam_key(session_id: str) -> str:
+    return f"exam_{session_id}"
+
+def receive_exam_message(session_id: str, rows: List[Dict], end_ts: float) -> Dict | None:
+    """
+    Legge l'ultimo invio del componente (dal session_state, prima di disegnarlo)
+    e mette nel buffer le risposte cambiate. Ritorna l'invio se è nuovo
+    (kind: checkpoint | submit | timeout | layout), altrimenti None.
+    La scadenza è quella del server: un invio arrivato oltre end_ts + EXAM_LATE_GRACE_SECONDS
+    (orologio del browser indietro o modificato) non porta risposte e chiude la prova.
+    """
+    msg = st.session_state.get(exam_key(session_id))
+    if not isinstance(msg, dict) or int(msg.get("seq") or 0) <= st.session_state["exam_seq"]:
+        return None
+    st.session_state["exam_seq"] = int(msg["seq"])
+    if time.time() > end_ts + EXAM_LATE_GRACE_SECONDS:
+        return {"kind": "timeout"}
+
+    pending = st.session_state["pending_answers"]
+    by_id = {int(r["id"]): r for r in rows}
+    for key, letter in (msg.get("answers") or {}).items():
+        row = by_id.get(int(key))
+        if row is None:
+            continue
+        if letter not in ["A", "B", "C", "D"] or not row[f"option_{letter.lower()}"]:
+            letter = None
+        if pending.get(row["id"], row["chosen_option"]) != letter:
+            pending[row["id"]] = letter
+    return msg
+
+def render_exam_runner(session_id: str, rows: List[Dict], end_ts: float):
+    pending = st.session_state["pending_answers"]
+    if not pending:
+        st.session_state["exam_saved_seq"] = st.session_state["exam_seq"]
+    _exam_runner(
+        session_id=session_id,
+        questions=[
+            {
+                "id": r["id"],
+                "text": r["question_text"],
+                "options": {k: r[f"option_{k.lower()}"] for k in ["A", "B", "C", "D"]},
+            }
+            for r in rows
+        ],
+        answers={str(r["id"]): pending.get(r["id"], r["chosen_option"]) for r in rows},
+        # tempo residuo secondo il server: il browser lo conta dal proprio orologio senza dipendere dall'ora
+        remaining_ms=max(0, int((end_ts - time.time()) * 1000)),
+        layouts={k: v for k, v in SIM_LAYOUTS.items() if k != "exam"},
+        checkpoint_seconds=EXAM_CHECKPOINT_SECONDS,
+        seq=st.session_state["exam_seq"],
+        saved_seq=st.session_state["exam_saved_seq"],
+        key=exam_key(session_id),
+        default=None,
+    )
+
+# =========================================================
+# MATERIALI DI STUDIO (RICERCA NEI PDF)
+# =========================================================
+# Indice generato offline con `python study_pdf.py` oppure, se manca, costruito dal processo
+# alla prima ricerca (in background, dai PDF in .cache/study) e poi tenuto in memoria.
+STUDY_SEARCH_LIMIT = 8
+
+@st.cache_resource(show_spinner=False)
+def get_study_index() -> LazyStudyIndex:
+    return LazyStudyIndex(STUDY_INDEX_PATH)
+
+
+@st.cache_resource(show_spinner=False)
+def get_page_renderer() -> PageRenderer:
+    return PageRenderer()
+
+
+def open_in_reader(doc_id: str, page: int):
+    st.session_state["bank_doc"] = doc_id
+    st.session_state["bank_page"] = page
+
+
+def on_reader_doc_change():
+    st.session_state["bank_page"] = 1
+
+
+def move_reader_page(delta: int, total: int):
+    st.session_state["bank_page"] = min(max(1, st.session_state["bank_page"] + delta), total)
+
+
+def md_escape(text: str) -> str:
+    # il testo dei PDF contiene * _ $ ecc. che st.markdown interpreterebbe
+    for ch in "\\`*_{}[]<>()#+-.!|$~":
+        text = text.replace(ch, "\\" + ch)
+    return text
+
 # =========================================================
 # HEADER
 # =========================================================
@@ -420,24 +1725,48 @@ def render_header(total_questions: int):
 # =========================================================
 # APP
 # =========================================================
-bank_count = fetch_bank_count()
-# render_header(bank_count)
+start_deadline_sweeper()
+# render_header(get_bank_index().count())
 # ===============================
 # HERO / LANDING PAGE (NUOVO)
 # ===============================
-def _img_to_base64(path: Path) -> str:
-    return base64.b64encode(path.read_bytes()).decode()
-
-_bg_path = Path("assets/bg.png")
-if _bg_path.exists():
-    _bg_b64 = _img_to_base64(_bg_path)
-
+APP_DIR = Path(__file__).parent
+BG_SOURCE = APP_DIR / "assets" / "bg.png"
+BG_STATIC = APP_DIR / "static" / "bg.webp"   # servita da Streamlit come app/static/bg.webp
+BG_MAX_WIDTH = 1600
+BG_WEBP_QUALITY = 70
+
+@st.cache_resource(show_spinner=False)
+def background_url() -> str | None:
+    """
+    Una volta per processo: rigenera static/bg.webp (ridimensionata e compressa)
+    se manca o è più vecchia di assets/bg.png. Il browser la scarica una volta
+    e la tiene in cache: nessun base64 nella pagina a ogni rerun.
+    """
+    stale = not BG_STATIC.exists() or (
+        BG_SOURCE.exists() and BG_SOURCE.stat().st_mtime > BG_STATIC.stat().st_mtime
+    )
+    if stale and BG_SOURCE.exists():
+        try:
+            from PIL import Image
+
+            im = Image.open(BG_SOURCE).convert("RGB")
+            if im.width > BG_MAX_WIDTH:
+                im = im.resize((BG_MAX_WIDTH, round(im.height * BG_MAX_WIDTH / im.width)))
+            BG_STATIC.parent.mkdir(exist_ok=True)
+            im.save(BG_STATIC, "WEBP", quality=BG_WEBP_QUALITY, method=6)
+        except Exception:
+            pass  # file system in sola lettura o Pillow assente: si usa la versione già presente
+    return f"app/static/{BG_STATIC.name}" if BG_STATIC.exists() else None
+
+_bg_url = background_url()
+if _bg_url:
     st.markdown(
         f"""
         <style>
         /* background image */
         .stApp {{
-            background: url("data:image/png;base64,{{_bg_b64}}") no-repeat center center fixed;
+            background: url("{_bg_url}") no-repeat center center fixed;
             background-size: cover;
         }}
         /* overlay per leggibilità */
@@ -509,76 +1838,168 @@ st.markdown(
 )
 
 tab_stud, tab_doc = st.tabs(["🎓 Corsista", "🧑‍🏫 Docente (upload CSV)"])
+# costo fisso di ogni rerun prima delle pagine (stili, client, sfondo, hero): nessuna chiamata DB
+get_metrics().observe("page.prologue", time.perf_counter() - RERUN_T0)
 
 # =========================================================
 # DOCENTE
 # =========================================================
 with tab_doc:
     st.subheader("Carica banca dati (CSV)")
-    st.write("CSV richiesto: `question_text, option_a, option_b, option_c, option_d, correct_option` (+ opzionale `explanation`).")
-    st.write("Nota: `option_d` può essere vuota. Se è vuota, la D non comparirà nel quiz.")
+    st.write("CSV richiesto: `question_text, option_a, option_b, option_c, option_d, correct_option` (+ opzionali `explanation`, `topic`).")
+    st.write(
+        "Nota: `option_a` e `option_b` sono obbligatorie; `option_c` e `option_d` possono essere vuote "
+        "(la D solo se c'è la C) e non compariranno nel quiz. `correct_option` deve indicare un'opzione "
+        "presente: le righe non valide vengono scartate ed elencate dopo il caricamento."
+    )
 
     admin = st.text_input("Codice docente", type="password")
     up = st.file_uploader("Carica CSV", type=["csv"])
 
     st.divider()
-    st.write("Domande in banca dati:", fetch_bank_count())
+    # il conteggio (chiamata DB) solo per il docente: la scheda viene eseguita a ogni rerun
+    count_slot = st.empty()
+    if admin == ADMIN_CODE:
+        count_slot.write(f"Domande in banca dati: {get_bank_index().count()}")
 
     if up and admin == ADMIN_CODE:
-        import pandas as pd
-        import io
-
-        raw = up.getvalue()
-        df = None
-        for enc in ("utf-8-sig", "utf-8", "latin1"):
-            try:
-                df = pd.read_csv(io.BytesIO(raw), encoding=enc)
-                break
-            except Exception:
-                df = None
-
-        if df is None:
-            st.error("Impossibile leggere il CSV. Salvalo come UTF-8.")
-            st.stop()
-
-        required = ["question_text", "option_a", "option_b", "option_c", "option_d", "correct_option"]
-        miss = [c for c in required if c not in df.columns]
-        if miss:
-            st.error(f"Mancano colonne: {miss}")
-            st.stop()
-
-        if "explanation" not in df.columns:
-            df["explanation"] = ""
-
-        df = df.fillna("")
-        df["correct_option"] = df["correct_option"].astype(str).str.strip().str.upper()
-        df["option_d"] = df["option_d"].astype(str).fillna("").str.strip()
+        # import solo su richiesta esplicita: un rerun non reimporta lo stesso file
+        if st.button("📥 Importa domande"):
+            bar = st.progress(0.0, text="Import in corso…")
+
+            def _progress(frac: float, s: Dict):
+                bar.progress(
+                    frac,
+                    text=(
+                        f"Import in corso… nuove {s['new']} • aggiornate {s['updated']} • "
+                        f"doppioni {s['duplicates']} • scartate {s['rejected']} • saltate {s['skipped']}"
+                    ),
+                )
 
-        bad = ~df["correct_option"].isin(["A", "B", "C", "D"])
-        if bad.any():
-            st.error("Trovate righe con correct_option non valido (deve essere A/B/C/D).")
-            st.dataframe(df.loc[bad, ["question_text", "correct_option"]].head(10))
-            st.stop()
+            summary = import_questions_csv(up, on_progress=_progress)
+            bar.progress(1.0, text="Import terminato")
 
-        bad_d = (df["option_d"] == "") & (df["correct_option"] == "D")
-        if bad_d.any():
-            st.error("Righe con correct_option = D ma option_d vuota. Correggi il CSV.")
-            st.dataframe(df.loc[bad_d, ["question_text", "option_d", "correct_option"]].head(20))
-            st.stop()
-
-        rows = df[required + ["explanation"]].to_dict(orient="records")
+            if summary["error"]:
+                st.error(summary["error"])
+            else:
+                st.success(
+                    f"Import completato ✅ Nuove **{summary['new']}** • aggiornate **{summary['updated']}** • "
+                    f"doppioni **{summary['duplicates']}** • scartate **{summary['rejected']}** • "
+                    f"saltate **{summary['skipped']}** "
+                    f"(codifica {summary['encoding']})"
+                )
+                if summary["version"]:
+                    st.caption(f"Banca dati pubblicata come versione {summary['version']}.")
+                if summary["rejects"]:
+                    st.warning(f"Righe scartate (prime {len(summary['rejects'])}): correggi il CSV e ricaricale.")
+                    st.dataframe(summary["rejects"])
+                for err in summary["errors"]:
+                    st.error(err)
 
-        try:
-            sb.table("question_bank").insert(rows).execute()
-            st.success(f"Caricate {len(rows)} domande ✅")
-            st.rerun()
-        except Exception as e:
-            st.error("Errore inserimento in question_bank.")
-            st.exception(e)
+            count_slot.write(f"Domande in banca dati: {get_bank_index().count()}")
 
     elif up and admin != ADMIN_CODE:
         st.warning("Codice docente errato.")
 
+    if admin == ADMIN_CODE:
+        with st.expander("🗂️ Prepara esame (fogli pronti per l'inizio lezione)"):
+            st.caption(
+                "Genera in anticipo i fogli d'esame (domande già sorteggiate, senza ripetizioni tra fogli "
+                "finché la banca dati lo consente): all'avvio ogni studente prende un foglio libero, "
+                "così anche se tutta la classe inizia insieme l'avvio resta immediato. "
+                "Finiti i fogli si torna al sorteggio normale."
+            )
+            papers_slot = st.empty()
+            papers_slot.write(f"Fogli pronti non ancora usati: **{count_unclaimed_papers()}**")
+
+            paper_topics = get_bank_index().topic_counts()
+            paper_topic_names = {t: f"{name} ({count} domande)" for t, name, count in paper_topics}
+            cP1, cP2 = st.columns(2)
+            with cP1:
+                n_papers = st.number_input("Numero di fogli", min_value=1, max_value=500, value=60, step=10)
+            with cP2:
+                paper_topic = st.selectbox(
+                    "Argomento",
+                    options=[None] + list(paper_topic_names),
+                    format_func=lambda t: "Tutta la banca dati" if t is None else paper_topic_names[t],
+                    key="paper_topic",
+                )
+            paper_balanced = False
+            if paper_topic is None and paper_topics:
+                paper_balanced = st.checkbox("Stesso numero di domande per ogni argomento", key="paper_balanced")
+            st.caption("I fogli valgono per la stessa scelta fatta dallo studente (argomento e bilanciamento).")
+
+            cG1, cG2 = st.columns(2)
+            with cG1:
+                if st.button("Genera fogli"):
+                    sizes = {t: count for t, _, count in paper_topics}
+                    n_paper_questions = min(N_QUESTIONS_DEFAULT, sizes[paper_topic]) if paper_topic is not None else N_QUESTIONS_DEFAULT
+                    try:
+                        created = prepare_exam_papers(int(n_papers), n_paper_questions, paper_topic, paper_balanced)
+                        st.success(f"Creati {created} fogli da {n_paper_questions} domande.")
+                        papers_slot.write(f"Fogli pronti non ancora usati: **{count_unclaimed_papers()}**")
+                    except Exception as e:
+                        st.error(f"Fogli non creati: {e}")
+            with cG2:
+                if st.button("Elimina fogli non usati"):
+                    delete_unclaimed_papers()
+                    st.rerun()
+
+        with st.expander("📈 Statistiche domande"):
+            st.caption(
+                "Aggiornate a ogni simulazione corretta. In cima le domande più sbagliate; "
+                "discriminazione bassa o negativa = chi va bene nel resto della prova sbaglia "
+                f"proprio questa (testo o risposta da ricontrollare). Solo domande proposte almeno "
+                f"{STATS_MIN_SERVED} volte; dati aggiornati ogni {STATS_CACHE_TTL_SECONDS} s."
+            )
+            stats = load_question_stats()
+            if not stats:
+                st.info("Nessuna simulazione corretta finora.")
+            else:
+                stats_topics = {t: name for t, name, _ in get_bank_index().topic_counts()}
+                stats_topic = st.selectbox(
+                    "Argomento",
+                    options=[None] + list(stats_topics),
+                    format_func=lambda t: "Tutta la banca dati" if t is None else stats_topics[t],
+                    key="stats_topic",
+                )
+                served_total = sum(int(r["served"]) for r in stats)
+                correct_total = sum(int(r["correct"]) for r in stats)
+                cS1, cS2, cS3 = st.columns(3)
+                cS1.metric("Domande proposte almeno una volta", len(stats))
+                cS2.metric("Risposte registrate", served_total)
+                cS3.metric("Corrette in media", f"{100 * correct_total / max(served_total, 1):.1f}%")
+                table = question_stats_table(stats, stats_topic)
+                if table:
+                    st.dataframe(table, use_container_width=True, hide_index=True)
+                else:
+                    st.caption("Nessuna domanda con abbastanza risposte per questo argomento.")
+            if st.button("Aggiorna statistiche"):
+                load_question_stats.clear()
+                st.rerun()
+
+        with st.expander("📊 Metriche prestazioni (solo docente)"):
+            metrics = get_metrics()
+            st.caption(
+                f"Questo processo, da {int((time.time() - metrics.started_ts) // 60)} min. "
+                "db.* = chiamate Supabase, page.* = rami della pagina corsista "
+                "(page.prologue = parte comune a ogni rerun, prima della pagina). "
+                "I percentili sono stimati dai bucket dell'istogramma."
+            )
+            st.dataframe(metrics.snapshot(), use_container_width=True)
+            cM1, cM2 = st.columns(2)
+            with cM1:
+                st.download_button(
+                    "⬇️ Esporta (formato Prometheus)",
+                    metrics.prometheus_text(),
+                    file_name="quiz_metrics.prom",
+                    mime="text/plain",
+                )
+            with cM2:
+                if st.button("Azzera metriche"):
+                    metrics.reset()
+                    st.rerun()
+
 # =========================================================
 # CORSISTA
 # =========================================================
@@ -623,26 +2044,29 @@ div[data-testid="stVerticalBlock"] > div {
 
     st.subheader("Accesso corsista")
 
+    restore_simulation()
+
     # ---------- LOGIN ----------
     if not st.session_state["logged"]:
-        st.markdown('<div class="login-wrapper">', unsafe_allow_html=True)
-
-        full_name = st.text_input("Nome e Cognome (es. Mario Rossi)")
-        course_pass = st.text_input("Password corso", type="password")
-
-        if st.button("Entra", use_container_width=True):
-            if not full_name or not course_pass:
-                st.error("Inserisci Nome e Cognome + Password.")
-            elif course_pass != COURSE_PASSWORD:
-                st.error("Password errata.")
-            else:
-                st.session_state["student"] = upsert_student(COURSE_CLASS_CODE, full_name)
-                st.session_state["logged"] = True
-                st.session_state["menu_page"] = "home"
-                st.rerun()
-
-        st.markdown('</div>', unsafe_allow_html=True)
-        st.stop()
+        with page_timer("login"):
+            st.markdown('<div class="login-wrapper">', unsafe_allow_html=True)
+
+            full_name = st.text_input("Nome e Cognome (es. Mario Rossi)")
+            course_pass = st.text_input("Password corso", type="password")
+
+            if st.button("Entra", use_container_width=True):
+                if not full_name or not course_pass:
+                    st.error("Inserisci Nome e Cognome + Password.")
+                elif course_pass != COURSE_PASSWORD:
+                    st.error("Password errata.")
+                else:
+                    st.session_state["student"] = upsert_student(COURSE_CLASS_CODE, full_name)
+                    st.session_state["logged"] = True
+                    st.session_state["menu_page"] = "home"
+                    st.rerun()
+
+            st.markdown('</div>', unsafe_allow_html=True)
+            st.stop()
 
     # ---------- PROFILO ----------
     student = st.session_state["student"]
@@ -656,356 +2080,539 @@ div[data-testid="stVerticalBlock"] > div {
 
     with col2:
         if st.button("Logout"):
+            # la simulazione in corso resta aperta sul DB e riprende al prossimo login
+            if st.session_state["in_progress"]:
+                flush_answers(force=True)
+            reset_sim_state()
             st.session_state["logged"] = False
             st.session_state["student"] = None
-            st.session_state["session_id"] = None
-            st.session_state["in_progress"] = False
-            st.session_state["show_results"] = False
-            st.session_state["started_ts"] = None
-            st.session_state["finished_ts"] = None
-            st.session_state["duration_seconds"] = DURATION_SECONDS_DEFAULT
-            st.session_state["menu_page"] = "home"
+            st.session_state["restore_checked"] = False
             st.rerun()
 
-    bank_count = fetch_bank_count()
-    st.write(f"📚 Domande in banca dati: **{bank_count}**")
     st.divider()
 
     # =========================================================
     # MENU DOPO LOGIN (NUOVO)
     # =========================================================
     if (not st.session_state["in_progress"]) and (not st.session_state["show_results"]) and st.session_state["menu_page"] == "home":
-        st.markdown("## Seleziona modalità")
-        st.caption("Scegli cosa vuoi fare oggi. La simulazione ha il timer; banca dati e caso pratico per ora sono in modalità base.")
-
-        # layout a 3 card
-        st.markdown('<div class="menu-grid">', unsafe_allow_html=True)
-
-        st.markdown(
-            """
-            <div class="menu-card">
-              <div class="menu-chip">⏱️ Timer attivo</div>
-              <div class="menu-title">Simulazione Quiz (30 minuti)</div>
-              <div class="menu-desc">
-                30 domande estratte casualmente dalla banca dati. Alla fine vedi punteggio e correzione dettagliata.
-              </div>
-            </div>
-            """,
-            unsafe_allow_html=True,
-        )
-        c1, c2, c3 = st.columns(3)
-        with c1:
-            if st.button("➡️ Vai alla Simulazione"):
-                st.session_state["menu_page"] = "sim"
-                st.rerun()
+        with page_timer("menu"):
+            st.write(f"📚 Domande in banca dati: **{get_bank_index().count()}**")
+            st.markdown("## Seleziona modalità")
+            st.caption("Scegli cosa vuoi fare oggi. La simulazione ha il timer; banca dati e caso pratico per ora sono in modalità base.")
 
-        st.markdown(
-            """
-            <div class="menu-card">
-              <div class="menu-chip">📚 Studio libero</div>
-              <div class="menu-title">Banca dati</div>
-              <div class="menu-desc">
-                Modalità studio: sfoglia le domande e allenati senza timer. (In arrivo: filtri per argomento)
-              </div>
-            </div>
-            """,
-            unsafe_allow_html=True,
-        )
-        with c2:
-            if st.button("➡️ Vai alla Banca dati"):
-                st.session_state["menu_page"] = "bank"
-                st.rerun()
+            # layout a 3 card
+            st.markdown('<div class="menu-grid">', unsafe_allow_html=True)
 
-        st.markdown(
-            """
-            <div class="menu-card">
-              <div class="menu-chip">🧠 Allenamento</div>
-              <div class="menu-title">Caso pratico</div>
-              <div class="menu-desc">
-                Rispondi a uno scenario operativo. (In arrivo: correzione guidata e griglia di valutazione)
-              </div>
-            </div>
-            """,
-            unsafe_allow_html=True,
-        )
-        with c3:
-            if st.button("➡️ Vai al Caso pratico"):
-                st.session_state["menu_page"] = "case"
-                st.rerun()
+            st.markdown(
+                """
+                <div class="menu-card">
+                  <div class="menu-chip">⏱️ Timer attivo</div>
+                  <div class="menu-title">Simulazione Quiz (30 minuti)</div>
+                  <div class="menu-desc">
+                    30 domande estratte casualmente dalla banca dati. Alla fine vedi punteggio e correzione dettagliata.
+                  </div>
+                </div>
+                """,
+                unsafe_allow_html=True,
+            )
+            c1, c2, c3 = st.columns(3)
+            with c1:
+                if st.button("➡️ Vai alla Simulazione"):
+                    st.session_state["menu_page"] = "sim"
+                    st.rerun()
+
+            st.markdown(
+                """
+                <div class="menu-card">
+                  <div class="menu-chip">📚 Studio libero</div>
+                  <div class="menu-title">Banca dati</div>
+                  <div class="menu-desc">
+                    Modalità studio: sfoglia le domande e allenati senza timer. (In arrivo: filtri per argomento)
+                  </div>
+                </div>
+                """,
+                unsafe_allow_html=True,
+            )
+            with c2:
+                if st.button("➡️ Vai alla Banca dati"):
+                    st.session_state["menu_page"] = "bank"
+                    st.rerun()
+
+            st.markdown(
+                """
+                <div class="menu-card">
+                  <div class="menu-chip">🧠 Allenamento</div>
+                  <div class="menu-title">Caso pratico</div>
+                  <div class="menu-desc">
+                    Rispondi a uno scenario operativo. (In arrivo: correzione guidata e griglia di valutazione)
+                  </div>
+                </div>
+                """,
+                unsafe_allow_html=True,
+            )
+            with c3:
+                if st.button("➡️ Vai al Caso pratico"):
+                    st.session_state["menu_page"] = "case"
+                    st.rerun()
 
-        st.markdown("</div>", unsafe_allow_html=True)
-        st.stop()
+            st.markdown("</div>", unsafe_allow_html=True)
+            st.stop()
 
     # =========================================================
     # =========================================================
     # BANCA DATI (PDF materiali di studio) - NO TIMER
     # =========================================================
     if (not st.session_state["in_progress"]) and (not st.session_state["show_results"]) and st.session_state["menu_page"] == "bank":
-        st.markdown("## 📚 Banca dati")
-        st.caption("Materiali di studio consultabili (PDF).")
-
-        # Stato selezione documento
-        if "bank_doc" not in st.session_state:
-            st.session_state["bank_doc"] = None
-
-        # Documenti disponibili
-        docs = [
-            {
-                "title": "LEGGE QUADRO (Legge 7 marzo 1986, n. 65)",
-                "url": "https://sjeztkpspxzxyctfjsyg.supabase.co/storage/v1/object/public/study/legge%20quadro%20completa.pdf",
-            },
-            {
-                "title": "CODICE DELLA STRADA (D.Lgs. 30 aprile 1992, n. 285)",
-                "url": "https://sjeztkpspxzxyctfjsyg.supabase.co/storage/v1/object/public/study/cds%20completo.pdf",
-            },
-        ]
+        with page_timer("bank"):
+            st.markdown("## 📚 Banca dati")
+            st.caption("Materiali di studio consultabili (PDF).")
+
+            docs_by_id = {d["id"]: d for d in STUDY_DOCS}
+
+            # Ricerca full-text (pagina + articolo) con link diretto alla pagina del PDF
+            query = st.text_input(
+                "🔎 Cerca nei materiali",
+                key="bank_query",
+                placeholder="es. art. 186, guida in stato di ebbrezza, fermo amministrativo",
+            ).strip()
+            if query:
+                loader = get_study_index()
+                study_index = loader.get()
+                if study_index is None:
+                    if loader.building or loader.error is None:
+                        st.info("Indice dei PDF in preparazione (solo al primo utilizzo): riprova tra qualche istante.")
+                    else:
+                        st.warning(f"Ricerca non disponibile: indice dei PDF non generato ({loader.error}).")
+                else:
+                    hits = study_index.search(query, limit=STUDY_SEARCH_LIMIT)
+                    if not hits:
+                        st.caption("Nessun risultato.")
+                    for h in hits:
+                        arts = ", ".join(h["articles"][:3])
+                        head = f"**{md_escape(h['title'])}** — pag. {h['page']}" + (f" • Art. {md_escape(arts)}" if arts else "")
+                        with st.container(border=True):
+                            st.markdown(head)
+                            st.caption(md_escape(h["snippet"]))
+                            c1, c2 = st.columns(2)
+                            c1.button(
+                                "📖 Leggi qui",
+                                key=f"read_{h['doc']}_{h['page']}",
+                                on_click=open_in_reader,
+                                args=(h["doc"], h["page"]),
+                                use_container_width=True,
+                            )
+                            c2.link_button(
+                                f"Apri a pagina {h['page']}",
+                                f"{docs_by_id[h['doc']]['url']}#page={h['page']}",
+                                use_container_width=True,
+                            )
+
+            # Lettore integrato: una pagina alla volta, resa lato server e messa in cache
+            st.markdown("### 📖 Lettore")
+            rc1, rc2 = st.columns([3, 1])
+            rc1.selectbox(
+                "Documento",
+                options=list(docs_by_id),
+                format_func=lambda doc_id: docs_by_id[doc_id]["title"],
+                key="bank_doc",
+                on_change=on_reader_doc_change,
+            )
+            rc2.radio("Formato", ["Pagina", "Testo"], key="bank_view", horizontal=True)
 
-                # Lista argomenti (clic diretto -> apre PDF in nuova scheda)
-        st.markdown("### Seleziona un argomento (si apre in una nuova scheda)")
-        for d in docs:
-            st.link_button(f"📄 {d['title']}", d["url"], use_container_width=True)
+            renderer = get_page_renderer()
+            doc_id = st.session_state["bank_doc"]
+            try:
+                total_pages = renderer.page_count(doc_id)
+            except Exception as e:
+                total_pages = 0
+                st.warning(f"Documento non disponibile al momento: {e}")
+
+            if total_pages:
+                page = min(max(1, int(st.session_state["bank_page"])), total_pages)
+                st.session_state["bank_page"] = page
+                nc1, nc2, nc3 = st.columns([1, 2, 1])
+                nc1.button("◀", key="bank_prev", on_click=move_reader_page, args=(-1, total_pages), disabled=page <= 1, use_container_width=True)
+                nc2.number_input(f"Pagina (di {total_pages})", min_value=1, max_value=total_pages, step=1, key="bank_page", label_visibility="collapsed")
+                nc3.button("▶", key="bank_next", on_click=move_reader_page, args=(1, total_pages), disabled=page >= total_pages, use_container_width=True)
+
+                kind = "text" if st.session_state["bank_view"] == "Testo" else "image"
+                data = renderer.get(doc_id, page, kind)
+                if kind == "text":
+                    st.text(data.decode("utf-8"))
+                else:
+                    st.image(data, caption=f"{docs_by_id[doc_id]['title']} — pag. {page}/{total_pages}", use_container_width=True)
+                renderer.prefetch(doc_id, page, kind)
+
+                    # Lista argomenti (clic diretto -> apre PDF in nuova scheda)
+            st.markdown("### Seleziona un argomento (si apre in una nuova scheda)")
+            for d in STUDY_DOCS:
+                st.link_button(f"📄 {d['title']}", d["url"], use_container_width=True)
 
-        st.stop()
+            st.stop()
 
 
     # =========================================================
     # CASO PRATICO (placeholder, NO timer)
     # =========================================================
     if (not st.session_state["in_progress"]) and (not st.session_state["show_results"]) and st.session_state["menu_page"] == "case":
-        st.markdown("## 🧠 Caso pratico")
-        st.caption("Qui inseriremo casi pratici per argomento. Per ora è una versione base senza correzione automatica.")
+        with page_timer("case"):
+            st.markdown("## 🧠 Caso pratico")
+            st.caption("Qui inseriremo casi pratici per argomento. Per ora è una versione base senza correzione automatica.")
 
-        st.markdown("### Scenario (demo)")
-        st.write(
-            "Durante un controllo, un conducente circola con documento di guida non esibito al momento del controllo e sostiene di averlo dimenticato a casa."
-        )
-        ans = st.text_area("Scrivi la tua risposta (sintetica ma completa):", height=140)
+            st.markdown("### Scenario (demo)")
+            st.write(
+                "Durante un controllo, un conducente circola con documento di guida non esibito al momento del controllo e sostiene di averlo dimenticato a casa."
+            )
+            ans = st.text_area("Scrivi la tua risposta (sintetica ma completa):", height=140)
 
-        colA, colB = st.columns([1, 3])
-        with colA:
-            if st.button("Salva risposta (demo)"):
-                st.success("Risposta salvata (demo). In arrivo: correzione automatica e griglia di valutazione.")
+            colA, colB = st.columns([1, 3])
+            with colA:
+                if st.button("Salva risposta (demo)"):
+                    st.success("Risposta salvata (demo). In arrivo: correzione automatica e griglia di valutazione.")
 
-        with colB:
-            st.info("Prossimo step: casi pratici reali + criteri di idoneità + feedback automatico.")
+            with colB:
+                st.info("Prossimo step: casi pratici reali + criteri di idoneità + feedback automatico.")
 
-        st.stop()
+            st.stop()
 
     # =========================================================
     # SIMULAZIONE (timer SOLO QUI)
     # =========================================================
-    if bank_count < N_QUESTIONS_DEFAULT:
-        st.warning(f"Servono almeno {N_QUESTIONS_DEFAULT} domande per la simulazione. Ora: {bank_count}")
-        st.stop()
-
     # ---------- START SIM (solo se menu_page == sim) ----------
     if (not st.session_state["in_progress"]) and (not st.session_state["show_results"]) and st.session_state["menu_page"] == "sim":
-        st.markdown("### Simulazione (30 domande – 30 minuti)")
-        st.caption("Le domande vengono estratte casualmente dalla banca dati. Il timer parte SOLO in questa modalità.")
+        with page_timer("sim"):
+            bank_count = get_bank_index().count()
+            if bank_count < N_QUESTIONS_DEFAULT:
+                st.warning(f"Servono almeno {N_QUESTIONS_DEFAULT} domande per la simulazione. Ora: {bank_count}")
+                st.stop()
+
+            st.markdown("### Simulazione (30 domande – 30 minuti)")
+            st.caption("Le domande vengono estratte casualmente dalla banca dati. Il timer parte SOLO in questa modalità.")
+
+            # Argomento: tutta la banca dati (a strati per argomento) oppure uno solo
+            topics = get_bank_index().topic_counts()
+            topic_names = {t: f"{name} ({count} domande)" for t, name, count in topics}
+            topic_sizes = {t: count for t, _, count in topics}
+            topic_id = None
+            balanced = False
+            if topics:
+                topic_id = st.selectbox(
+                    "Argomento",
+                    options=[None] + list(topic_names),
+                    format_func=lambda t: "Tutta la banca dati" if t is None else topic_names[t],
+                    key="sim_topic",
+                )
+                if topic_id is None:
+                    balanced = st.checkbox("Stesso numero di domande per ogni argomento", key="sim_balanced")
+            n_questions = min(N_QUESTIONS_DEFAULT, topic_sizes[topic_id]) if topic_id is not None else N_QUESTIONS_DEFAULT
+            if n_questions < N_QUESTIONS_DEFAULT:
+                st.caption(f"Questo argomento ha {n_questions} domande: la simulazione le userà tutte.")
 
-        if st.button("Inizia simulazione"):
-            try:
-                sess = create_session(student_id=student["id"], n_questions=N_QUESTIONS_DEFAULT)
-                st.session_state["session_id"] = sess["id"]
-                st.session_state["in_progress"] = True
-                st.session_state["show_results"] = False
-                st.session_state["started_ts"] = time.time()
-                st.session_state["finished_ts"] = None
-                st.session_state["duration_seconds"] = DURATION_SECONDS_DEFAULT
-
-                all_q = fetch_all_bank_questions()
-                picked = random.sample(all_q, N_QUESTIONS_DEFAULT)
-                insert_session_questions(sess["id"], picked)
-
-                st.success("Simulazione avviata ✅")
-                st.rerun()
-            except Exception as e:
-                st.error("Errore avvio simulazione.")
-                st.exception(e)
+            if st.button("Inizia simulazione"):
+                try:
+                    sess, questions = start_sim_session(
+                        student_id=student["id"],
+                        n=n_questions,
+                        duration_seconds=DURATION_SECONDS_DEFAULT,
+                        topic_id=topic_id,
+                        balanced=balanced,
+                    )
+                    reset_answer_buffer()
+                    st.session_state["session_summary"] = None
+                    st.session_state["sim_page"] = 0
+                    apply_session_state(sess)
+                    set_session_rows(sess["id"], questions)
+
+                    st.success("Simulazione avviata ✅")
+                    st.rerun()
+                except Exception as e:
+                    st.error("Errore avvio simulazione.")
+                    st.exception(e)
 
-        st.stop()
+            st.stop()
 
     # ---------- IN PROGRESS ----------
     if st.session_state["in_progress"]:
-        session_id = st.session_state["session_id"]
-        rows = fetch_session_questions(session_id)
-
-        if not rows:
-            st.error("Sessione senza domande (quiz_answers vuota).")
-            st.stop()
+        with page_timer("in_progress"):
+            session_id = st.session_state["session_id"]
+            rows = load_session_rows(session_id)
+
+            if not rows:
+                st.error("Sessione senza domande (quiz_answers vuota).")
+                st.stop()
+
+            elapsed = int(time.time() - float(st.session_state["started_ts"]))
+            remaining = max(0, int(st.session_state["duration_seconds"]) - elapsed)
+            end_ts = session_end_ts()
+            time_up = time.time() >= end_ts
+            exam_mode = st.session_state["sim_layout"] == "exam"
+
+            if exam_mode:
+                # esame nel browser: le risposte arrivano solo con checkpoint, Termina o scadenza
+                exam_msg = receive_exam_message(session_id, rows, end_ts)
+                exam_kind = exam_msg["kind"] if exam_msg else None
+                if exam_kind in ("submit", "timeout"):
+                    st.session_state["exam_submitted"] = True
+                elif exam_kind == "checkpoint":
+                    flush_answers(force=True)
+                elif exam_kind == "layout" and exam_msg.get("layout") in SIM_LAYOUTS:
+                    # cambio visualizzazione dal componente: prima si salvano le risposte del browser
+                    if flush_answers(force=True):
+                        st.session_state["sim_layout"] = exam_msg["layout"]
+                        st.rerun()
+                    st.error("Impossibile salvare le risposte: la visualizzazione non è stata cambiata. Riprova.")
+                time_up = time_up or st.session_state["exam_submitted"]
+            else:
+                # TIMER SUPER FLUIDO (NO RERUN)
+                render_live_timer(end_ts)
+
+                progress = 1.0 - (remaining / int(st.session_state["duration_seconds"]))
+                st.progress(min(max(progress, 0.0), 1.0))
+                st.divider()
+
+            # controllo scadenza o consegna dal browser (prima salva le risposte date entro il tempo)
+            if time_up:
+                if not flush_answers(force=True):
+                    if time.time() >= end_ts:
+                        st.error("Tempo scaduto, ma alcune risposte non sono state ancora salvate. Riprova.")
+                    else:
+                        st.error("Alcune risposte non sono state ancora salvate. Riprova.")
+                    st.button("🔄 Riprova salvataggio")
+                    st.stop()
+                if time.time() >= end_ts:
+                    st.warning("Tempo scaduto! Correzione automatica…")
+                st.session_state["in_progress"] = False
+                st.session_state["show_results"] = True
+                st.session_state["finished_ts"] = time.time()
+                st.session_state["session_summary"] = finish_session(session_id)
+                st.rerun()
 
-        elapsed = int(time.time() - float(st.session_state["started_ts"]))
-        remaining = max(0, int(st.session_state["duration_seconds"]) - elapsed)
-
-        # TIMER SUPER FLUIDO (NO RERUN)
-        end_ts = float(st.session_state["started_ts"]) + int(st.session_state["duration_seconds"])
-        time_up = time.time() >= end_ts
-        render_live_timer(end_ts)
-
-        progress = 1.0 - (remaining / int(st.session_state["duration_seconds"]))
-        st.progress(min(max(progress, 0.0), 1.0))
-        st.divider()
-
-        # controllo scadenza
-        if time.time() >= end_ts:
-            st.warning("Tempo scaduto! Correzione automatica…")
-            st.session_state["in_progress"] = False
-            st.session_state["show_results"] = True
-            st.session_state["finished_ts"] = time.time()
-            finish_session(session_id)
-            st.rerun()
+            st.markdown("## 📝 Sessione in corso")
 
-        st.markdown("## 📝 Sessione in corso")
+            flush_answers()
+            pending = st.session_state["pending_answers"]
 
-        answered = sum(1 for r in rows if (r.get("chosen_option") or "").strip())
-        st.markdown(
-            f'<div class="badge">✅ <strong>Risposte date</strong>: {answered}/{len(rows)}</div>',
-            unsafe_allow_html=True
-        )
+            if exam_mode:
+                render_exam_runner(session_id, rows, end_ts)
+                st.caption(
+                    f"In modalità Esame le risposte restano nel browser e vengono salvate ogni {EXAM_CHECKPOINT_SECONDS} secondi, "
+                    "alla consegna e quando cambi visualizzazione."
+                )
+                st.stop()
 
-        # Lettere "bold" compatibili con radio (no markdown)
-        BOLD_LETTER = {"A": "𝐀", "B": "𝐁", "C": "𝐂", "D": "𝐃"}
+            def effective_choice(row: dict) -> str | None:
+                # la risposta in buffer (non ancora salvata) prevale su quella letta dal DB
+                if int(row["id"]) in pending:
+                    return pending[int(row["id"])]
+                return row["chosen_option"]
 
-        for idx, row in enumerate(rows, start=1):
+            answered = sum(1 for r in rows if effective_choice(r))
             st.markdown(
-                f"""
-                <div class="quiz-card">
-                  <div class="quiz-title">Domanda n°{idx} di {len(rows)}</div>
-                </div>
-                """,
+                f'<div class="badge">✅ <strong>Risposte date</strong>: {answered}/{len(rows)}</div>',
                 unsafe_allow_html=True
             )
 
-            st.markdown(f"**{row['question_text']}**")
-
-            options_map = {
-                "A": (row.get("option_a") or "").strip(),
-                "B": (row.get("option_b") or "").strip(),
-                "C": (row.get("option_c") or "").strip(),
-                "D": (row.get("option_d") or "").strip(),
-            }
-
-            letters = [k for k in ["A", "B", "C", "D"] if options_map[k] != ""]
-            radio_options = ["—"] + letters
-
-            def fmt(opt: str) -> str:
-                if opt == "—":
-                    return "— (lascia senza risposta)"
-                return f"{BOLD_LETTER.get(opt,opt)}) {options_map[opt]}"
-
-            current = (row.get("chosen_option") or "").strip().upper()
-            if current not in letters:
-                current = "—"
-
-            choice = st.radio(
-                "Seleziona risposta",
-                options=radio_options,
-                index=radio_options.index(current),
-                format_func=fmt,
-                key=f"q_{row['id']}",
-                disabled=time_up,
-            )
+            if pending:
+                cW, cS = st.columns([4, 1])
+                with cW:
+                    st.markdown(
+                        f'<div class="status-pill warn">💾 <b>Risposte non ancora salvate:</b> {len(pending)}</div>',
+                        unsafe_allow_html=True,
+                    )
+                    if st.session_state["answers_flush_error"]:
+                        st.caption(f"Ultimo salvataggio non riuscito: {st.session_state['answers_flush_error']}")
+                with cS:
+                    if st.button("💾 Salva ora"):
+                        flush_answers(force=True)
+                        st.rerun()
+
+            # ---------- VISUALIZZAZIONE ----------
+            cL, cP = st.columns([3, 1])
+            with cL:
+                st.radio(
+                    "Visualizzazione",
+                    options=list(SIM_LAYOUTS),
+                    format_func=lambda k: SIM_LAYOUTS[k],
+                    key="sim_layout",
+                    horizontal=True,
+                )
+            paged = st.session_state["sim_layout"] == "paged"
+
+            if paged:
+                with cP:
+                    st.selectbox(
+                        "Domande per pagina",
+                        options=SIM_PAGE_SIZES,
+                        key="sim_page_size",
+                        on_change=on_page_size_change,
+                    )
+                page_size = int(st.session_state["sim_page_size"])
+                n_pages = (len(rows) + page_size - 1) // page_size
+                page = min(int(st.session_state["sim_page"]), n_pages - 1)
+                st.session_state["sim_page"] = page
+                first, last = page * page_size, min(len(rows), (page + 1) * page_size)
+
+                # navigatore: ✅ risposta data, ⬜ ancora da rispondere
+                for start in range(0, len(rows), SIM_NAV_COLUMNS):
+                    cols = st.columns(SIM_NAV_COLUMNS)
+                    for pos in range(start, min(start + SIM_NAV_COLUMNS, len(rows))):
+                        with cols[pos - start]:
+                            st.button(
+                                f"{'✅' if effective_choice(rows[pos]) else '⬜'} {pos + 1}",
+                                key=f"nav_{pos}",
+                                on_click=go_to_question,
+                                args=(pos,),
+                                type="primary" if first <= pos < last else "secondary",
+                                use_container_width=True,
+                            )
+            else:
+                first, last = 0, len(rows)
 
-            new_val = None if choice == "—" else choice
-            old_val = (row.get("chosen_option") or None)
+            st.divider()
 
-            if (not time_up) and (new_val != old_val):
-                try:
-                    update_chosen_option(row_id=row["id"], session_id=session_id, chosen_letter=new_val)
-                except Exception:
-                    pass
+            # Lettere "bold" compatibili con radio (no markdown)
+            BOLD_LETTER = {"A": "𝐀", "B": "𝐁", "C": "𝐂", "D": "𝐃"}
 
-            if new_val is None:
+            for idx, row in enumerate(rows[first:last], start=first + 1):
                 st.markdown(
-                    '<div class="status-pill warn">📝 <b>Stato risposta:</b> ⚠️ Non hai ancora risposto</div>',
-                    unsafe_allow_html=True,
+                    f"""
+                    <div class="quiz-card">
+                      <div class="quiz-title">Domanda n°{idx} di {len(rows)}</div>
+                    </div>
+                    """,
+                    unsafe_allow_html=True
                 )
-            else:
-                st.markdown(
-                    f'<div class="status-pill ok">📝 <b>Stato risposta:</b> ✅ Risposta selezionata: <b>{new_val}</b></div>',
-                    unsafe_allow_html=True,
+
+                st.markdown(f"**{row['question_text']}**")
+
+                options_map = {
+                    "A": row["option_a"],
+                    "B": row["option_b"],
+                    "C": row["option_c"],
+                    "D": row["option_d"],
+                }
+
+                letters = [k for k in ["A", "B", "C", "D"] if options_map[k] != ""]
+                radio_options = ["—"] + letters
+
+                def fmt(opt: str, options_map: Dict = options_map) -> str:
+                    if opt == "—":
+                        return "— (lascia senza risposta)"
+                    return f"{BOLD_LETTER.get(opt,opt)}) {options_map[opt]}"
+
+                current = effective_choice(row) or "—"
+                if current not in letters:
+                    current = "—"
+
+                choice = st.radio(
+                    "Seleziona risposta",
+                    options=radio_options,
+                    index=radio_options.index(current),
+                    format_func=fmt,
+                    key=f"q_{row['id']}",
+                    on_change=on_answer_change,
+                    args=(row["id"],),
+                    disabled=time_up,
                 )
 
-            st.divider()
-
-        st.markdown('<div class="end-btn-wrap">', unsafe_allow_html=True)
-        if st.button("Termina simulazione e vedi correzione"):
-            st.session_state["in_progress"] = False
-            st.session_state["show_results"] = True
-            st.session_state["finished_ts"] = time.time()
-            finish_session(session_id)
-            st.rerun()
-        st.markdown("</div>", unsafe_allow_html=True)
+                new_val = None if choice == "—" else choice
+
+                if new_val is None:
+                    st.markdown(
+                        '<div class="status-pill warn">📝 <b>Stato risposta:</b> ⚠️ Non hai ancora risposto</div>',
+                        unsafe_allow_html=True,
+                    )
+                else:
+                    st.markdown(
+                        f'<div class="status-pill ok">📝 <b>Stato risposta:</b> ✅ Risposta selezionata: <b>{new_val}</b></div>',
+                        unsafe_allow_html=True,
+                    )
+
+                st.divider()
+
+            if paged and n_pages > 1:
+                cPrev, cInfo, cNext = st.columns([1, 2, 1])
+                with cPrev:
+                    st.button("⬅️ Precedente", on_click=go_to_page, args=(page - 1,), disabled=page == 0)
+                with cInfo:
+                    st.caption(f"Pagina {page + 1} di {n_pages}")
+                with cNext:
+                    st.button("Successiva ➡️", on_click=go_to_page, args=(page + 1,), disabled=page >= n_pages - 1)
+
+            st.markdown('<div class="end-btn-wrap">', unsafe_allow_html=True)
+            if st.button("Termina simulazione e vedi correzione"):
+                if flush_answers(force=True):
+                    st.session_state["in_progress"] = False
+                    st.session_state["show_results"] = True
+                    st.session_state["finished_ts"] = time.time()
+                    st.session_state["session_summary"] = finish_session(session_id)
+                    st.rerun()
+                else:
+                    st.error("Impossibile salvare le risposte. Controlla la connessione e riprova.")
+            st.markdown("</div>", unsafe_allow_html=True)
 
     # ---------- RESULTS ----------
     if st.session_state["show_results"]:
-        session_id = st.session_state["session_id"]
-        rows = fetch_session_questions(session_id)
-
-        score = 0
-        for row in rows:
-            chosen = (row.get("chosen_option") or "").strip().upper()
-            correct = (row.get("correct_option") or "").strip().upper()
-            if chosen and chosen == correct:
-                score += 1
-
-        start_ts = st.session_state.get("started_ts")
-        end_ts2 = st.session_state.get("finished_ts") or time.time()
-        elapsed_sec = int(max(0, float(end_ts2) - float(start_ts))) if start_ts else 0
-        em = elapsed_sec // 60
-        es = elapsed_sec % 60
-
-        st.markdown("## ✅ Correzione finale")
-        st.success(f"📌 Punteggio: **{score} / {len(rows)}**  •  ⏱️ Completata in **{em} min {es:02d} sec**")
-        st.divider()
-
-        def letter_to_text(row: dict, letter: str) -> str:
-            letter = (letter or "").strip().upper()
-            if letter == "A":
-                return (row.get("option_a") or "").strip()
-            if letter == "B":
-                return (row.get("option_b") or "").strip()
-            if letter == "C":
-                return (row.get("option_c") or "").strip()
-            if letter == "D":
-                return (row.get("option_d") or "").strip()
-            return ""
-
-        for idx, row in enumerate(rows, start=1):
-            chosen = (row.get("chosen_option") or "").strip().upper()
-            correct = (row.get("correct_option") or "").strip().upper()
-
-            chosen_text = letter_to_text(row, chosen) if chosen else ""
-            correct_text = letter_to_text(row, correct)
-
-            ok = (chosen != "" and chosen == correct)
-
-            st.markdown(f"### Domanda n°{idx} {'✅' if ok else '❌'}")
-            st.markdown(f"**{row['question_text']}**")
-
-            if chosen:
-                st.write(f"**Tua risposta:** {chosen}) {chosen_text}")
-            else:
-                st.write("**Tua risposta:** — (non risposta)")
+        with page_timer("results"):
+            session_id = st.session_state["session_id"]
+            rows = load_session_rows(session_id)
+
+            # punteggio già calcolato e salvato alla chiusura: qui si legge soltanto
+            summary = st.session_state["session_summary"]
+            if not summary or summary.get("score") is None:
+                summary = fetch_session(session_id)
+                if summary and summary.get("score") is None:
+                    summary = finish_session(session_id)
+                st.session_state["session_summary"] = summary
+            if not summary:
+                st.error("Sessione non trovata.")
+                st.stop()
+            score = int(summary["score"])
+
+            start_ts = st.session_state.get("started_ts")
+            end_ts2 = st.session_state.get("finished_ts") or time.time()
+            elapsed_sec = int(max(0, float(end_ts2) - float(start_ts))) if start_ts else 0
+            em = elapsed_sec // 60
+            es = elapsed_sec % 60
+
+            st.markdown("## ✅ Correzione finale")
+            st.success(f"📌 Punteggio: **{score} / {len(rows)}**  •  ⏱️ Completata in **{em} min {es:02d} sec**")
+            st.caption(f"Risposte date: {summary['answered']} / {summary['n_questions']}")
+            st.divider()
 
-            st.write(f"**Corretta:** {correct}) {correct_text}")
+            def letter_to_text(row: dict, letter: str) -> str:
+                return row[f"option_{letter.lower()}"] if letter else ""
 
-            if row.get("explanation"):
-                st.caption(row["explanation"])
+            for idx, row in enumerate(rows, start=1):
+                chosen = row["chosen_option"] or ""
+                correct = row["correct_option"]
 
-            st.divider()
+                chosen_text = letter_to_text(row, chosen) if chosen else ""
+                correct_text = letter_to_text(row, correct)
 
-        st.success(f"📌 Punteggio: **{score} / {len(rows)}**  •  ⏱️ Completata in **{em} min {es:02d} sec**")
+                ok = (chosen != "" and chosen == correct)
 
-        if st.button("Torna al menu"):
-            st.session_state["session_id"] = None
-            st.session_state["in_progress"] = False
-            st.session_state["show_results"] = False
-            st.session_state["started_ts"] = None
-            st.session_state["finished_ts"] = None
-            st.session_state["duration_seconds"] = DURATION_SECONDS_DEFAULT
-            st.session_state["menu_page"] = "home"
-            st.rerun()
+                st.markdown(f"### Domanda n°{idx} {'✅' if ok else '❌'}")
+                st.markdown(f"**{row['question_text']}**")
+
+                if chosen:
+                    st.write(f"**Tua risposta:** {chosen}) {chosen_text}")
+                else:
+                    st.write("**Tua risposta:** — (non risposta)")
+
+                st.write(f"**Corretta:** {correct}) {correct_text}")
+
+                if row.get("explanation"):
+                    st.caption(row["explanation"])
+
+                st.divider()
+
+            st.success(f"📌 Punteggio: **{score} / {len(rows)}**  •  ⏱️ Completata in **{em} min {es:02d} sec**")
+
+            if st.button("Torna al menu"):
+                close_session(session_id)
+                reset_sim_state()
+                st.rerun()
 
 # =========================================================
 # PADDING (non rimuovere nulla)
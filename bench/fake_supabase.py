@@ -0,0 +1,465 @@
+"""
+Finto Supabase locale per i benchmark: implementa il sottoinsieme di PostgREST
+usato da app.py (tabelle students, sessions, question_bank, quiz_answers, topics, exam_papers,
+bank_versions, question_stats e le funzioni RPC) tenendo i dati in memoria, con latenza iniettabile per richiesta.
+
+Uso tipico (vedi bench/load_test.py):
+
+    fake = FakeSupabase(latency_ms=20)
+    fake.seed_questions(2000)
+    url = fake.start()           # http://127.0.0.1:<porta>
+    ...
+    fake.stop()
+"""
+import json
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from urllib.parse import parse_qsl, urlsplit
+
+TABLES = [
+    "students", "sessions", "question_bank", "quiz_answers", "topics", "exam_papers", "bank_versions", "question_stats",
+    "question_bank_staging",
+]
+
+# vincoli unique usati dagli upsert (on_conflict)
+UNIQUE_KEYS = {
+    "students": [("class_code", "nickname")],
+    "question_bank": [("content_hash",)],
+    "question_bank_staging": [("content_hash",)],
+    "topics": [("name",)],
+}
+
+
+def _now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _coerce(value, raw: str):
+    # i filtri PostgREST arrivano come stringhe: confronto col tipo della colonna
+    if raw == "null":
+        return None
+    if isinstance(value, bool):
+        return raw.lower() == "true"
+    if isinstance(value, int):
+        try:
+            return int(raw)
+        except ValueError:
+            return raw
+    if isinstance(value, float):
+        return float(raw)
+    return raw.strip('"')
+
+
+def _match(row: Dict, col: str, expr: str) -> bool:
+    op, _, raw = expr.partition(".")
+    negate = op == "not"
+    if negate:
+        op, _, raw = raw.partition(".")
+    val = row.get(col)
+
+    if op == "in":
+        items = [x.strip().strip('"') for x in raw.strip("()").split(",") if x.strip()]
+        ok = val is not None and any(val == _coerce(val, x) for x in items)
+    elif op == "is":
+        ok = (val is None) if raw == "null" else (val is (raw == "true"))
+    elif val is None:
+        ok = False
+    else:
+        other = _coerce(val, raw)
+        if op == "eq":
+            ok = val == other
+        elif op == "neq":
+            ok = val != other
+        elif op == "gt":
+            ok = val > other
+        elif op == "gte":
+            ok = val >= other
+        elif op == "lt":
+            ok = val < other
+        elif op == "lte":
+            ok = val <= other
+        else:
+            raise ValueError(f"operatore non supportato: {op}")
+    return ok != negate
+
+
+def _project(row: Dict, select: str) -> Dict:
+    cols = [c.strip() for c in select.split(",") if c.strip()]
+    if not cols or "*" in cols:
+        return dict(row)
+    return {c: row.get(c) for c in cols}
+
+
+class FakeSupabase:
+    """
+    Database in memoria + server HTTP PostgREST-compatibile (solo il necessario).
+    calls: Counter delle richieste per (metodo, risorsa), per misurare le chiamate DB.
+    """
+
+    def __init__(self, latency_ms: float = 0.0):
+        self.latency = latency_ms / 1000.0
+        self.lock = threading.RLock()
+        self.tables: Dict[str, List[Dict]] = {t: [] for t in TABLES}
+        self.next_id: Counter = Counter()
+        self.calls: Counter = Counter()
+        self.rpcs = {
+            "start_session": self.rpc_start_session,
+            "grade_session": self.rpc_grade_session,
+            "sweep_expired_sessions": self.rpc_sweep_expired_sessions,
+            "start_session_from_paper": self.rpc_start_session_from_paper,
+            "publish_bank_version": self.rpc_publish_bank_version,
+            "save_answers": self.rpc_save_answers,
+        }
+        self._server = None
+
+    # ---------- dati ----------
+    def _new_id(self, table: str):
+        if table == "sessions":
+            return str(uuid.uuid4())
+        self.next_id[table] += 1
+        return self.next_id[table]
+
+    def _pending_version(self) -> int:
+        # come il trigger question_bank_stamp_version: ultima versione pubblicata + 1
+        return max((v["version"] for v in self.tables["bank_versions"]), default=0) + 1
+
+    @staticmethod
+    def _n_options(row: Dict) -> int:
+        # colonna calcolata question_bank.n_options
+        return sum(1 for k in "abcd" if row.get(f"option_{k}"))
+
+    def insert(self, table: str, row: Dict) -> Dict:
+        with self.lock:
+            row = dict(row)
+            row.setdefault("id", self._new_id(table))
+            if table == "question_bank":
+                row["version_added"] = row["version_changed"] = self._pending_version()
+                row["n_options"] = self._n_options(row)
+            if table == "exam_papers":
+                row.setdefault("claimed_at", None)
+            if table == "sessions":
+                row.setdefault("status", "in_progress")
+                row.setdefault("duration_seconds", 1800)
+                row.setdefault("started_at", _now_iso())
+                row.setdefault("finished_at", None)
+                row.setdefault("score", None)
+                row.setdefault("answered", None)
+            self.tables[table].append(row)
+            return row
+
+    def seed_questions(self, n: int, seed: int = 0, topics: int = 0) -> None:
+        rnd = random.Random(seed)
+        topic_ids = [self.insert("topics", {"name": f"Argomento {k + 1}"})["id"] for k in range(topics)]
+        for i in range(n):
+            letters = "ABCD" if rnd.random() < 0.7 else "ABC"
+            self.insert(
+                "question_bank",
+                {
+                    "question_text": (f"Domanda di prova n. {i + 1}: " + "testo " * rnd.randint(10, 40)).strip(),
+                    "option_a": f"Risposta A {i}",
+                    "option_b": f"Risposta B {i}",
+                    "option_c": f"Risposta C {i}",
+                    "option_d": f"Risposta D {i}" if "D" in letters else "",
+                    "correct_option": rnd.choice(letters),
+                    "explanation": ("spiegazione " * rnd.randint(0, 20)).strip(),
+                    "content_hash": uuid.uuid4().hex,
+                    "topic_id": rnd.choice(topic_ids) if topic_ids else None,
+                },
+            )
+        self.rpc_publish_bank_version()
+
+    def _find_conflict(self, table: str, row: Dict, on_conflict: str | None) -> Dict | None:
+        keys = [tuple(c.strip() for c in on_conflict.split(","))] if on_conflict else UNIQUE_KEYS.get(table, [])
+        for key in keys:
+            for existing in self.tables[table]:
+                if all(existing.get(k) == row.get(k) for k in key):
+                    return existing
+        return None
+
+    # ---------- RPC (equivalenti Python delle funzioni SQL in supabase/migrations) ----------
+    def rpc_start_session(
+        self, p_student_id, p_question_ids, p_duration_seconds=1800, p_mode="sim", p_topic_scope="bank",
+        p_topic_id=None, p_bank_version=None, **_
+    ):
+        with self.lock:
+            version = p_bank_version or self._pending_version() - 1
+            by_id = {q["id"]: q for q in self.tables["question_bank"] if q["version_added"] <= version}
+            picked = [by_id[i] for i in p_question_ids if i in by_id]
+            if not picked or len(picked) < len(p_question_ids):
+                raise ValueError("start_session: domande mancanti in question_bank")
+            sess = self.insert(
+                "sessions",
+                {
+                    "student_id": p_student_id,
+                    "mode": p_mode,
+                    "topic_scope": p_topic_scope,
+                    "selected_topic_id": p_topic_id,
+                    "bank_version": version,
+                    "n_questions": len(picked),
+                    "duration_seconds": p_duration_seconds,
+                },
+            )
+            rows = []
+            for pos, q in enumerate(picked, start=1):
+                rows.append(
+                    self.insert(
+                        "quiz_answers",
+                        {
+                            "session_id": sess["id"],
+                            "question_id": q["id"],
+                            "position": pos,
+                            "topic_id": q.get("topic_id"),
+                            "correct_option": q["correct_option"],
+                            "chosen_option": None,
+                            "is_correct": None,
+                        },
+                    )
+                )
+            keys = ["id", "question_id", "position", "correct_option", "chosen_option"]
+            return {"session": dict(sess), "questions": [{k: r[k] for k in keys} for r in rows]}
+
+    def rpc_save_answers(self, p_session_id, p_answers, p_grace_seconds=120, **_):
+        with self.lock:
+            sess = next((s for s in self.tables["sessions"] if s["id"] == p_session_id), None)
+            if (
+                sess is None
+                or sess["status"] != "in_progress"
+                or (datetime.now(timezone.utc) - datetime.fromisoformat(sess["started_at"])).total_seconds()
+                > sess["duration_seconds"] + p_grace_seconds
+            ):
+                return -1
+            updated = 0
+            for a in self.tables["quiz_answers"]:
+                key = str(a["id"])
+                if a["session_id"] == p_session_id and key in p_answers:
+                    letter = p_answers[key]
+                    a["chosen_option"] = letter if letter in ("A", "B", "C", "D") else None
+                    updated += 1
+            return updated
+
+    def rpc_grade_session(self, p_session_id, **_):
+        with self.lock:
+            answers = [a for a in self.tables["quiz_answers"] if a["session_id"] == p_session_id]
+            for a in answers:
+                a["is_correct"] = a["chosen_option"] is not None and a["chosen_option"] == a["correct_option"]
+            sess = next(s for s in self.tables["sessions"] if s["id"] == p_session_id)
+            sess["score"] = sum(1 for a in answers if a["is_correct"])
+            sess["answered"] = sum(1 for a in answers if a["chosen_option"] is not None)
+            sess["finished_at"] = sess.get("finished_at") or _now_iso()
+            sess["graded_at"] = _now_iso()
+            if sess["status"] != "closed":
+                sess["status"] = "finished"
+            if not sess.get("stats_at"):
+                self._add_question_stats(answers, sess["score"])
+                sess["stats_at"] = _now_iso()
+            return {k: sess.get(k) for k in ["id", "status", "score", "answered", "n_questions", "started_at", "duration_seconds", "finished_at"]}
+
+    def _add_question_stats(self, answers: List[Dict], score: int) -> None:
+        # come add_question_stats(): aggregati per domanda, resto della prova in frazione
+        rest_den = max(len(answers) - 1, 1)
+        by_id = {r["question_id"]: r for r in self.tables["question_stats"]}
+        for a in answers:
+            if a.get("question_id") is None:
+                continue
+            st = by_id.get(a["question_id"])
+            if st is None:
+                st = self.insert("question_stats", {
+                    "question_id": a["question_id"], "served": 0, "answered": 0, "correct": 0,
+                    "chosen_a": 0, "chosen_b": 0, "chosen_c": 0, "chosen_d": 0,
+                    "rest_sum_correct": 0.0, "rest_sum_wrong": 0.0,
+                })
+                by_id[a["question_id"]] = st
+            st["served"] += 1
+            if a["chosen_option"]:
+                st["answered"] += 1
+                st[f"chosen_{a['chosen_option'].lower()}"] += 1
+            if a["is_correct"]:
+                st["correct"] += 1
+                st["rest_sum_correct"] += (score - 1) / rest_den
+            else:
+                st["rest_sum_wrong"] += score / rest_den
+            st["updated_at"] = _now_iso()
+
+    def rpc_start_session_from_paper(
+        self, p_student_id, p_n_questions, p_duration_seconds=1800, p_topic_id=None, p_balanced=False, **_
+    ):
+        with self.lock:
+            for paper in self.tables["exam_papers"]:
+                if (
+                    paper["claimed_at"] is None
+                    and paper["n_questions"] == p_n_questions
+                    and paper.get("topic_id") == p_topic_id
+                    and bool(paper.get("balanced")) == bool(p_balanced)
+                ):
+                    paper["claimed_at"] = _now_iso()
+                    try:
+                        res = self.rpc_start_session(
+                            p_student_id, paper["question_ids"], p_duration_seconds,
+                            p_topic_scope="bank" if p_topic_id is None else "topic", p_topic_id=p_topic_id,
+                            p_bank_version=paper.get("bank_version"),
+                        )
+                    except ValueError:
+                        continue
+                    paper["student_id"] = p_student_id
+                    paper["session_id"] = res["session"]["id"]
+                    return res
+            return None
+
+    def rpc_publish_bank_version(self, **_):
+        with self.lock:
+            # aggiornamenti accodati dall'import: applicati con la nuova versione
+            by_hash = {q["content_hash"]: q for q in self.tables["question_bank"]}
+            for upd in self.tables["question_bank_staging"]:
+                q = by_hash.get(upd["content_hash"])
+                if q is not None and (q.get("explanation"), q.get("topic_id")) != (upd["explanation"], upd["topic_id"]):
+                    q["explanation"], q["topic_id"] = upd["explanation"], upd["topic_id"]
+                    q["version_changed"] = self._pending_version()
+            self.tables["question_bank_staging"] = []
+            return dict(self.insert(
+                "bank_versions",
+                {"version": self._pending_version(), "published_at": _now_iso(), "n_questions": len(self.tables["question_bank"])},
+            ))
+
+    def rpc_sweep_expired_sessions(self, p_limit=200, p_grace_seconds=120, **_):
+        with self.lock:
+            now = datetime.now(timezone.utc)
+            expired = sorted(
+                (
+                    s for s in self.tables["sessions"]
+                    if s["status"] == "in_progress"
+                    and (now - datetime.fromisoformat(s["started_at"])).total_seconds() > s["duration_seconds"] + p_grace_seconds
+                ),
+                key=lambda s: s["started_at"],
+            )[:p_limit]
+            for s in expired:
+                deadline = datetime.fromisoformat(s["started_at"]).timestamp() + s["duration_seconds"]
+                s["finished_at"] = s.get("finished_at") or datetime.fromtimestamp(deadline, timezone.utc).isoformat()
+                self.rpc_grade_session(s["id"])
+            return {"finalized": len(expired), "ids": [s["id"] for s in expired]}
+
+    # ---------- PostgREST ----------
+    def handle(self, method: str, path: str, query: List, headers: Dict, body) -> tuple:
+        if self.latency:
+            time.sleep(self.latency)
+
+        parts = [p for p in path.split("/") if p]
+        # /rest/v1/<tabella>  oppure  /rest/v1/rpc/<funzione>
+        if parts[:2] != ["rest", "v1"] or len(parts) < 3:
+            return 404, {}, {"message": f"percorso non gestito: {path}"}
+
+        if parts[2] == "rpc":
+            name = parts[3]
+            self.calls[(method, f"rpc/{name}")] += 1
+            try:
+                return 200, {}, self.rpcs[name](**(body or {}))
+            except Exception as e:
+                return 400, {}, {"message": str(e), "code": "P0001"}
+
+        table = parts[2]
+        self.calls[(method, table)] += 1
+        if table not in self.tables:
+            return 404, {}, {"message": f"tabella sconosciuta: {table}"}
+
+        params = {}
+        filters = []
+        for k, v in query:
+            if k in ("select", "order", "limit", "offset", "on_conflict", "columns"):
+                params[k] = v
+            else:
+                filters.append((k, v))
+        prefer = headers.get("prefer", "")
+
+        with self.lock:
+            if method == "POST":
+                items = body if isinstance(body, list) else [body]
+                merge = "resolution=merge-duplicates" in prefer
+                out = []
+                for item in items:
+                    existing = self._find_conflict(table, item, params.get("on_conflict"))
+                    if existing is not None:
+                        if not merge:
+                            return 409, {}, {"message": "duplicate key value violates unique constraint", "code": "23505"}
+                        existing.update(item)
+                        if table == "question_bank":
+                            existing["version_changed"] = self._pending_version()
+                            existing["n_options"] = self._n_options(existing)
+                        out.append(existing)
+                    else:
+                        out.append(self.insert(table, item))
+                return 201, {}, [_project(r, params.get("select", "*")) for r in out]
+
+            rows = [r for r in self.tables[table] if all(_match(r, c, e) for c, e in filters)]
+
+            if method == "PATCH":
+                for r in rows:
+                    r.update(body or {})
+                    if table == "question_bank":
+                        r["version_changed"] = self._pending_version()
+                        r["n_options"] = self._n_options(r)
+                return 200, {}, [dict(r) for r in rows]
+
+            if method == "DELETE":
+                self.tables[table] = [r for r in self.tables[table] if r not in rows]
+                return 200, {}, [dict(r) for r in rows]
+
+            # GET
+            total = len(rows)
+            for spec in reversed([s for s in params.get("order", "").split(",") if s]):
+                col, _, direction = spec.partition(".")
+                desc = direction.startswith("desc")
+                rows = sorted(rows, key=lambda r: (r.get(col) is None, r.get(col)), reverse=desc)
+            offset = int(params.get("offset", 0))
+            limit = params.get("limit")
+            rows = rows[offset: offset + int(limit)] if limit is not None else rows[offset:]
+            extra = {}
+            if "count=exact" in prefer:
+                end = offset + len(rows) - 1
+                extra["Content-Range"] = f"{offset}-{end}/{total}" if rows else f"*/{total}"
+            return 200, extra, [_project(r, params.get("select", "*")) for r in rows]
+
+    # ---------- server HTTP ----------
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _serve(self):
+                url = urlsplit(self.path)
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length) if length else b""
+                body = json.loads(raw) if raw else None
+                headers = {k.lower(): v for k, v in self.headers.items()}
+                status, extra, payload = fake.handle(
+                    self.command, url.path, parse_qsl(url.query, keep_blank_values=True), headers, body
+                )
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for k, v in extra.items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PATCH = do_DELETE = _serve
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return f"http://{host}:{self._server.server_address[1]}"
+
+    def stop(self) -> None:
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
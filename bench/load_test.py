@@ -0,0 +1,294 @@
+"""
+Load test di app.py: simula una classe intera contro il finto Supabase locale.
+
+Ogni studente virtuale guida l'app in modalità headless (streamlit AppTest):
+login -> "Inizia simulazione" -> 30 risposte -> "Termina". Per ogni livello
+riporta tempo della schermata di login, latenza dei rerun (p50/p95), chiamate DB
+per studente e memoria per sessione.
+Con --mode exam (predefinito) le risposte passano dal componente esame nel browser:
+si simulano i suoi invii (un checkpoint ogni EXAM_ANSWERS_PER_CHECKPOINT risposte
++ la consegna); con --mode radio ogni risposta è un rerun.
+
+    python bench/load_test.py                          # 50, 200, 500 studenti
+    python bench/load_test.py --students 50 --latency-ms 40 --json bench_output.json
+    python bench/load_test.py --students 200 --processes 4
+    python bench/load_test.py --mode radio             # vecchia modalità: un rerun per risposta
+    python bench/load_test.py --papers 500             # avvio da fogli d'esame già preparati
+
+Come viene simulata la concorrenza: AppTest usa un Runtime Streamlit unico per
+processo, quindi dentro un processo i rerun girano uno alla volta. Gli studenti
+però avanzano a turno (round robin): tutte le sessioni restano vive insieme,
+come su un'istanza reale, e la memoria misurata è quella con N sessioni aperte.
+Con --processes P gli studenti vengono divisi su P processi (= P istanze dell'app)
+che colpiscono in parallelo lo stesso finto DB.
+
+Le latenze includono il costo di AppTest (albero degli elementi), non la rete
+browser <-> server: servono per confrontare versioni dell'app tra loro.
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import pickle
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List
+
+sys.path.insert(0, str(Path(__file__).parent))
+from fake_supabase import FakeSupabase  # noqa: E402
+
+APP_PATH = Path(__file__).resolve().parent.parent / "app.py"
+COURSE_PASSWORD = "polizia2026"
+N_ANSWERS = 30
+EXAM_ANSWERS_PER_CHECKPOINT = 10  # ~ risposte date tra due checkpoint (60 s) del componente
+
+
+def _rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return 0
+
+
+def _pct(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, round(p / 100 * (len(values) - 1))))
+    return values[k]
+
+
+class Student:
+    """Uno studente virtuale: un AppTest che registra la durata di ogni rerun."""
+
+    def __init__(self, n: int, timeout: float, mode: str = "exam"):
+        from streamlit.testing.v1 import AppTest
+
+        self.name = f"Studente Bench {n:04d}"
+        self.mode = mode
+        self.at = AppTest.from_file(str(APP_PATH), default_timeout=timeout)
+        self.timings: List[float] = []
+
+    def run(self):
+        t0 = time.perf_counter()
+        self.at.run()
+        self.timings.append(time.perf_counter() - t0)
+        if self.at.exception:
+            raise RuntimeError(self.at.exception[0].message)
+
+    def click(self, label: str):
+        btn = next(b for b in self.at.button if b.label.startswith(label))
+        btn.click()
+        self.run()
+
+    def session_state_bytes(self) -> int:
+        # stima della memoria per sessione: stato applicativo (senza widget) serializzato
+        state = {}
+        for k, v in self.at._session_state._state.filtered_state.items():
+            try:
+                pickle.dumps(v)
+                state[k] = v
+            except Exception:
+                continue
+        return len(pickle.dumps(state))
+
+    def exam(self, answers: int = N_ANSWERS) -> Iterator[None]:
+        """Percorso completo; cede il turno dopo ogni rerun."""
+        self.run()
+        yield
+        self.at.text_input[0].input(self.name)
+        self.at.text_input[1].input(COURSE_PASSWORD)
+        self.click("Entra")
+        yield
+        self.click("➡️ Vai alla Simulazione")
+        yield
+        self.click("Inizia simulazione")
+        yield
+        if not self.at.session_state["in_progress"]:
+            raise RuntimeError("simulazione non avviata")
+
+        if self.mode == "exam":
+            # invii del componente (come li manderebbe il browser) scritti nella sua chiave
+            key = f"exam_{self.at.session_state['session_id']}"
+            rows = self.at.session_state["session_rows"]
+            chosen: Dict[str, str] = {}
+            seq = 0
+            for i, row in enumerate(rows[:answers]):
+                chosen[str(row["id"])] = "ABC"[i % 3]
+                if (i + 1) % EXAM_ANSWERS_PER_CHECKPOINT == 0 and i + 1 < answers:
+                    seq += 1
+                    self.at.session_state[key] = {"kind": "checkpoint", "seq": seq, "answers": dict(chosen)}
+                    self.run()
+                    yield
+            self.at.session_state[key] = {"kind": "submit", "seq": seq + 1, "answers": dict(chosen)}
+            self.run()
+            if not self.at.session_state["show_results"]:
+                raise RuntimeError("correzione non mostrata")
+            return
+
+        # tutte le domande in pagina, così ogni risposta è un singolo rerun;
+        # dalla vista Esame si cambia con il pulsante del componente, come nel browser
+        if self.at.session_state["sim_layout"] == "exam":
+            key = f"exam_{self.at.session_state['session_id']}"
+            self.at.session_state[key] = {"kind": "layout", "seq": 1, "answers": {}, "layout": "all"}
+            self.run()
+            yield
+
+        keys = [r.key for r in self.at.radio if r.key and r.key.startswith("q_")]
+        for k in keys[:answers]:
+            # A/B/C esistono sempre (la D può mancare)
+            self.at.radio(key=k).set_value("ABC"[len(self.timings) % 3])
+            self.run()
+            yield
+
+        self.click("Termina")
+        if not self.at.session_state["show_results"]:
+            raise RuntimeError("correzione non mostrata")
+
+
+def _quiet_streamlit():
+    import logging
+
+    import streamlit as st
+
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+    # ast.parse della "magic" di Streamlit non è thread-safe su Python 3.11 e l'app non la usa
+    st.config.set_option("runner.magicEnabled", False)
+
+
+def run_worker(first: int, count: int, url: str, timeout: float, mode: str = "exam") -> Dict:
+    """Un'istanza dell'app: `count` studenti che avanzano a turno."""
+    import streamlit as st
+
+    _quiet_streamlit()
+    os.environ["SUPABASE_URL"] = url
+    os.environ["SUPABASE_ANON_KEY"] = "bench-anon-key"
+    st.cache_data.clear()
+    st.cache_resource.clear()
+
+    rss_before = _rss_bytes()
+    students = [Student(first + i, timeout, mode) for i in range(count)]
+    active = {s.name: (s, s.exam()) for s in students}
+    errors: List[str] = []
+
+    while active:
+        for name, (s, steps) in list(active.items()):
+            try:
+                next(steps)
+            except StopIteration:
+                del active[name]
+            except Exception as e:  # un errore non ferma gli altri studenti
+                errors.append(f"{name}: {e}")
+                del active[name]
+
+    rss_after = _rss_bytes()
+    return {
+        "timings": [t for s in students for t in s.timings],
+        # primo rerun di ogni studente = schermata di login (prima visualizzazione)
+        "first_paint": [s.timings[0] for s in students if s.timings],
+        "state_bytes": [s.session_state_bytes() for s in students],
+        "rss_delta": rss_after - rss_before,
+        "errors": errors,
+    }
+
+
+def run_level(
+    n_students: int,
+    latency_ms: float,
+    bank_size: int,
+    processes: int,
+    timeout: float,
+    mode: str = "exam",
+    papers: int = 0,
+) -> Dict:
+    fake = FakeSupabase(latency_ms=latency_ms)
+    fake.seed_questions(bank_size)
+    ids = [q["id"] for q in fake.tables["question_bank"]]
+    for _ in range(papers):
+        fake.insert("exam_papers", {"question_ids": random.sample(ids, N_ANSWERS), "n_questions": N_ANSWERS, "balanced": False})
+    url = fake.start()
+
+    processes = max(1, min(processes, n_students))
+    share = [n_students // processes + (1 if i < n_students % processes else 0) for i in range(processes)]
+    jobs, first = [], 0
+    for count in share:
+        jobs.append((first, count, url, timeout, mode))
+        first += count
+
+    t0 = time.perf_counter()
+    if processes == 1:
+        parts = [run_worker(*jobs[0])]
+    else:
+        with mp.get_context("spawn").Pool(processes) as pool:
+            parts = pool.starmap(run_worker, jobs)
+    wall = time.perf_counter() - t0
+
+    calls = dict(fake.calls)
+    fake.stop()
+
+    timings = [t for p in parts for t in p["timings"]]
+    first_paint = [t for p in parts for t in p["first_paint"]]
+    state_bytes = [b for p in parts for b in p["state_bytes"]]
+    errors = [e for p in parts for e in p["errors"]]
+    total_calls = sum(calls.values())
+    return {
+        "students": n_students,
+        "mode": mode,
+        "papers": papers,
+        "processes": processes,
+        "latency_ms": latency_ms,
+        "bank_size": bank_size,
+        "wall_s": round(wall, 2),
+        "reruns": len(timings),
+        "first_paint_p50_ms": round(_pct(first_paint, 50) * 1000, 1),
+        "first_paint_max_ms": round(max(first_paint, default=0) * 1000, 1),
+        "rerun_p50_ms": round(_pct(timings, 50) * 1000, 1),
+        "rerun_p95_ms": round(_pct(timings, 95) * 1000, 1),
+        "rerun_max_ms": round(max(timings, default=0) * 1000, 1),
+        "db_calls_per_student": round(total_calls / n_students, 1),
+        "db_calls": {f"{m} {r}": c for (m, r), c in sorted(calls.items())},
+        "session_state_kb": round(statistics.mean(state_bytes) / 1024, 1) if state_bytes else 0,
+        "rss_mb_per_student": round(sum(p["rss_delta"] for p in parts) / n_students / 1024 / 1024, 2),
+        "errors": len(errors),
+        "first_errors": errors[:5],
+    }
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--students", type=int, nargs="+", default=[50, 200, 500])
+    p.add_argument("--latency-ms", type=float, default=20.0, help="latenza iniettata per richiesta DB")
+    p.add_argument("--bank-size", type=int, default=5000)
+    p.add_argument("--processes", type=int, default=1, help="istanze dell'app in parallelo")
+    p.add_argument("--timeout", type=float, default=120.0, help="timeout per singolo rerun (s)")
+    p.add_argument("--mode", choices=["exam", "radio"], default="exam", help="modalità di risposta simulata")
+    p.add_argument("--papers", type=int, default=0, help="fogli d'esame preparati prima del test")
+    p.add_argument("--json", help="salva i risultati anche in questo file")
+    args = p.parse_args(argv)
+
+    results = []
+    for n in args.students:
+        res = run_level(n, args.latency_ms, args.bank_size, args.processes, args.timeout, args.mode, args.papers)
+        results.append(res)
+        print(
+            f"{n:>4} studenti | login p50 {res['first_paint_p50_ms']:>7.1f} ms | "
+            f"rerun p50 {res['rerun_p50_ms']:>7.1f} ms  p95 {res['rerun_p95_ms']:>7.1f} ms | "
+            f"DB/studente {res['db_calls_per_student']:>5.1f} | stato {res['session_state_kb']:>6.1f} KB | "
+            f"RSS/studente {res['rss_mb_per_student']:>5.2f} MB | errori {res['errors']} | {res['wall_s']} s",
+            flush=True,
+        )
+        for call, count in res["db_calls"].items():
+            print(f"       {call:<28} {count / n:>6.2f} per studente")
+        for err in res["first_errors"]:
+            print(f"       ! {err}")
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,452 @@
+"""
+Materiali di studio (PDF): elenco documenti, download in cache locale,
+indice di ricerca full-text per pagina/articolo e rendering delle singole
+pagine per il lettore integrato.
+
+L'indice si può costruire offline, una volta, e salvare su disco:
+
+    python study_pdf.py                                   # scarica i PDF e crea data/study_index.json.gz
+    python study_pdf.py --pdf cds=/percorso/cds.pdf       # usa un file locale per un documento
+
+L'app carica il file JSON compresso (nessun parsing dei PDF all'avvio); se manca,
+lo costruisce in background alla prima ricerca dai PDF scaricati in .cache/study
+e lo salva lì per i riavvii successivi (LazyStudyIndex).
+"""
+import io
+import argparse
+import gzip
+import json
+import math
+import os
+import re
+import tempfile
+import threading
+import time
+import unicodedata
+import urllib.request
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+BASE_DIR = Path(__file__).parent
+STUDY_INDEX_PATH = BASE_DIR / "data" / "study_index.json.gz"
+STUDY_CACHE_DIR = BASE_DIR / ".cache" / "study"
+STUDY_INDEX_CACHE_PATH = STUDY_CACHE_DIR / "study_index.json.gz"
+STUDY_INDEX_VERSION = 1
+STUDY_INDEX_RETRY_SECONDS = 60  # attesa prima di ritentare una costruzione fallita
+
+STUDY_DOCS = [
+    {
+        "id": "legge_quadro",
+        "title": "LEGGE QUADRO (Legge 7 marzo 1986, n. 65)",
+        "url": "https://sjeztkpspxzxyctfjsyg.supabase.co/storage/v1/object/public/study/legge%20quadro%20completa.pdf",
+    },
+    {
+        "id": "cds",
+        "title": "CODICE DELLA STRADA (D.Lgs. 30 aprile 1992, n. 285)",
+        "url": "https://sjeztkpspxzxyctfjsyg.supabase.co/storage/v1/object/public/study/cds%20completo.pdf",
+    },
+]
+STUDY_DOCS_BY_ID = {d["id"]: d for d in STUDY_DOCS}
+
+# parole troppo comuni per essere utili nella ricerca
+STOPWORDS = set(
+    """
+    a ad al alla alle agli ai all con col da dal dalla dalle dai dagli dell della delle dei degli del di
+    e ed il in la le lo gli i nel nella nelle nei negli nello o od per su sul sulla sulle sui un una uno
+    che chi cui non piu se si sono essere ha hanno come anche ovvero nonche tra fra
+    """.split()
+)
+
+# "Art. 186", "Articolo 186-bis", "ART 126 bis" a inizio riga
+ARTICLE_RE = re.compile(
+    r"^\s*art(?:icolo)?\.?\s*(\d+(?:[\s-]?(?:bis|ter|quater|quinquies|sexies|septies|octies|novies|decies))?)\b",
+    re.IGNORECASE | re.MULTILINE,
+)
+# richiesta di un articolo preciso nella query ("art 186", "articolo 126-bis")
+QUERY_ARTICLE_RE = re.compile(
+    r"\bart(?:icolo)?\.?\s*(\d+(?:[\s-]?(?:bis|ter|quater|quinquies|sexies|septies|octies|novies|decies))?)\b",
+    re.IGNORECASE,
+)
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+SNIPPET_CHARS = 240
+
+
+def _fold(text: str) -> str:
+    # minuscolo senza accenti: "Velocità" -> "velocita"
+    nfkd = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in nfkd if not unicodedata.combining(c))
+
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in re.findall(r"[a-z0-9]+", _fold(text)) if t not in STOPWORDS and (len(t) > 1 or t.isdigit())]
+
+
+def _norm_article(label: str) -> str:
+    return re.sub(r"[\s-]+", "-", label.strip().lower())
+
+
+# =========================================================
+# PDF IN CACHE LOCALE
+# =========================================================
+_download_locks: Dict[str, threading.Lock] = defaultdict(threading.Lock)
+_download_locks_guard = threading.Lock()
+
+
+def ensure_pdf(doc_id: str, cache_dir: Path = STUDY_CACHE_DIR) -> Path:
+    """
+    Scarica il PDF una sola volta in cache_dir e ne restituisce il percorso.
+    Costruzione dell'indice e lettore possono chiederlo insieme: un lock per file
+    nel processo, e un file temporaneo per download tra processi diversi.
+    """
+    path = cache_dir / f"{doc_id}.pdf"
+    if path.exists():
+        return path
+    with _download_locks_guard:
+        lock = _download_locks[str(path)]
+    with lock:
+        if path.exists():
+            return path  # scaricato da un altro thread nel frattempo
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(prefix=f"{doc_id}.", suffix=".part", dir=cache_dir)
+        tmp = Path(tmp_name)
+        try:
+            with os.fdopen(fd, "wb") as f, urllib.request.urlopen(STUDY_DOCS_BY_ID[doc_id]["url"], timeout=120) as r:
+                while True:
+                    chunk = r.read(1 << 16)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+            if not path.exists():
+                tmp.replace(path)
+        finally:
+            tmp.unlink(missing_ok=True)
+    return path
+
+
+# =========================================================
+# COSTRUZIONE INDICE (OFFLINE)
+# =========================================================
+def extract_pages(pdf_path: Path) -> List[str]:
+    import pymupdf  # PyMuPDF (solo per la costruzione offline)
+
+    with pymupdf.open(pdf_path) as pdf:
+        return [page.get_text("text") for page in pdf]
+
+
+def build_index(pdf_paths: Dict[str, Path]) -> Dict:
+    """
+    Una unità di ricerca per pagina: testo, articoli che iniziano nella pagina
+    (o quello in corso, se la pagina ne è la continuazione) e indice invertito
+    token -> [[unità, frequenza], ...] per il ranking BM25.
+    """
+    docs, units, lengths = {}, [], []
+    postings: Dict[str, List[List[int]]] = defaultdict(list)
+
+    for doc_id, path in pdf_paths.items():
+        pages = extract_pages(path)
+        docs[doc_id] = {"title": STUDY_DOCS_BY_ID[doc_id]["title"], "pages": len(pages)}
+        current_article = None
+        for page_no, text in enumerate(pages, start=1):
+            found = [_norm_article(m) for m in ARTICLE_RE.findall(text)]
+            articles = found or ([current_article] if current_article else [])
+            if found:
+                current_article = found[-1]
+
+            unit = len(units)
+            units.append({"doc": doc_id, "page": page_no, "articles": articles, "starts": found, "text": text})
+            tokens = tokenize(text)
+            lengths.append(len(tokens))
+            for tok, tf in Counter(tokens).items():
+                postings[tok].append([unit, tf])
+
+    return {
+        "version": STUDY_INDEX_VERSION,
+        "docs": docs,
+        "units": units,
+        "lengths": lengths,
+        "postings": postings,
+    }
+
+
+def save_index(index: Dict, path: Path = STUDY_INDEX_PATH) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False, separators=(",", ":"))
+
+
+# =========================================================
+# RICERCA (USATA DALL'APP)
+# =========================================================
+class StudyIndex:
+    """Indice caricato dal file JSON compresso; search() restituisce i risultati ordinati."""
+
+    def __init__(self, data: Dict):
+        self.docs = data["docs"]
+        self.units = data["units"]
+        self.lengths = data["lengths"]
+        self.postings = data["postings"]
+        self.avg_len = (sum(self.lengths) / len(self.lengths)) if self.lengths else 1.0
+        self.by_article: Dict[str, List[int]] = defaultdict(list)
+        for i, u in enumerate(self.units):
+            for a in u.get("starts", []):
+                self.by_article[a].append(i)
+
+    @classmethod
+    def load(cls, path: Path = STUDY_INDEX_PATH) -> "StudyIndex":
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") != STUDY_INDEX_VERSION:
+            raise ValueError(f"Indice {path} in formato non supportato: rigeneralo con python study_pdf.py")
+        return cls(data)
+
+    def _bm25(self, tokens: List[str]) -> Dict[int, float]:
+        n = len(self.units)
+        scores: Dict[int, float] = defaultdict(float)
+        for tok in set(tokens):
+            plist = self.postings.get(tok)
+            if not plist:
+                continue
+            idf = math.log(1 + (n - len(plist) + 0.5) / (len(plist) + 0.5))
+            for unit, tf in plist:
+                norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[unit] / self.avg_len)
+                scores[unit] += idf * tf * (BM25_K1 + 1) / norm
+        return scores
+
+    def snippet(self, unit: int, query: str) -> str:
+        text = " ".join(self.units[unit]["text"].split())
+        folded = _fold(text)  # stessa lunghezza del testo per i caratteri latini usati nei PDF
+        pos = -1
+        for tok in sorted(tokenize(query), key=len, reverse=True):
+            pos = folded.find(tok)
+            if pos >= 0:
+                break
+        start = max(0, pos - SNIPPET_CHARS // 3) if pos >= 0 else 0
+        out = text[start:start + SNIPPET_CHARS]
+        return ("…" if start > 0 else "") + out + ("…" if start + SNIPPET_CHARS < len(text) else "")
+
+    def search(self, query: str, limit: int = 10, doc_id: str | None = None) -> List[Dict]:
+        scores = self._bm25(tokenize(query))
+
+        # "art. 186": le pagine dove inizia l'articolo vanno in cima
+        for label in QUERY_ARTICLE_RE.findall(query):
+            for unit in self.by_article.get(_norm_article(label), []):
+                scores[unit] += 1000.0
+
+        ranked = sorted(
+            (u for u in scores if doc_id is None or self.units[u]["doc"] == doc_id),
+            key=lambda u: scores[u],
+            reverse=True,
+        )[:limit]
+        hits = []
+        for u in ranked:
+            unit = self.units[u]
+            hits.append(
+                {
+                    "doc": unit["doc"],
+                    "title": self.docs[unit["doc"]]["title"],
+                    "page": unit["page"],
+                    "articles": unit["articles"],
+                    "score": round(scores[u], 3),
+                    "snippet": self.snippet(u, query),
+                }
+            )
+        return hits
+
+
+class LazyStudyIndex:
+    """
+    Indice per l'app, caricato alla prima ricerca: file pubblicato (data/), altrimenti
+    quello già costruito in cache, altrimenti costruito in un thread dai PDF in cache
+    (scaricati con ensure_pdf) e salvato in cache_dir. get() non blocca mai.
+    """
+
+    def __init__(self, path: Path = STUDY_INDEX_PATH, cache_dir: Path = STUDY_CACHE_DIR):
+        self.paths = [path, cache_dir / STUDY_INDEX_CACHE_PATH.name]
+        self.cache_dir = cache_dir
+        self.index: StudyIndex | None = None
+        self.error: str | None = None
+        self._failed_ts = 0.0
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def _build(self) -> None:
+        try:
+            index = None
+            for path in self.paths:
+                if path.exists():
+                    try:
+                        index = StudyIndex.load(path)
+                        break
+                    except ValueError:
+                        continue  # formato vecchio: si ricostruisce
+            if index is None:
+                data = build_index({d["id"]: ensure_pdf(d["id"], self.cache_dir) for d in STUDY_DOCS})
+                save_index(data, self.paths[-1])
+                index = StudyIndex(data)
+            self.index, self.error = index, None
+        except Exception as e:
+            self.error = str(e)
+            self._failed_ts = time.time()
+
+    def get(self) -> StudyIndex | None:
+        """Indice pronto, oppure None (costruzione avviata o in corso; errore in self.error)."""
+        if self.index is not None:
+            return self.index
+        with self._lock:
+            running = self._thread is not None and self._thread.is_alive()
+            retry = self.error is None or time.time() - self._failed_ts >= STUDY_INDEX_RETRY_SECONDS
+            if self.index is None and not running and retry:
+                self._thread = threading.Thread(target=self._build, name="study-index", daemon=True)
+                self._thread.start()
+        return self.index
+
+    @property
+    def building(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+
+# =========================================================
+# RENDERING PAGINE (LETTORE INTEGRATO)
+# =========================================================
+PAGE_RENDER_DPI = 110
+PAGE_WEBP_QUALITY = 60
+PAGE_MEMORY_BYTES = 32 * 1024 * 1024
+PAGE_DISK_BYTES = 256 * 1024 * 1024
+PAGE_PREFETCH = 1  # pagine adiacenti (prima e dopo) preparate in background
+
+
+class PageRenderer:
+    """
+    Rende una pagina alla volta (WebP compressa o testo) dal PDF in cache locale.
+    Cache a due livelli, entrambe LRU limitate in byte: memoria del processo e
+    file su disco (sopravvive ai riavvii). Così lo studente scarica una pagina,
+    non l'intero PDF.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path = STUDY_CACHE_DIR,
+        memory_bytes: int = PAGE_MEMORY_BYTES,
+        disk_bytes: int = PAGE_DISK_BYTES,
+    ):
+        self.cache_dir = cache_dir
+        self.pages_dir = cache_dir / "pages"
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._mem: "OrderedDict[Tuple[str, int, str], bytes]" = OrderedDict()
+        self._mem_size = 0
+        self._docs: Dict[str, object] = {}
+        self._lock = threading.Lock()      # cache in memoria / su disco
+        self._pdf_lock = threading.Lock()  # i documenti PyMuPDF non sono thread-safe
+        self._prefetch = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pdf-prefetch")
+        self._disk_size = sum(f.stat().st_size for f in self.pages_dir.rglob("*") if f.is_file()) if self.pages_dir.exists() else 0
+
+    def _doc(self, doc_id: str):
+        import pymupdf
+
+        doc = self._docs.get(doc_id)
+        if doc is None:
+            doc = self._docs[doc_id] = pymupdf.open(ensure_pdf(doc_id, self.cache_dir))
+        return doc
+
+    def page_count(self, doc_id: str) -> int:
+        with self._pdf_lock:
+            return self._doc(doc_id).page_count
+
+    def _render(self, doc_id: str, page: int, kind: str) -> bytes:
+        with self._pdf_lock:
+            pg = self._doc(doc_id)[page - 1]
+            if kind == "text":
+                return pg.get_text("text").encode("utf-8")
+            pix = pg.get_pixmap(dpi=PAGE_RENDER_DPI)
+            mode, size, samples = ("RGBA" if pix.alpha else "RGB"), (pix.width, pix.height), pix.samples
+
+        from PIL import Image
+
+        buf = io.BytesIO()
+        Image.frombytes(mode, size, samples).save(buf, format="WEBP", quality=PAGE_WEBP_QUALITY, method=4)
+        return buf.getvalue()
+
+    def _disk_path(self, doc_id: str, page: int, kind: str) -> Path:
+        ext = "txt" if kind == "text" else "webp"
+        return self.pages_dir / doc_id / f"{page:05d}_{PAGE_RENDER_DPI}.{ext}"
+
+    def _remember(self, key, data: bytes) -> None:
+        # chiamata con self._lock acquisito
+        if key in self._mem:
+            self._mem_size -= len(self._mem.pop(key))
+        self._mem[key] = data
+        self._mem_size += len(data)
+        while self._mem_size > self.memory_bytes and len(self._mem) > 1:
+            _, old = self._mem.popitem(last=False)
+            self._mem_size -= len(old)
+
+    def _store(self, path: Path, data: bytes) -> None:
+        # chiamata con self._lock acquisito; elimina i file usati meno di recente
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".part")
+        tmp.write_bytes(data)
+        tmp.replace(path)
+        self._disk_size += len(data)
+        if self._disk_size <= self.disk_bytes:
+            return
+        files = sorted((f for f in self.pages_dir.rglob("*") if f.is_file() and f != path), key=lambda f: f.stat().st_mtime)
+        for f in files:
+            if self._disk_size <= self.disk_bytes:
+                break
+            self._disk_size -= f.stat().st_size
+            f.unlink(missing_ok=True)
+
+    def get(self, doc_id: str, page: int, kind: str = "image") -> bytes:
+        """Pagina `page` (da 1) come WebP (kind="image") o testo UTF-8 (kind="text")."""
+        key = (doc_id, page, kind)
+        path = self._disk_path(doc_id, page, kind)
+        with self._lock:
+            data = self._mem.get(key)
+            if data is not None:
+                self._mem.move_to_end(key)
+                return data
+            if path.exists():
+                data = path.read_bytes()
+                path.touch()  # aggiorna l'ordine LRU su disco
+                self._remember(key, data)
+                return data
+
+        data = self._render(doc_id, page, kind)
+        with self._lock:
+            if not path.exists():
+                self._store(path, data)
+            self._remember(key, data)
+        return data
+
+    def prefetch(self, doc_id: str, page: int, kind: str = "image") -> None:
+        """Prepara in background le pagine adiacenti (avanti prima, poi indietro)."""
+        total = self.page_count(doc_id)
+        for delta in [d for k in range(1, PAGE_PREFETCH + 1) for d in (k, -k)]:
+            p = page + delta
+            if 1 <= p <= total:
+                with self._lock:
+                    cached = (doc_id, p, kind) in self._mem or self._disk_path(doc_id, p, kind).exists()
+                if not cached:
+                    self._prefetch.submit(self.get, doc_id, p, kind)
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Costruisce l'indice di ricerca dei PDF di studio.")
+    p.add_argument("--pdf", action="append", default=[], metavar="DOC_ID=PERCORSO", help="usa un PDF locale")
+    p.add_argument("--out", type=Path, default=STUDY_INDEX_PATH)
+    args = p.parse_args(argv)
+
+    local = dict(item.split("=", 1) for item in args.pdf)
+    paths = {d["id"]: Path(local[d["id"]]) if d["id"] in local else ensure_pdf(d["id"]) for d in STUDY_DOCS}
+    index = build_index(paths)
+    save_index(index, args.out)
+    print(f"Indice salvato in {args.out}: {len(index['units'])} pagine, {len(index['postings'])} termini")
+
+
+if __name__ == "__main__":
+    main()
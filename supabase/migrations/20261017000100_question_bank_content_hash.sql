@@ -0,0 +1,37 @@
+-- Hash di contenuto normalizzato per question_bank: import idempotenti (upsert su content_hash).
+-- La normalizzazione replica question_hash() in app.py:
+--   spazi (solo spazio, tab, a capo, \f, \v: non NBSP) compressi e tolti ai bordi + minuscolo su testo
+--   e opzioni, lettera corretta senza spazi ai bordi e maiuscola,
+--   campi uniti con il separatore chr(31), sha256 in esadecimale.
+
+alter table question_bank add column if not exists content_hash text;
+
+create or replace function question_bank_norm(t text) returns text
+language sql immutable as $$
+  -- prima si comprimono gli spazi (anche tab e a capo), poi si tolgono ai bordi, come _norm_text
+  -- in app.py: insieme esplicito (CSV_WHITESPACE), non \s, che dipende dal locale per NBSP & co.
+  select lower(btrim(regexp_replace(coalesce(t, ''), '[ \t\n\r\f\v]+', ' ', 'g')))
+$$;
+
+update question_bank
+set content_hash = encode(
+  sha256(convert_to(concat_ws(chr(31),
+    question_bank_norm(question_text),
+    question_bank_norm(option_a),
+    question_bank_norm(option_b),
+    question_bank_norm(option_c),
+    question_bank_norm(option_d),
+    upper(btrim(coalesce(correct_option, ''), E' \t\n\r\f\v'))
+  ), 'UTF8')),
+  'hex'
+)
+where content_hash is null;
+
+-- i doppioni già presenti (stesso contenuto caricato più volte) tengono solo la riga più vecchia;
+-- quiz_answers copia il testo delle domande, quindi nessuna sessione li referenzia
+delete from question_bank q
+using question_bank older
+where q.content_hash = older.content_hash
+  and q.id > older.id;
+
+create unique index if not exists question_bank_content_hash_key on question_bank (content_hash);
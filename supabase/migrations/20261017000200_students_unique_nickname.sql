@@ -0,0 +1,23 @@
+-- Login con un solo upsert atomico su (class_code, nickname).
+-- Prima accorpa gli eventuali doppioni creati dal vecchio SELECT + INSERT:
+-- le sessioni passano allo studente più vecchio, poi i doppioni vengono rimossi.
+
+update sessions s
+set student_id = keep.id
+from students dup
+join lateral (
+  select min(k.id) as id
+  from students k
+  where k.class_code = dup.class_code and k.nickname = dup.nickname
+) keep on true
+where s.student_id = dup.id
+  and dup.id <> keep.id;
+
+delete from students dup
+using students keep
+where dup.class_code = keep.class_code
+  and dup.nickname = keep.nickname
+  and dup.id > keep.id;
+
+alter table students
+  add constraint students_class_code_nickname_key unique (class_code, nickname);
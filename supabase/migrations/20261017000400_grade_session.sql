@@ -0,0 +1,47 @@
+-- Correzione lato DB, eseguita una volta alla chiusura della sessione (Termina o tempo scaduto).
+-- Salva l'esito per domanda (quiz_answers.is_correct) e il riepilogo sulla riga sessions,
+-- così la pagina risultati (e ogni storico/classifica) legge solo il riepilogo.
+
+alter table sessions add column if not exists score int;
+alter table sessions add column if not exists answered int;
+alter table sessions add column if not exists graded_at timestamptz;
+
+alter table quiz_answers add column if not exists is_correct boolean;
+
+create or replace function grade_session(p_session_id uuid)
+returns json
+language plpgsql
+as $$
+declare
+  v_session sessions;
+begin
+  update quiz_answers
+  set is_correct = (chosen_option is not null and chosen_option = correct_option)
+  where session_id = p_session_id;
+
+  update sessions s
+  set
+    score = g.score,
+    answered = g.answered,
+    finished_at = coalesce(s.finished_at, now()),
+    graded_at = now()
+  from (
+    select
+      count(*) filter (where is_correct) as score,
+      count(*) filter (where chosen_option is not null) as answered
+    from quiz_answers
+    where session_id = p_session_id
+  ) g
+  where s.id = p_session_id
+  returning s.* into v_session;
+
+  return json_build_object(
+    'id', v_session.id,
+    'score', v_session.score,
+    'answered', v_session.answered,
+    'n_questions', v_session.n_questions,
+    'started_at', v_session.started_at,
+    'finished_at', v_session.finished_at
+  );
+end;
+$$;
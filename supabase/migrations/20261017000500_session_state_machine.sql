@@ -0,0 +1,130 @@
+-- Stato della simulazione salvato su sessions (fonte di verità per tutte le repliche):
+--   in_progress -> finished (corretta, risultati visibili) -> closed (tornato al menu).
+-- La scadenza si calcola da started_at + duration_seconds, mai dall'orologio della replica.
+
+alter table sessions add column if not exists status text not null default 'in_progress';
+alter table sessions add column if not exists duration_seconds int not null default 1800;
+
+update sessions set status = 'closed' where finished_at is not null and status = 'in_progress';
+
+create index if not exists sessions_student_status_idx on sessions (student_id, status);
+
+-- start_session riceve ora anche la durata: nuova firma, quindi si elimina la precedente
+drop function if exists start_session(bigint, bigint[], text, text);
+
+create or replace function start_session(
+  p_student_id bigint,
+  p_question_ids bigint[],
+  p_duration_seconds int default 1800,
+  p_mode text default 'sim',
+  p_topic_scope text default 'bank'
+)
+returns json
+language plpgsql
+as $$
+declare
+  v_session sessions;
+  v_requested int := coalesce(array_length(p_question_ids, 1), 0);
+  v_inserted int;
+begin
+  if v_requested = 0 then
+    raise exception 'start_session: nessuna domanda richiesta';
+  end if;
+
+  insert into sessions (
+    student_id, mode, topic_scope, selected_topic_id, n_questions,
+    started_at, duration_seconds, status
+  )
+  values (
+    p_student_id, p_mode, p_topic_scope, null, v_requested,
+    now(), p_duration_seconds, 'in_progress'
+  )
+  returning * into v_session;
+
+  insert into quiz_answers (
+    session_id, topic_id, question_text,
+    option_a, option_b, option_c, option_d,
+    correct_option, chosen_option, explanation
+  )
+  select
+    v_session.id,
+    null,
+    btrim(coalesce(q.question_text, '')),
+    btrim(coalesce(q.option_a, '')),
+    btrim(coalesce(q.option_b, '')),
+    btrim(coalesce(q.option_c, '')),
+    btrim(coalesce(q.option_d, '')),
+    case
+      when upper(btrim(coalesce(q.correct_option, ''))) = 'D' and btrim(coalesce(q.option_d, '')) = '' then
+        case
+          when btrim(coalesce(q.option_c, '')) <> '' then 'C'
+          when btrim(coalesce(q.option_b, '')) <> '' then 'B'
+          else 'A'
+        end
+      when upper(btrim(coalesce(q.correct_option, ''))) in ('A', 'B', 'C', 'D') then
+        upper(btrim(q.correct_option))
+      else 'A'
+    end,
+    null,
+    btrim(coalesce(q.explanation, ''))
+  from unnest(p_question_ids) with ordinality as p(question_id, pos)
+  join question_bank q on q.id = p.question_id
+  order by p.pos;
+
+  get diagnostics v_inserted = row_count;
+  if v_inserted < v_requested then
+    raise exception 'start_session: domande mancanti in question_bank (% su %)', v_inserted, v_requested
+      using errcode = 'QB001';
+  end if;
+
+  return json_build_object(
+    'session', row_to_json(v_session),
+    'questions', (
+      select coalesce(json_agg(a order by a.id), '[]'::json)
+      from quiz_answers a
+      where a.session_id = v_session.id
+    )
+  );
+end;
+$$;
+
+create or replace function grade_session(p_session_id uuid)
+returns json
+language plpgsql
+as $$
+declare
+  v_session sessions;
+begin
+  update quiz_answers
+  set is_correct = (chosen_option is not null and chosen_option = correct_option)
+  where session_id = p_session_id;
+
+  update sessions s
+  set
+    score = g.score,
+    answered = g.answered,
+    finished_at = coalesce(s.finished_at, now()),
+    graded_at = now(),
+    status = case when s.status = 'closed' then 'closed' else 'finished' end
+  from (
+    select
+      count(*) filter (where is_correct) as score,
+      count(*) filter (where chosen_option is not null) as answered
+    from quiz_answers
+    where session_id = p_session_id
+  ) g
+  where s.id = p_session_id
+  returning s.* into v_session;
+
+  return json_build_object(
+    'id', v_session.id,
+    'status', v_session.status,
+    'score', v_session.score,
+    'answered', v_session.answered,
+    'n_questions', v_session.n_questions,
+    'started_at', v_session.started_at,
+    'duration_seconds', v_session.duration_seconds,
+    'finished_at', v_session.finished_at
+  );
+end;
+$$;
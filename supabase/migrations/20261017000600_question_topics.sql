@@ -0,0 +1,92 @@
+-- Argomenti delle domande: tabella topics (nome unico, usato dall'import CSV)
+-- e argomento opzionale su question_bank. start_session salva l'argomento scelto
+-- sulla sessione e copia quello di ogni domanda su quiz_answers.topic_id.
+
+create table if not exists topics (
+  id bigint generated by default as identity primary key,
+  name text not null
+);
+create unique index if not exists topics_name_key on topics (name);
+
+alter table question_bank add column if not exists topic_id bigint references topics (id) on delete set null;
+create index if not exists question_bank_topic_idx on question_bank (topic_id);
+
+-- nuova firma (p_topic_id): si elimina la precedente
+drop function if exists start_session(bigint, bigint[], int, text, text);
+
+create or replace function start_session(
+  p_student_id bigint,
+  p_question_ids bigint[],
+  p_duration_seconds int default 1800,
+  p_mode text default 'sim',
+  p_topic_scope text default 'bank',
+  p_topic_id bigint default null
+)
+returns json
+language plpgsql
+as $$
+declare
+  v_session sessions;
+  v_requested int := coalesce(array_length(p_question_ids, 1), 0);
+  v_inserted int;
+begin
+  if v_requested = 0 then
+    raise exception 'start_session: nessuna domanda richiesta';
+  end if;
+
+  insert into sessions (
+    student_id, mode, topic_scope, selected_topic_id, n_questions,
+    started_at, duration_seconds, status
+  )
+  values (
+    p_student_id, p_mode, p_topic_scope, p_topic_id, v_requested,
+    now(), p_duration_seconds, 'in_progress'
+  )
+  returning * into v_session;
+
+  insert into quiz_answers (
+    session_id, topic_id, question_text,
+    option_a, option_b, option_c, option_d,
+    correct_option, chosen_option, explanation
+  )
+  select
+    v_session.id,
+    q.topic_id,
+    btrim(coalesce(q.question_text, '')),
+    btrim(coalesce(q.option_a, '')),
+    btrim(coalesce(q.option_b, '')),
+    btrim(coalesce(q.option_c, '')),
+    btrim(coalesce(q.option_d, '')),
+    case
+      when upper(btrim(coalesce(q.correct_option, ''))) = 'D' and btrim(coalesce(q.option_d, '')) = '' then
+        case
+          when btrim(coalesce(q.option_c, '')) <> '' then 'C'
+          when btrim(coalesce(q.option_b, '')) <> '' then 'B'
+          else 'A'
+        end
+      when upper(btrim(coalesce(q.correct_option, ''))) in ('A', 'B', 'C', 'D') then
+        upper(btrim(q.correct_option))
+      else 'A'
+    end,
+    null,
+    btrim(coalesce(q.explanation, ''))
+  from unnest(p_question_ids) with ordinality as p(question_id, pos)
+  join question_bank q on q.id = p.question_id
+  order by p.pos;
+
+  get diagnostics v_inserted = row_count;
+  if v_inserted < v_requested then
+    raise exception 'start_session: domande mancanti in question_bank (% su %)', v_inserted, v_requested
+      using errcode = 'QB001';  -- riconosciuto da start_session_from_paper
+  end if;
+
+  return json_build_object(
+    'session', row_to_json(v_session),
+    'questions', (
+      select coalesce(json_agg(a order by a.id), '[]'::json)
+      from quiz_answers a
+      where a.session_id = v_session.id
+    )
+  );
+end;
+$$;
@@ -0,0 +1,47 @@
+-- Chiusura delle simulazioni scadute e abbandonate (scheda chiusa prima della consegna).
+-- sweep_expired_sessions corregge a blocchi le sessioni in_progress oltre
+-- started_at + duration_seconds (+ margine per la consegna automatica del browser)
+-- e imposta finished_at alla scadenza.
+-- Idempotente; più repliche possono chiamarla insieme (FOR UPDATE SKIP LOCKED).
+-- La chiamano l'app (thread in background) oppure sweeper.py / pg_cron, ad esempio:
+--   select cron.schedule('sweep-expired-sessions', '* * * * *', 'select sweep_expired_sessions()');
+
+create index if not exists sessions_in_progress_started_idx
+  on sessions (started_at)
+  where status = 'in_progress';
+
+create or replace function sweep_expired_sessions(
+  p_limit int default 200,
+  p_grace_seconds int default 120
+)
+returns json
+language plpgsql
+as $$
+declare
+  v_ids uuid[];
+  v_id uuid;
+begin
+  select array_agg(e.id) into v_ids
+  from (
+    select s.id
+    from sessions s
+    where s.status = 'in_progress'
+      and s.started_at + make_interval(secs => s.duration_seconds + p_grace_seconds) < now()
+    order by s.started_at
+    limit p_limit
+    for update skip locked
+  ) e;
+
+  foreach v_id in array coalesce(v_ids, '{}'::uuid[]) loop
+    update sessions
+    set finished_at = coalesce(finished_at, started_at + make_interval(secs => duration_seconds))
+    where id = v_id;
+    perform grade_session(v_id);
+  end loop;
+
+  return json_build_object(
+    'finalized', coalesce(array_length(v_ids, 1), 0),
+    'ids', coalesce(to_json(v_ids), '[]'::json)
+  );
+end;
+$$;
@@ -0,0 +1,74 @@
+-- Fogli d'esame preparati dal docente prima della lezione: liste di id domanda
+-- già sorteggiate. All'avvio lo studente prende un foglio libero (una riga,
+-- FOR UPDATE SKIP LOCKED) invece di sorteggiare: tempo di avvio costante
+-- anche quando tutta la classe clicca "Inizia simulazione" insieme.
+
+create table if not exists exam_papers (
+  id bigint generated by default as identity primary key,
+  question_ids bigint[] not null,
+  n_questions int not null,
+  topic_id bigint references topics (id) on delete cascade,
+  balanced boolean not null default false,
+  created_at timestamptz not null default now(),
+  claimed_at timestamptz,
+  student_id bigint,
+  session_id uuid
+);
+
+create index if not exists exam_papers_unclaimed_idx
+  on exam_papers (n_questions, topic_id, balanced, id)
+  where claimed_at is null;
+
+-- Ritorna lo stesso json di start_session, oppure null se non ci sono fogli adatti
+-- (l'app allora sorteggia come prima).
+create or replace function start_session_from_paper(
+  p_student_id bigint,
+  p_n_questions int,
+  p_duration_seconds int default 1800,
+  p_topic_id bigint default null,
+  p_balanced boolean default false
+)
+returns json
+language plpgsql
+as $$
+declare
+  v_paper exam_papers;
+  v_result json;
+begin
+  loop
+    select * into v_paper
+    from exam_papers
+    where claimed_at is null
+      and n_questions = p_n_questions
+      and topic_id is not distinct from p_topic_id
+      and balanced = p_balanced
+    order by id
+    limit 1
+    for update skip locked;
+
+    if not found then
+      return null;
+    end if;
+
+    begin
+      v_result := start_session(
+        p_student_id, v_paper.question_ids, p_duration_seconds, 'sim',
+        case when p_topic_id is null then 'bank' else 'topic' end, p_topic_id
+      );
+    exception when sqlstate 'QB001' then
+      -- foglio non più valido (domanda eliminata): lo si scarta e si prova il successivo;
+      -- ogni altro errore (lock, timeout, serializzazione) risale e il foglio resta libero
+      update exam_papers set claimed_at = now() where id = v_paper.id;
+      continue;
+    end;
+
+    update exam_papers
+    set claimed_at = now(),
+        student_id = p_student_id,
+        session_id = (v_result -> 'session' ->> 'id')::uuid
+    where id = v_paper.id;
+
+    return v_result;
+  end loop;
+end;
+$$;
@@ -0,0 +1,126 @@
+-- quiz_answers compatta: ogni riga referenzia la domanda (question_id, position) invece di
+-- copiarne testo, opzioni e spiegazione. Il contenuto si legge da question_bank
+-- (in app.py da una cache di processo: il testo di una domanda non cambia, perché
+-- l'import lavora per content_hash). Restano sulla riga solo la risposta data e la
+-- lettera corretta al momento dell'avvio, usata da grade_session.
+
+alter table quiz_answers add column if not exists question_id bigint references question_bank (id);
+alter table quiz_answers add column if not exists position int;
+create index if not exists quiz_answers_question_idx on quiz_answers (question_id);
+
+-- righe esistenti: posizione = ordine di inserimento nella sessione
+update quiz_answers a
+set position = p.pos
+from (
+  select id, row_number() over (partition by session_id order by id) as pos
+  from quiz_answers
+  where position is null
+) p
+where a.id = p.id;
+
+-- righe esistenti: domanda ritrovata per testo e opzioni normalizzati (non per content_hash,
+-- che include la lettera corretta: la copia poteva averla riscritta). A parità di contenuto
+-- vince la domanda più vecchia.
+update quiz_answers a
+set question_id = m.question_id
+from (
+  select a2.id as answer_id, min(q.id) as question_id
+  from quiz_answers a2
+  join question_bank q
+    on question_bank_norm(q.question_text) = question_bank_norm(a2.question_text)
+   and question_bank_norm(q.option_a) = question_bank_norm(a2.option_a)
+   and question_bank_norm(q.option_b) = question_bank_norm(a2.option_b)
+   and question_bank_norm(q.option_c) = question_bank_norm(a2.option_c)
+   and question_bank_norm(q.option_d) = question_bank_norm(a2.option_d)
+  where a2.question_id is null
+  group by a2.id
+) m
+where a.id = m.answer_id;
+
+-- il testo copiato serve solo alle righe senza domanda (domanda eliminata dalla banca dati)
+alter table quiz_answers alter column question_text drop not null;
+alter table quiz_answers alter column option_a drop not null;
+alter table quiz_answers alter column option_b drop not null;
+alter table quiz_answers alter column option_c drop not null;
+alter table quiz_answers alter column option_d drop not null;
+alter table quiz_answers alter column explanation drop not null;
+
+update quiz_answers
+set question_text = null, option_a = null, option_b = null, option_c = null, option_d = null, explanation = null
+where question_id is not null
+  and question_text is not null;
+
+create or replace function start_session(
+  p_student_id bigint,
+  p_question_ids bigint[],
+  p_duration_seconds int default 1800,
+  p_mode text default 'sim',
+  p_topic_scope text default 'bank',
+  p_topic_id bigint default null
+)
+returns json
+language plpgsql
+as $$
+declare
+  v_session sessions;
+  v_requested int := coalesce(array_length(p_question_ids, 1), 0);
+  v_inserted int;
+begin
+  if v_requested = 0 then
+    raise exception 'start_session: nessuna domanda richiesta';
+  end if;
+
+  insert into sessions (
+    student_id, mode, topic_scope, selected_topic_id, n_questions,
+    started_at, duration_seconds, status
+  )
+  values (
+    p_student_id, p_mode, p_topic_scope, p_topic_id, v_requested,
+    now(), p_duration_seconds, 'in_progress'
+  )
+  returning * into v_session;
+
+  insert into quiz_answers (session_id, question_id, position, topic_id, correct_option, chosen_option)
+  select
+    v_session.id,
+    q.id,
+    p.pos,
+    q.topic_id,
+    case
+      when upper(btrim(coalesce(q.correct_option, ''))) = 'D' and btrim(coalesce(q.option_d, '')) = '' then
+        case
+          when btrim(coalesce(q.option_c, '')) <> '' then 'C'
+          when btrim(coalesce(q.option_b, '')) <> '' then 'B'
+          else 'A'
+        end
+      when upper(btrim(coalesce(q.correct_option, ''))) in ('A', 'B', 'C', 'D') then
+        upper(btrim(q.correct_option))
+      else 'A'
+    end,
+    null
+  from unnest(p_question_ids) with ordinality as p(question_id, pos)
+  join question_bank q on q.id = p.question_id
+  order by p.pos;
+
+  get diagnostics v_inserted = row_count;
+  if v_inserted < v_requested then
+    raise exception 'start_session: domande mancanti in question_bank (% su %)', v_inserted, v_requested
+      using errcode = 'QB001';  -- riconosciuto da start_session_from_paper
+  end if;
+
+  return json_build_object(
+    'session', row_to_json(v_session),
+    'questions', (
+      select coalesce(json_agg(json_build_object(
+        'id', a.id,
+        'question_id', a.question_id,
+        'position', a.position,
+        'correct_option', a.correct_option,
+        'chosen_option', a.chosen_option
+      ) order by a.position), '[]'::json)
+      from quiz_answers a
+      where a.session_id = v_session.id
+    )
+  );
+end;
+$$;
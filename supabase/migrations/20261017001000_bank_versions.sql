@@ -0,0 +1,212 @@
+-- Versioni della banca dati. Ogni pubblicazione (fine di un import del docente) crea una
+-- riga in bank_versions con numero crescente; le domande portano la versione in cui sono
+-- comparse (version_added) e quella dell'ultima modifica (version_changed).
+-- Le scritture su question_bank finiscono nella versione "in preparazione" (ultima
+-- pubblicata + 1) e diventano visibili insieme alla pubblicazione:
+--   snapshot V      = domande con version_added <= V
+--   novità da V a W = domande con version_changed > V (e version_added <= W)
+-- Le cache dell'app confrontano solo il numero di versione (una riga) invece di rileggere.
+-- Le sessioni e i fogli d'esame registrano la versione da cui sono state sorteggiate.
+-- Anche le modifiche fatte a mano su question_bank passano dal trigger: per renderle
+-- visibili basta `select publish_bank_version();`.
+
+create table if not exists bank_versions (
+  version bigint primary key,
+  published_at timestamptz not null default now(),
+  n_questions int not null
+);
+
+alter table question_bank add column if not exists version_added bigint;
+alter table question_bank add column if not exists version_changed bigint;
+
+-- stato attuale = versione 1
+insert into bank_versions (version, n_questions)
+select 1, count(*) from question_bank
+where not exists (select 1 from bank_versions);
+
+update question_bank
+set version_added = coalesce(version_added, 1), version_changed = coalesce(version_changed, 1)
+where version_added is null or version_changed is null;
+
+alter table question_bank alter column version_added set not null;
+alter table question_bank alter column version_changed set not null;
+create index if not exists question_bank_version_changed_idx on question_bank (version_changed);
+
+create or replace function question_bank_stamp_version() returns trigger
+language plpgsql as $$
+declare
+  v_pending bigint := (select coalesce(max(version), 0) + 1 from bank_versions);
+begin
+  new.version_changed := v_pending;
+  if tg_op = 'INSERT' then
+    new.version_added := v_pending;
+  else
+    new.version_added := old.version_added;
+  end if;
+  return new;
+end;
+$$;
+
+drop trigger if exists question_bank_stamp_version on question_bank;
+create trigger question_bank_stamp_version
+  before insert or update on question_bank
+  for each row execute function question_bank_stamp_version();
+
+-- Pubblica le modifiche in preparazione. Il lock attende le scritture in corso e blocca
+-- le nuove fino al commit: nessuna riga resta timbrata con una versione già letta dalle cache.
+create or replace function publish_bank_version()
+returns json
+language plpgsql
+as $$
+declare
+  v_row bank_versions;
+begin
+  lock table question_bank in exclusive mode;
+
+  insert into bank_versions (version, n_questions)
+  select coalesce(max(v.version), 0) + 1, (select count(*) from question_bank)
+  from bank_versions v
+  returning * into v_row;
+
+  return row_to_json(v_row);
+end;
+$$;
+
+alter table sessions add column if not exists bank_version bigint;
+alter table exam_papers add column if not exists bank_version bigint;
+
+-- nuova firma (p_bank_version): si elimina la precedente
+drop function if exists start_session(bigint, bigint[], int, text, text, bigint);
+
+create or replace function start_session(
+  p_student_id bigint,
+  p_question_ids bigint[],
+  p_duration_seconds int default 1800,
+  p_mode text default 'sim',
+  p_topic_scope text default 'bank',
+  p_topic_id bigint default null,
+  p_bank_version bigint default null
+)
+returns json
+language plpgsql
+as $$
+declare
+  v_session sessions;
+  v_requested int := coalesce(array_length(p_question_ids, 1), 0);
+  v_inserted int;
+begin
+  if v_requested = 0 then
+    raise exception 'start_session: nessuna domanda richiesta';
+  end if;
+
+  insert into sessions (
+    student_id, mode, topic_scope, selected_topic_id, n_questions,
+    started_at, duration_seconds, status, bank_version
+  )
+  values (
+    p_student_id, p_mode, p_topic_scope, p_topic_id, v_requested,
+    now(), p_duration_seconds, 'in_progress',
+    coalesce(p_bank_version, (select max(version) from bank_versions))
+  )
+  returning * into v_session;
+
+  insert into quiz_answers (session_id, question_id, position, topic_id, correct_option, chosen_option)
+  select
+    v_session.id,
+    q.id,
+    p.pos,
+    q.topic_id,
+    case
+      when upper(btrim(coalesce(q.correct_option, ''))) = 'D' and btrim(coalesce(q.option_d, '')) = '' then
+        case
+          when btrim(coalesce(q.option_c, '')) <> '' then 'C'
+          when btrim(coalesce(q.option_b, '')) <> '' then 'B'
+          else 'A'
+        end
+      when upper(btrim(coalesce(q.correct_option, ''))) in ('A', 'B', 'C', 'D') then
+        upper(btrim(q.correct_option))
+      else 'A'
+    end,
+    null
+  from unnest(p_question_ids) with ordinality as p(question_id, pos)
+  join question_bank q on q.id = p.question_id
+  -- solo domande dello snapshot sorteggiato (non quelle di un import non ancora pubblicato)
+  where q.version_added <= v_session.bank_version
+  order by p.pos;
+
+  get diagnostics v_inserted = row_count;
+  if v_inserted < v_requested then
+    raise exception 'start_session: domande mancanti in question_bank (% su %)', v_inserted, v_requested
+      using errcode = 'QB001';  -- riconosciuto da start_session_from_paper
+  end if;
+
+  return json_build_object(
+    'session', row_to_json(v_session),
+    'questions', (
+      select coalesce(json_agg(json_build_object(
+        'id', a.id,
+        'question_id', a.question_id,
+        'position', a.position,
+        'correct_option', a.correct_option,
+        'chosen_option', a.chosen_option
+      ) order by a.position), '[]'::json)
+      from quiz_answers a
+      where a.session_id = v_session.id
+    )
+  );
+end;
+$$;
+
+-- il foglio d'esame porta la versione da cui è stato sorteggiato
+create or replace function start_session_from_paper(
+  p_student_id bigint,
+  p_n_questions int,
+  p_duration_seconds int default 1800,
+  p_topic_id bigint default null,
+  p_balanced boolean default false
+)
+returns json
+language plpgsql
+as $$
+declare
+  v_paper exam_papers;
+  v_result json;
+begin
+  loop
+    select * into v_paper
+    from exam_papers
+    where claimed_at is null
+      and n_questions = p_n_questions
+      and topic_id is not distinct from p_topic_id
+      and balanced = p_balanced
+    order by id
+    limit 1
+    for update skip locked;
+
+    if not found then
+      return null;
+    end if;
+
+    begin
+      v_result := start_session(
+        p_student_id, v_paper.question_ids, p_duration_seconds, 'sim',
+        case when p_topic_id is null then 'bank' else 'topic' end, p_topic_id,
+        v_paper.bank_version
+      );
+    exception when sqlstate 'QB001' then
+      -- foglio non più valido (domanda eliminata): lo si scarta e si prova il successivo;
+      -- ogni altro errore (lock, timeout, serializzazione) risale e il foglio resta libero
+      update exam_papers set claimed_at = now() where id = v_paper.id;
+      continue;
+    end;
+
+    update exam_papers
+    set claimed_at = now(),
+        student_id = p_student_id,
+        session_id = (v_result -> 'session' ->> 'id')::uuid
+    where id = v_paper.id;
+
+    return v_result;
+  end loop;
+end;
+$$;
@@ -0,0 +1,190 @@
+-- Forma canonica delle domande, garantita una volta per tutte in question_bank:
+--   testo, opzioni e spiegazione senza spazi ai bordi, opzione assente = '' (mai null),
+--   almeno le opzioni A e B, opzioni presenti consecutive (niente D senza C),
+--   correct_option maiuscola in A/B/C/D e riferita a un'opzione presente,
+--   n_options = numero di opzioni presenti (colonna calcolata).
+-- L'import del docente scarta le righe non valide e le segnala al caricamento;
+-- le domande già presenti con opzioni non canoniche passano in question_bank_quarantine;
+-- start_session copia la lettera così com'è, senza ripulire né riscrivere nulla.
+
+-- spazi ai bordi: stesso insieme di validate_csv_row (CSV_WHITESPACE in app.py)
+update question_bank
+set question_text = btrim(coalesce(question_text, ''), E' \t\n\r\f\v'),
+    option_a = btrim(coalesce(option_a, ''), E' \t\n\r\f\v'),
+    option_b = btrim(coalesce(option_b, ''), E' \t\n\r\f\v'),
+    option_c = btrim(coalesce(option_c, ''), E' \t\n\r\f\v'),
+    option_d = btrim(coalesce(option_d, ''), E' \t\n\r\f\v'),
+    explanation = btrim(coalesce(explanation, ''), E' \t\n\r\f\v'),
+    correct_option = upper(btrim(coalesce(correct_option, ''), E' \t\n\r\f\v'))
+where question_text is distinct from btrim(coalesce(question_text, ''), E' \t\n\r\f\v')
+   or option_a is distinct from btrim(coalesce(option_a, ''), E' \t\n\r\f\v')
+   or option_b is distinct from btrim(coalesce(option_b, ''), E' \t\n\r\f\v')
+   or option_c is distinct from btrim(coalesce(option_c, ''), E' \t\n\r\f\v')
+   or option_d is distinct from btrim(coalesce(option_d, ''), E' \t\n\r\f\v')
+   or explanation is distinct from btrim(coalesce(explanation, ''), E' \t\n\r\f\v')
+   or correct_option is distinct from upper(btrim(coalesce(correct_option, ''), E' \t\n\r\f\v'));
+
+-- Domande senza opzione A o B, o con un buco (D presente e C vuota): i vincoli sotto non
+-- si potrebbero aggiungere, e spostare le opzioni cambierebbe il significato delle lettere
+-- già date nelle sessioni passate. Si spostano in question_bank_quarantine (da ricaricare
+-- corrette): le risposte già date riprendono la copia del testo (come per una domanda
+-- eliminata) e i fogli d'esame non ancora assegnati che le contengono si eliminano.
+create table if not exists question_bank_quarantine (like question_bank);
+alter table question_bank_quarantine add column if not exists quarantined_at timestamptz not null default now();
+
+do $$
+declare
+  v_ids bigint[];
+begin
+  select array_agg(id) into v_ids
+  from question_bank
+  where not (option_a <> '' and option_b <> '' and (option_d = '' or option_c <> ''));
+  if v_ids is null then
+    return;
+  end if;
+
+  insert into question_bank_quarantine
+  select q.* from question_bank q where q.id = any(v_ids);
+
+  update quiz_answers a
+  set question_id = null,
+      question_text = q.question_text,
+      option_a = q.option_a,
+      option_b = q.option_b,
+      option_c = q.option_c,
+      option_d = q.option_d,
+      explanation = q.explanation
+  from question_bank q
+  where q.id = any(v_ids)
+    and a.question_id = q.id;
+
+  delete from exam_papers where claimed_at is null and question_ids && v_ids;
+  delete from question_bank where id = any(v_ids);
+  raise notice 'question_bank: % domande con opzioni mancanti o non consecutive spostate in question_bank_quarantine', array_length(v_ids, 1);
+end;
+$$;
+
+-- Lettere non valide già presenti: si applica un'ultima volta la stessa correzione che
+-- start_session faceva a ogni avvio (D senza opzione D -> ultima opzione presente),
+-- altrimenti la prima opzione presente, così le sessioni passate restano coerenti con
+-- la banca dati. content_hash non si ricalcola: un nuovo import della domanda con la
+-- lettera giusta la aggiunge come domanda distinta invece di sovrascrivere quella
+-- sistemata qui.
+do $$
+declare
+  v_fixed int;
+begin
+  update question_bank
+  set correct_option = case
+    when correct_option = 'D' and option_d = '' then
+      case when option_c <> '' then 'C' when option_b <> '' then 'B' else 'A' end
+    else
+      case when option_a <> '' then 'A' when option_b <> '' then 'B' when option_c <> '' then 'C' else 'D' end
+  end
+  where correct_option not in ('A', 'B', 'C', 'D')
+     or (correct_option = 'A' and option_a = '')
+     or (correct_option = 'B' and option_b = '')
+     or (correct_option = 'C' and option_c = '')
+     or (correct_option = 'D' and option_d = '');
+  get diagnostics v_fixed = row_count;
+  if v_fixed > 0 then
+    raise notice 'question_bank: lettera corretta sistemata su % domande (da ricontrollare)', v_fixed;
+  end if;
+end;
+$$;
+
+alter table question_bank alter column question_text set not null;
+alter table question_bank alter column option_a set not null;
+alter table question_bank alter column option_b set not null;
+alter table question_bank alter column option_c set not null;
+alter table question_bank alter column option_d set not null;
+alter table question_bank alter column explanation set not null;
+alter table question_bank alter column explanation set default '';
+
+alter table question_bank add column if not exists n_options smallint generated always as (
+  (option_a <> '')::int + (option_b <> '')::int + (option_c <> '')::int + (option_d <> '')::int
+) stored;
+
+-- stessa forma richiesta da validate_csv_row in app.py (e da "ABCD"[:n_options])
+alter table question_bank drop constraint if exists question_bank_options_check;
+alter table question_bank add constraint question_bank_options_check check (
+  option_a <> '' and option_b <> '' and (option_d = '' or option_c <> '')
+);
+
+alter table question_bank drop constraint if exists question_bank_correct_option_check;
+alter table question_bank add constraint question_bank_correct_option_check check (
+  case correct_option
+    when 'A' then option_a <> ''
+    when 'B' then option_b <> ''
+    when 'C' then option_c <> ''
+    when 'D' then option_d <> ''
+    else false
+  end
+);
+
+-- le righe ripulite sopra (timbrate dal trigger) diventano visibili alle cache
+select publish_bank_version();
+
+create or replace function start_session(
+  p_student_id bigint,
+  p_question_ids bigint[],
+  p_duration_seconds int default 1800,
+  p_mode text default 'sim',
+  p_topic_scope text default 'bank',
+  p_topic_id bigint default null,
+  p_bank_version bigint default null
+)
+returns json
+language plpgsql
+as $$
+declare
+  v_session sessions;
+  v_requested int := coalesce(array_length(p_question_ids, 1), 0);
+  v_inserted int;
+begin
+  if v_requested = 0 then
+    raise exception 'start_session: nessuna domanda richiesta';
+  end if;
+
+  insert into sessions (
+    student_id, mode, topic_scope, selected_topic_id, n_questions,
+    started_at, duration_seconds, status, bank_version
+  )
+  values (
+    p_student_id, p_mode, p_topic_scope, p_topic_id, v_requested,
+    now(), p_duration_seconds, 'in_progress',
+    coalesce(p_bank_version, (select max(version) from bank_versions))
+  )
+  returning * into v_session;
+
+  -- question_bank è già canonica (vincolo question_bank_correct_option_check)
+  insert into quiz_answers (session_id, question_id, position, topic_id, correct_option, chosen_option)
+  select v_session.id, q.id, p.pos, q.topic_id, q.correct_option, null
+  from unnest(p_question_ids) with ordinality as p(question_id, pos)
+  join question_bank q on q.id = p.question_id
+  -- solo domande dello snapshot sorteggiato (non quelle di un import non ancora pubblicato)
+  where q.version_added <= v_session.bank_version
+  order by p.pos;
+
+  get diagnostics v_inserted = row_count;
+  if v_inserted < v_requested then
+    raise exception 'start_session: domande mancanti in question_bank (% su %)', v_inserted, v_requested
+      using errcode = 'QB001';  -- riconosciuto da start_session_from_paper
+  end if;
+
+  return json_build_object(
+    'session', row_to_json(v_session),
+    'questions', (
+      select coalesce(json_agg(json_build_object(
+        'id', a.id,
+        'question_id', a.question_id,
+        'position', a.position,
+        'correct_option', a.correct_option,
+        'chosen_option', a.chosen_option
+      ) order by a.position), '[]'::json)
+      from quiz_answers a
+      where a.session_id = v_session.id
+    )
+  );
+end;
+$$;
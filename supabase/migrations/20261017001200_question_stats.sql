@@ -0,0 +1,133 @@
+-- Statistiche per domanda aggiornate in modo incrementale alla correzione di ogni sessione
+-- (grade_session), una riga per domanda: la scheda docente legge O(domande),
+-- senza scorrere quiz_answers.
+--   served / answered / correct          volte proposta, con risposta, risposta esatta
+--   chosen_a .. chosen_d                 distribuzione delle risposte date
+--   rest_sum_correct / rest_sum_wrong    somma del punteggio sul resto della prova
+--                                        (frazione 0..1, esclusa questa domanda) di chi
+--                                        ha risposto giusto / sbagliato o non ha risposto
+-- Difficoltà = correct / served; discriminazione = media del resto di chi ha risposto giusto
+-- meno quella di chi ha sbagliato (-1..1: bassa o negativa = domanda da rivedere).
+-- sessions.stats_at segna le sessioni già contate: una seconda correzione non conta due volte.
+
+create table if not exists question_stats (
+  question_id bigint primary key references question_bank (id) on delete cascade,
+  served int not null default 0,
+  answered int not null default 0,
+  correct int not null default 0,
+  chosen_a int not null default 0,
+  chosen_b int not null default 0,
+  chosen_c int not null default 0,
+  chosen_d int not null default 0,
+  rest_sum_correct double precision not null default 0,
+  rest_sum_wrong double precision not null default 0,
+  updated_at timestamptz not null default now()
+);
+
+alter table sessions add column if not exists stats_at timestamptz;
+
+create or replace function add_question_stats(p_session_id uuid)
+returns void
+language sql
+as $$
+  with s as (
+    select count(*) as n, count(*) filter (where is_correct) as score
+    from quiz_answers
+    where session_id = p_session_id
+  )
+  insert into question_stats as qs (
+    question_id, served, answered, correct, chosen_a, chosen_b, chosen_c, chosen_d,
+    rest_sum_correct, rest_sum_wrong, updated_at
+  )
+  select
+    a.question_id,
+    count(*),
+    count(*) filter (where a.chosen_option is not null),
+    count(*) filter (where a.is_correct),
+    count(*) filter (where a.chosen_option = 'A'),
+    count(*) filter (where a.chosen_option = 'B'),
+    count(*) filter (where a.chosen_option = 'C'),
+    count(*) filter (where a.chosen_option = 'D'),
+    coalesce(sum((s.score - 1)::double precision / greatest(s.n - 1, 1)) filter (where a.is_correct), 0),
+    coalesce(sum(s.score::double precision / greatest(s.n - 1, 1)) filter (where not a.is_correct), 0),
+    now()
+  from quiz_answers a
+  cross join s
+  where a.session_id = p_session_id
+    and a.question_id is not null
+  group by a.question_id
+  on conflict (question_id) do update set
+    served = qs.served + excluded.served,
+    answered = qs.answered + excluded.answered,
+    correct = qs.correct + excluded.correct,
+    chosen_a = qs.chosen_a + excluded.chosen_a,
+    chosen_b = qs.chosen_b + excluded.chosen_b,
+    chosen_c = qs.chosen_c + excluded.chosen_c,
+    chosen_d = qs.chosen_d + excluded.chosen_d,
+    rest_sum_correct = qs.rest_sum_correct + excluded.rest_sum_correct,
+    rest_sum_wrong = qs.rest_sum_wrong + excluded.rest_sum_wrong,
+    updated_at = now();
+$$;
+
+create or replace function grade_session(p_session_id uuid)
+returns json
+language plpgsql
+as $$
+declare
+  v_session sessions;
+begin
+  -- app e sweeper possono correggere la stessa sessione insieme: si serializzano sulla riga
+  perform 1 from sessions where id = p_session_id for update;
+
+  update quiz_answers
+  set is_correct = (chosen_option is not null and chosen_option = correct_option)
+  where session_id = p_session_id;
+
+  update sessions s
+  set
+    score = g.score,
+    answered = g.answered,
+    finished_at = coalesce(s.finished_at, now()),
+    graded_at = now(),
+    status = case when s.status = 'closed' then 'closed' else 'finished' end
+  from (
+    select
+      count(*) filter (where is_correct) as score,
+      count(*) filter (where chosen_option is not null) as answered
+    from quiz_answers
+    where session_id = p_session_id
+  ) g
+  where s.id = p_session_id
+  returning s.* into v_session;
+
+  if v_session.id is not null and v_session.stats_at is null then
+    perform add_question_stats(p_session_id);
+    update sessions set stats_at = now() where id = p_session_id;
+  end if;
+
+  return json_build_object(
+    'id', v_session.id,
+    'status', v_session.status,
+    'score', v_session.score,
+    'answered', v_session.answered,
+    'n_questions', v_session.n_questions,
+    'started_at', v_session.started_at,
+    'duration_seconds', v_session.duration_seconds,
+    'finished_at', v_session.finished_at
+  );
+end;
+$$;
+
+-- sessioni già corrette prima di questa migrazione: contate una volta qui
+do $$
+declare
+  v_id uuid;
+begin
+  for v_id in
+    select id from sessions where graded_at is not null and stats_at is null
+  loop
+    perform add_question_stats(v_id);
+    update sessions set stats_at = now() where id = v_id;
+  end loop;
+end;
+$$;
@@ -0,0 +1,22 @@
+-- Salvataggio delle risposte in una sola chiamata, qualunque sia il numero di risposte:
+-- p_answers = {"<quiz_answers.id>": "A" | "B" | "C" | "D" | null}.
+-- Si aggiornano solo le righe della sessione indicata; una lettera diversa da A/B/C/D
+-- vale come "nessuna risposta". Ritorna il numero di righe aggiornate.
+
+create or replace function save_answers(p_session_id uuid, p_answers jsonb)
+returns int
+language plpgsql
+as $$
+declare
+  v_updated int;
+begin
+  update quiz_answers a
+  set chosen_option = case when v.letter in ('A', 'B', 'C', 'D') then v.letter end
+  from jsonb_each_text(p_answers) as v(answer_id, letter)
+  where a.session_id = p_session_id
+    and a.id = v.answer_id::bigint;
+
+  get diagnostics v_updated = row_count;
+  return v_updated;
+end;
+$$;
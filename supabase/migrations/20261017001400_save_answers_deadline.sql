@@ -0,0 +1,41 @@
+-- save_answers accetta risposte solo per una sessione ancora in corso ed entro la scadenza
+-- (started_at + duration_seconds + margine, lo stesso di sweep_expired_sessions).
+-- Dopo la consegna, la correzione dello sweeper o la scadenza le risposte non cambiano più:
+-- punteggio e question_stats (contate una volta, sessions.stats_at) restano coerenti.
+-- La riga della sessione è bloccata in condivisione: grade_session (FOR UPDATE) aspetta
+-- la fine del salvataggio e un salvataggio concorrente vede lo stato già corretto.
+-- Ritorna il numero di righe aggiornate, -1 se la sessione è chiusa o scaduta.
+
+drop function if exists save_answers(uuid, jsonb);
+
+create or replace function save_answers(
+  p_session_id uuid,
+  p_answers jsonb,
+  p_grace_seconds int default 120
+)
+returns int
+language plpgsql
+as $$
+declare
+  v_updated int;
+begin
+  perform 1
+  from sessions s
+  where s.id = p_session_id
+    and s.status = 'in_progress'
+    and now() <= s.started_at + make_interval(secs => s.duration_seconds + p_grace_seconds)
+  for share;
+  if not found then
+    return -1;
+  end if;
+
+  update quiz_answers a
+  set chosen_option = case when v.letter in ('A', 'B', 'C', 'D') then v.letter end
+  from jsonb_each_text(p_answers) as v(answer_id, letter)
+  where a.session_id = p_session_id
+    and a.id = v.answer_id::bigint;
+
+  get diagnostics v_updated = row_count;
+  return v_updated;
+end;
+$$;
@@ -0,0 +1,44 @@
+-- Aggiornamenti dell'import in attesa di pubblicazione. Le domande nuove possono entrare
+-- subito in question_bank (version_added le tiene fuori dagli snapshot fino alla
+-- pubblicazione), ma spiegazione e argomento di una domanda già pubblicata si leggono
+-- dalla riga corrente (indice dell'app, testi delle sessioni): modificarli sul posto li
+-- renderebbe visibili prima della pubblicazione. L'import li scrive qui, per content_hash;
+-- publish_bank_version li applica e svuota la tabella nella stessa transazione in cui
+-- crea la versione. Un import interrotto prima della pubblicazione lascia qui le sue
+-- modifiche: entrano con la pubblicazione successiva.
+
+create table if not exists question_bank_staging (
+  content_hash text primary key,
+  explanation text not null default '',
+  topic_id bigint references topics (id) on delete set null,
+  staged_at timestamptz not null default now()
+);
+
+create or replace function publish_bank_version()
+returns json
+language plpgsql
+as $$
+declare
+  v_row bank_versions;
+begin
+  lock table question_bank in exclusive mode;
+  -- anche la coda: una riga accodata tra l'update e il delete andrebbe persa
+  lock table question_bank_staging in exclusive mode;
+
+  -- il trigger timbra version_changed con la versione creata qui sotto
+  update question_bank q
+  set explanation = s.explanation,
+      topic_id = s.topic_id
+  from question_bank_staging s
+  where q.content_hash = s.content_hash
+    and (q.explanation is distinct from s.explanation or q.topic_id is distinct from s.topic_id);
+  delete from question_bank_staging;
+
+  insert into bank_versions (version, n_questions)
+  select coalesce(max(v.version), 0) + 1, (select count(*) from question_bank)
+  from bank_versions v
+  returning * into v_row;
+
+  return row_to_json(v_row);
+end;
+$$;
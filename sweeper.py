@@ -0,0 +1,59 @@
+"""
+Chiusura delle simulazioni scadute e abbandonate, fuori dall'app (cron o worker
+dedicato). Chiama la funzione SQL sweep_expired_sessions a blocchi finché ne
+trova; è idempotente e si può lanciare da più macchine insieme.
+
+    python sweeper.py --once            # un giro e poi esce (cron)
+    python sweeper.py --interval 60     # ciclo continuo
+
+Legge SUPABASE_URL / SUPABASE_ANON_KEY dall'ambiente. Con questo processo attivo
+si può disattivare il thread dell'app con SWEEP_INTERVAL_SECONDS=0.
+"""
+import argparse
+import os
+import sys
+import time
+
+from supabase import create_client
+
+SWEEP_BATCH_SIZE = 200
+SWEEP_GRACE_SECONDS = 120
+
+
+def sweep_all(sb, batch_size: int = SWEEP_BATCH_SIZE, grace_seconds: int = SWEEP_GRACE_SECONDS) -> int:
+    total = 0
+    while True:
+        res = sb.rpc("sweep_expired_sessions", {"p_limit": batch_size, "p_grace_seconds": grace_seconds}).execute().data
+        total += int(res["finalized"])
+        if int(res["finalized"]) < batch_size:
+            return total
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Chiude e corregge le simulazioni scadute.")
+    p.add_argument("--once", action="store_true", help="un solo giro")
+    p.add_argument("--interval", type=float, default=60.0, help="secondi tra un giro e l'altro")
+    p.add_argument("--batch-size", type=int, default=SWEEP_BATCH_SIZE)
+    p.add_argument("--grace-seconds", type=int, default=SWEEP_GRACE_SECONDS)
+    args = p.parse_args(argv)
+
+    url, key = os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_ANON_KEY")
+    if not url or not key:
+        sys.exit("Mancano SUPABASE_URL / SUPABASE_ANON_KEY nell'ambiente.")
+    sb = create_client(url, key)
+
+    while True:
+        try:
+            n = sweep_all(sb, args.batch_size, args.grace_seconds)
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} sessioni chiuse: {n}", flush=True)
+        except Exception as e:
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} errore: {e}", file=sys.stderr, flush=True)
+            if args.once:
+                sys.exit(1)
+        if args.once:
+            return
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()